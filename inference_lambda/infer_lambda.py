@@ -1,83 +1,436 @@
 import os
+import json
 import time
 import boto3
 import numpy as np
 import pandas as pd
 import logging
-import tempfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pyarrow import fs
+from timestream_writer import TimestreamWriter, build_records
 
 aws_s3 = boto3.client("s3")
+aws_timestream = boto3.client("timestream-write")
+
+# bucket holding the models of all sites
+model_artifact_bucket = os.environ.get("model_artifact_bucket")
+# number of site models kept in memory between invocations, least recently used ones are dropped first
+model_cache_size = int(os.environ.get("model_cache_size", "32"))
+# seconds a cached model is used before checking whether a newer one was approved
+model_refresh_seconds = float(os.environ.get("model_refresh_seconds", "60"))
+# number of point groups of a batch read from S3 at the same time
+data_read_workers = int(os.environ.get("data_read_workers", "8"))
+# Timestream table the scored values are also written to, if both are set
+timestream_db_name = os.environ.get("timestream_db_name")
+timestream_table_name = os.environ.get("timestream_table_name")
 
 # Logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-model_df = pd.read_csv("model.csv")
+HOUR_NS = 3600 * 1_000_000_000
+# schema metadata key of the summary of a results part, as in the site results files (see results_report)
+SUMMARY_METADATA_KEY = b"summary"
+# tag of the results parts, which the results bucket expires if the init function could not delete them
+RESULTS_PART_TAGGING = "results-part=true"
+# values more than this many standard deviations from the mean are anomalies
+THRESHOLD_STDS = 2
+
+
+def build_model_index(model_df):
+    """Indexes a model table by (assetname, pointname), so a point's model is found in O(1).
+
+    Args:
+        model_df (dataframe): columns assetname, pointname, mean and std. Only the first
+            row of a pair counts.
+
+    Returns:
+        dict: (assetname, pointname) to (mean, std, lower_thresh, upper_thresh).
+    """
+    model_df = model_df.drop_duplicates(["assetname", "pointname"])
+    means = model_df["mean"].to_numpy(dtype=np.float64)
+    stds = model_df["std"].to_numpy(dtype=np.float64)
+    return dict(
+        zip(
+            zip(model_df["assetname"], model_df["pointname"]),
+            zip(
+                means.tolist(),
+                stds.tolist(),
+                (means - THRESHOLD_STDS * stds).tolist(),
+                (means + THRESHOLD_STDS * stds).tolist(),
+            ),
+        )
+    )
+
+
+def get_point_model(model_index, rtu, pointname):
+    """The (mean, std, lower_thresh, upper_thresh) of a point. Raises ValueError for a point without model."""
+    try:
+        return model_index[(rtu, pointname)]
+    except KeyError:
+        raise ValueError(f"No model for point {pointname} of asset {rtu}") from None
+
+
+def get_approved_model_key(site_id):
+    return f"models/{site_id}/approved.json"
+
+
+class ModelCache:
+    """Approved models of the sites, loaded from S3 and kept across warm invocations.
+
+    The approved model of a site is the version of its model file that
+    models/{site_id}/approved.json points to, so deploying a model only
+    rewrites that pointer. A cached model is used for refresh_seconds, after
+    which the pointer is read again, and the model is only loaded again if the
+    pointer names another version. At most max_models models are kept, the
+    least recently used one is dropped first.
+
+    Args:
+        s3_client: boto3 s3 client (or a stand-in with the same methods).
+        bucket (str): model artifact bucket.
+        max_models (int): number of models kept.
+        refresh_seconds (float): seconds between checks for a newly approved model.
+    """
+
+    def __init__(self, s3_client, bucket, max_models=32, refresh_seconds=60):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.max_models = max_models
+        self.refresh_seconds = refresh_seconds
+        # site_id to (version, time of the last check, model index), least recently used first
+        self.models = OrderedDict()
+
+    def read_approved(self, site_id):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=get_approved_model_key(site_id))
+        except self.s3_client.exceptions.NoSuchKey:
+            raise ValueError(f"No approved model for site {site_id}") from None
+        return json.loads(response["Body"].read())
+
+    def load(self, approved):
+        arguments = {"Bucket": self.bucket, "Key": approved["key"]}
+        if approved.get("versionId"):
+            arguments["VersionId"] = approved["versionId"]
+        response = self.s3_client.get_object(**arguments)
+        return build_model_index(
+            pd.read_csv(BytesIO(response["Body"].read()), dtype={"assetname": str, "pointname": str})
+        )
 
+    def get(self, site_id):
+        """The model index of a site's approved model, see build_model_index."""
+        now = time.monotonic()
+        cached = self.models.get(site_id)
+        if cached is not None and now - cached[1] < self.refresh_seconds:
+            self.models.move_to_end(site_id)
+            return cached[2]
+
+        approved = self.read_approved(site_id)
+        version = approved.get("versionId") or approved["etag"]
+        if cached is not None and cached[0] == version:
+            model_index = cached[2]
+        else:
+            model_index = self.load(approved)
+            logger.info(f"Loaded model {version} of {site_id} with {len(model_index)} points")
+        self.models[site_id] = (version, now, model_index)
+        self.models.move_to_end(site_id)
+        while len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+        return model_index
 
-def upload_to_s3(bucket_name, key, file_path):
+
+model_cache = ModelCache(aws_s3, model_artifact_bucket, model_cache_size, model_refresh_seconds)
+
+
+def upload_to_s3(bucket_name, key, body, tagging=None):
     """Uploads object to S3.
 
     Args:
         bucket_name (str): Destination bucket.
         key (str): File key in destination bucket.
-        file_path (str): Path to file to upload.
+        body (str): Content of the file.
+        tagging (str): optional tags of the object, as URL query parameters.
+    """
+
+    tags = {} if tagging is None else {"Tagging": tagging}
+    aws_s3.put_object(Bucket=bucket_name, Key=key, Body=body, **tags)
+    print("Successfully uploaded results to S3")
+
+
+def read_claim(data_ref, rtu, pointname, filesystem=None):
+    """Loads the data a claim check payload refers to.
+
+    Args:
+        data_ref (dict): bucket, and either the prefix of a partition of the site's
+            partitioned data, or the key of a Parquet file and the index of the row
+            group holding the point's data. Only that row group is read.
+        rtu (str): asset name of the point.
+        pointname (str): name of the point.
+        filesystem: optional pyarrow S3 filesystem to read with.
+
+    Returns:
+        dataframe: columns assetname, pointname, value and timestamp.
     """
+    if filesystem is None:
+        filesystem = fs.S3FileSystem(region=os.environ.get("AWS_REGION"))
+    columns = ["value", "timestamp"]
+    if "prefix" in data_ref:
+        table = pq.read_table(
+            data_ref["bucket"] + "/" + data_ref["prefix"], columns=columns, filesystem=filesystem
+        )
+    else:
+        with filesystem.open_input_file(data_ref["bucket"] + "/" + data_ref["key"]) as file:
+            table = pq.ParquetFile(file).read_row_group(data_ref["rowGroup"], columns=columns)
+    data_df = table.to_pandas()
+    data_df.insert(0, "assetname", rtu)
+    data_df.insert(1, "pointname", pointname)
+    return data_df
+
 
-    s3 = boto3.resource("s3")
-    s3.Bucket(bucket_name).upload_file(file_path, key)
-    print("Successfully uploaded model to S3")
+def score_values(values, lower_thresh, upper_thresh):
+    """Flags values outside the open interval (lower_thresh, upper_thresh).
+
+    A value is normal only if it lies strictly between the thresholds, so
+    values equal to a threshold, and NaN, are anomalies.
+
+    Args:
+        values (array): values of a point, or of several points.
+        lower_thresh (float or array): lower threshold, or the one of every value.
+        upper_thresh (float or array): upper threshold, or the one of every value.
+
+    Returns:
+        array: 1 for every anomaly and 0 otherwise, as int64.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return (~((lower_thresh < values) & (values < upper_thresh))).astype(np.int64)
+
+
+def summarize_results(key, rtu, pointname, data_df):
+    """Summary of a result file, for the site's results report.
+
+    Args:
+        key (str): key of the result file.
+        rtu (str): asset name of the point.
+        pointname (str): name of the point.
+        data_df (dataframe): the results, with columns timestamp and is_anomaly.
+
+    Returns:
+        dict: key, rtu, point, number of rows and anomalies, time range of the
+        values (nanoseconds, None without values) and the rows and anomalies of
+        every hour with values.
+    """
+    timestamps = data_df["timestamp"].to_numpy(dtype=np.int64)
+    anomalies = data_df["is_anomaly"].to_numpy()
+    hours = pd.DataFrame({"rows": 1, "anomalies": anomalies}).groupby(timestamps // HOUR_NS * HOUR_NS).sum()
+    return {
+        "key": key,
+        "rtu": rtu,
+        "point": pointname,
+        "rows": int(len(data_df)),
+        "anomalies": int(anomalies.sum()),
+        "startTime": int(timestamps.min()) if len(timestamps) else None,
+        "endTime": int(timestamps.max()) if len(timestamps) else None,
+        "hourly": [
+            [int(hour), int(rows), int(count)]
+            for hour, rows, count in zip(hours.index, hours["rows"], hours["anomalies"])
+        ],
+    }
+
+
+def score_points(model_index, keys, frames):
+    """Scores the data of several points in a single pass over all their values.
+
+    Args:
+        model_index (dict): model of the site, see build_model_index.
+        keys (list): (rtu, pointname) of every point.
+        frames (list): data of every point, with a value column.
+
+    Returns:
+        tuple: the is_anomaly flags of every point, and the error of every point without model
+        (None for the others). Points without model get no flags.
+    """
+    lower_thresh = np.full(len(keys), np.nan)
+    upper_thresh = np.full(len(keys), np.nan)
+    errors = [None] * len(keys)
+    for i, (rtu, pointname) in enumerate(keys):
+        try:
+            _, _, lower_thresh[i], upper_thresh[i] = get_point_model(model_index, rtu, pointname)
+        except ValueError as err:
+            errors[i] = str(err)
+    lengths = np.array([len(frame) for frame in frames], dtype=np.int64)
+    if len(frames) > 0:
+        values = np.concatenate([frame["value"].to_numpy(dtype=np.float64) for frame in frames])
+    else:
+        values = np.empty(0, dtype=np.float64)
+    is_anomaly = score_values(
+        values, np.repeat(lower_thresh, lengths), np.repeat(upper_thresh, lengths)
+    )
+    flags = np.split(is_anomaly, np.cumsum(lengths)[:-1])
+    return [None if error else flag for flag, error in zip(flags, errors)], errors
+
+
+def write_results_part(key, keys, frames):
+    """Writes the scored data of several points as one part of the site's results.
+
+    The part has the layout of a site results file (see results_report.writeSiteResults,
+    which is not part of this image): the anomalies come first, in their own row
+    group, followed by the other rows, and the number of anomaly row groups is
+    stored in the schema metadata. The caller merges the parts of all
+    invocations into the site's results file.
+
+    Args:
+        key (str): key of the part in the results bucket.
+        keys (list): (rtu, pointname) of every point.
+        frames (list): data of every point, with columns value, timestamp and is_anomaly.
+    """
+    lengths = [len(frame) for frame in frames]
+    rtu_codes = {rtu: code for code, rtu in enumerate(dict.fromkeys(rtu for rtu, _ in keys))}
+    point_codes = {pointname: code for code, pointname in enumerate(dict.fromkeys(point for _, point in keys))}
+    results = pd.DataFrame(
+        {
+            "assetname": pd.Categorical.from_codes(
+                np.repeat([rtu_codes[rtu] for rtu, _ in keys], lengths).astype(np.int32), list(rtu_codes)
+            ),
+            "pointname": pd.Categorical.from_codes(
+                np.repeat([point_codes[pointname] for _, pointname in keys], lengths).astype(np.int32),
+                list(point_codes),
+            ),
+            "value": np.concatenate([frame["value"].to_numpy(dtype=np.float64) for frame in frames]),
+            "timestamp": np.concatenate([frame["timestamp"].to_numpy(dtype=np.int64) for frame in frames]),
+            "is_anomaly": np.concatenate([frame["is_anomaly"].to_numpy() for frame in frames]).astype(np.int8),
+        }
+    )
+    results = results.sort_values(["assetname", "pointname", "timestamp"], kind="stable")
+    is_anomaly = results["is_anomaly"].to_numpy() == 1
+    parts = [part for part in (results[is_anomaly], results[~is_anomaly]) if len(part) > 0]
+    schema = pa.Schema.from_pandas(results, preserve_index=False).with_metadata(
+        {SUMMARY_METADATA_KEY: json.dumps({"anomalyRowGroups": int(is_anomaly.any())})}
+    )
+    body = pa.BufferOutputStream()
+    with pq.ParquetWriter(body, schema, compression="zstd") as writer:
+        for part in parts:
+            writer.write_table(
+                pa.Table.from_pandas(part, schema=schema, preserve_index=False), row_group_size=len(part)
+            )
+    upload_to_s3(os.environ["bucket"], key, body.getvalue().to_pybytes(), RESULTS_PART_TAGGING)
+
+
+def store_results(site_id, event_id, rtu, pointname, data_df, results_key=None):
+    """Writes the scored data of a point to S3, unless it goes to a part of the site's
+    results (see write_results_part), and writes it to Timestream.
+
+    Returns:
+        dict: summary of the results (see summarize_results), or None if they could not be written.
+    """
+    if results_key is not None:
+        summary = summarize_results(results_key, rtu, pointname, data_df)
+    else:
+        out_file_name = f"{site_id}_{rtu}_{pointname}.csv"
+        try:
+            # Save output in s3
+            bucket_name = os.environ["bucket"]
+            key = f"{event_id}/{out_file_name}"
+
+            upload_to_s3(bucket_name, key, data_df.to_csv())
+            summary = summarize_results(key, rtu, pointname, data_df)
+        except Exception as err:
+            print(err)
+            return
+
+    if timestream_db_name and timestream_table_name:
+        # the S3 results stay the complete record, values Timestream rejects are only logged
+        try:
+            writer = TimestreamWriter(aws_timestream, timestream_db_name, timestream_table_name)
+            rejected = writer.write(
+                {"site_id": site_id, "rtu": rtu, "point": pointname}, build_records(data_df)
+            )
+            if rejected:
+                logger.warning(f"Timestream rejected {len(rejected)} values: {rejected[0]['Reason']}")
+            summary["timestreamRejected"] = len(rejected)
+        except Exception as err:
+            print(err)
+    return summary
+
+
+def load_point(point, filesystem):
+    # the data comes with the event, or as a reference to it in S3 (claim check)
+    if "dataRef" in point:
+        return read_claim(point["dataRef"], point["rtu"], point["point"], filesystem)
+    return pd.DataFrame(point["data"])
 
 
 def handler(lambda_event, context):
     """Lambda function to run inference. Predicts if
-    values in the data are anomalies.
+    values in the data are anomalies, and returns a summary
+    of the results (see summarize_results).
+
+    The event holds a single point (rtu, point, and data or dataRef), or a
+    batch of them as points, a list of such points of the same site. A batch
+    is read concurrently and scored in one pass, and returns
+    {"points": [...]} with the summary of every point, or its error if the
+    site's model has no such point.
+
+    The results are written to S3 as one CSV file per point, unless the
+    event has a resultsKey: then the results of all its points are written
+    as one part to resultsPartKey (see write_results_part), and the caller
+    merges the parts of the site into its results file at resultsKey. Either
+    way only the summaries are returned, so the response stays small no
+    matter how many values were scored.
     """
     print(lambda_event)
     print(os.environ)
 
     site_id = lambda_event["site_id"]
-    rtu = lambda_event["rtu"]
-    pointname = lambda_event["point"]
-    data_df = pd.DataFrame(lambda_event["data"])
     event_id = lambda_event["event_id"]
     pipeline_type = lambda_event["pipeline_type"]
+    results_key = lambda_event.get("resultsKey")
+    results_part_key = lambda_event.get("resultsPartKey")
+    points = lambda_event.get("points")
+    model_index = model_cache.get(site_id)
 
-    # get mean and standard deviation for that asset-pointname combination
-    asset_groups = model_df.groupby(["assetname", "pointname"])
-    mean_std_df = asset_groups.get_group((rtu, pointname))
-    mean = mean_std_df["mean"].values[0]
-    std = mean_std_df["std"].values[0]
+    if points is None:
+        rtu = lambda_event["rtu"]
+        pointname = lambda_event["point"]
+        data_df = load_point(lambda_event, None)
 
-    # calculate threshold based on mean and standard deviation
-    upper_thresh = mean + 2 * std
-    lower_thresh = mean - 2 * std
+        # thresholds based on mean and standard deviation of that asset-pointname combination
+        mean, std, lower_thresh, upper_thresh = get_point_model(model_index, rtu, pointname)
 
-    is_anomaly = []
-    for i in range(data_df.shape[0]):
-        if lower_thresh < data_df["value"][i] < upper_thresh:
-            is_anomaly.append(0)
-        else:
-            is_anomaly.append(1)
+        data_df["is_anomaly"] = score_values(data_df["value"].to_numpy(), lower_thresh, upper_thresh)
+        if results_key is not None:
+            write_results_part(results_part_key, [(rtu, pointname)], [data_df])
+        return store_results(site_id, event_id, rtu, pointname, data_df, results_key)
 
-    data_df["is_anomaly"] = is_anomaly
-    out_file_name = f"{site_id}_{rtu}_{pointname}.csv"
-    
-    # create temp directory
-    tmpdir = tempfile.mkdtemp()
-    try:
-        path = f"{tmpdir}/{out_file_name}"
-        data_df.to_csv(path)
-
-        # Save output in s3
-        bucket_name = os.environ["bucket"]
-        key = f"{event_id}/{out_file_name}"
-
-        upload_to_s3(bucket_name, key, path)
-    except Exception as err:
-        print(err)
-    finally:
-        os.remove(path)
-        os.rmdir(tmpdir)
-        
+    filesystem = fs.S3FileSystem(region=os.environ.get("AWS_REGION"))
+    with ThreadPoolExecutor(max_workers=data_read_workers) as executor:
+        frames = list(executor.map(lambda point: load_point(point, filesystem), points))
+    keys = [(point["rtu"], point["point"]) for point in points]
+    flags, errors = score_points(model_index, keys, frames)
+
+    scored = [index for index, error in enumerate(errors) if error is None]
+    for index in scored:
+        frames[index]["is_anomaly"] = flags[index]
+    if results_key is not None and scored:
+        try:
+            write_results_part(
+                results_part_key, [keys[index] for index in scored], [frames[index] for index in scored]
+            )
+        except Exception as err:
+            print(err)
+            errors = [error or "results could not be written" for error in errors]
+
+    results = []
+    for (rtu, pointname), data_df, error in zip(keys, frames, errors):
+        if error is not None:
+            results.append({"rtu": rtu, "point": pointname, "error": error})
+            continue
+        summary = store_results(site_id, event_id, rtu, pointname, data_df, results_key)
+        if summary is None:
+            summary = {"rtu": rtu, "point": pointname, "error": "results could not be written"}
+        results.append(summary)
+    logger.info(f"Scored {sum(len(frame) for frame in frames)} values of {len(points)} points")
+    return {"points": results}
@@ -0,0 +1,130 @@
+import time
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# most records a single WriteRecords request takes
+MAX_RECORDS_PER_REQUEST = 100
+MEASURE_NAME = "inference"
+# errors after which a whole request is sent again
+RETRYABLE_ERRORS = ("ThrottlingException", "InternalServerException")
+
+
+def build_records(data_df):
+    """Turns scored values into multi-measure Timestream records.
+
+    Only what differs between records is kept in them: the time and the
+    measures. A missing value is left out, as Timestream has no NaN.
+
+    Args:
+        data_df (dataframe): columns timestamp (nanoseconds), value and is_anomaly.
+
+    Returns:
+        list: the records.
+    """
+    records = []
+    for timestamp, value, is_anomaly in zip(
+        data_df["timestamp"].to_numpy(dtype=np.int64),
+        data_df["value"].to_numpy(dtype=np.float64),
+        data_df["is_anomaly"].to_numpy(),
+    ):
+        measures = [{"Name": "is_anomaly", "Value": str(int(is_anomaly)), "Type": "BIGINT"}]
+        if not np.isnan(value):
+            measures.insert(0, {"Name": "value", "Value": repr(float(value)), "Type": "DOUBLE"})
+        records.append({"Time": str(timestamp), "MeasureValues": measures})
+    return records
+
+
+class TimestreamWriter:
+    """Writes inference results to a Timestream table in batches.
+
+    Records are sent MAX_RECORDS_PER_REQUEST at a time, with the dimensions,
+    measure name and time unit they share as common attributes of the request,
+    and up to workers requests at the same time. Rejected records are sent again:
+    records rejected because a different version of them exists get a higher
+    version, and throttled or failed requests are repeated with exponential
+    backoff. Records rejected for any other reason, e.g. a time outside the
+    table's memory store retention, cannot succeed and are only reported.
+
+    Args:
+        client: boto3 timestream-write client, or any stand-in with a write_records method that
+            raises botocore ClientErrors like it.
+        database (str): Timestream database.
+        table (str): Timestream table.
+        workers (int): number of requests sent at the same time.
+        max_attempts (int): most times a record is sent.
+        backoff_seconds (float): wait before the first repeat of a request, doubled on every further one.
+    """
+
+    def __init__(self, client, database, table, workers=4, max_attempts=5, backoff_seconds=0.1):
+        self.client = client
+        self.database = database
+        self.table = table
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+
+    def write_batch(self, common_attributes, records):
+        """Writes up to MAX_RECORDS_PER_REQUEST records. Returns the ones that were finally rejected."""
+        rejected = []
+        for attempt in range(self.max_attempts):
+            try:
+                self.client.write_records(
+                    DatabaseName=self.database,
+                    TableName=self.table,
+                    CommonAttributes=common_attributes,
+                    Records=records,
+                )
+                return rejected
+            except ClientError as err:
+                code = err.response["Error"]["Code"]
+                if code in RETRYABLE_ERRORS:
+                    logger.info(f"Write of {len(records)} records failed with {code}, attempt {attempt + 1}")
+                    time.sleep(self.backoff_seconds * 2**attempt)
+                    continue
+                if code != "RejectedRecordsException":
+                    raise
+                # the records of the request that were not rejected are written
+                retried = []
+                for rejection in err.response.get("RejectedRecords", []):
+                    record = records[rejection["RecordIndex"]]
+                    if "ExistingVersion" in rejection:
+                        # a rescored value replaces the one written before
+                        retried.append({**record, "Version": rejection["ExistingVersion"] + 1})
+                    else:
+                        rejected.append({**record, "Reason": rejection.get("Reason")})
+                records = retried
+                if not records:
+                    return rejected
+        return rejected + [{**record, "Reason": "Retries exhausted"} for record in records]
+
+    def write(self, dimensions, records):
+        """Writes records that share the given dimensions.
+
+        Args:
+            dimensions (dict): dimension names and values, e.g. site_id, rtu and point.
+            records (list): multi-measure records, see build_records.
+
+        Returns:
+            list: the records that could not be written, each with the reason for it.
+        """
+        common_attributes = {
+            "Dimensions": [{"Name": name, "Value": str(value)} for name, value in dimensions.items()],
+            "MeasureName": MEASURE_NAME,
+            "MeasureValueType": "MULTI",
+            "TimeUnit": "NANOSECONDS",
+        }
+        batches = [
+            records[start : start + MAX_RECORDS_PER_REQUEST]
+            for start in range(0, len(records), MAX_RECORDS_PER_REQUEST)
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(lambda batch: self.write_batch(common_attributes, batch), batches)
+            rejected = [record for batch_rejected in results for record in batch_rejected]
+        logger.info(
+            f"Wrote {len(records) - len(rejected)} of {len(records)} records in {len(batches)} requests"
+        )
+        return rejected
@@ -0,0 +1,44 @@
+import os
+import boto3
+import logging
+from history_store import HistoryStore
+from init_lambda import readFromS3
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+aws_s3 = boto3.client("s3")
+
+# data bucket holding the extracts and the history store
+data_bucket = os.environ.get("data_bucket")
+# period length of the history files of a new store, "day" or "month"
+history_granularity = os.environ.get("history_granularity", "day")
+
+
+def handler(event, context):
+    """Lambda function to merge the hourly extract of a site into its history store,
+    which raw retrain extractions read instead of querying SiteWise again.
+    """
+    print(event)
+    print(os.environ)
+
+    site_id = event["Payload"]["site_id"]
+    pipeline_type = event["Payload"]["pipeline_type"]
+    event_id = event["Payload"]["event_id"]
+    # query window of the extraction, as half-open nanosecond range
+    window = event["Payload"].get("window")
+    if pipeline_type != "inference" or window is None:
+        print("Nothing to compact for " + pipeline_type + " event " + event_id)
+        return
+
+    data = readFromS3(
+        site_id, data_bucket, pipeline_type, event_id, ["assetname", "pointname", "value", "timestamp"]
+    )
+    store = HistoryStore(aws_s3, data_bucket, site_id, history_granularity)
+    # the points whose every value in the window was read, which are covered by the window from now on
+    points = event["Payload"].get("coveredPoints", [])
+    coverage = store.compact(data, window[0], window[1], points)
+    logger.info(
+        f'Extended the history store coverage of {len(points)} points, '
+        f'{sum(len(assets) for assets in coverage["points"].values())} points of {site_id} are covered'
+    )
@@ -0,0 +1,238 @@
+import json
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import BytesIO
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from site_schema import applySchema
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PREFIX = "history/"
+# numpy datetime units of the supported period lengths
+PERIOD_UNITS = {"day": "D", "month": "M"}
+DEFAULT_WORKERS = 8
+
+
+def addInterval(intervals, lower, upper):
+    """Adds the half-open range [lower, upper) to sorted, disjoint intervals, merging those it touches."""
+    merged = []
+    for start, end in intervals:
+        if end < lower or start > upper:
+            merged.append([start, end])
+        else:
+            lower = min(lower, start)
+            upper = max(upper, end)
+    merged.append([lower, upper])
+    return sorted(merged)
+
+
+def intersectIntervals(intervals, lower, upper):
+    """Parts of the intervals that lie within [lower, upper)."""
+    return [
+        [max(start, lower), min(end, upper)]
+        for start, end in intervals
+        if start < upper and end > lower
+    ]
+
+
+def subtractIntervals(intervals, lower, upper):
+    """Parts of [lower, upper) that none of the sorted, disjoint intervals cover."""
+    gaps = []
+    for start, end in intersectIntervals(intervals, lower, upper):
+        if start > lower:
+            gaps.append([lower, start])
+        lower = end
+    if lower < upper:
+        gaps.append([lower, upper])
+    return gaps
+
+
+def alignIntervals(intervals, step):
+    """Shrinks intervals to their largest parts whose ends are multiples of step, dropping those that vanish."""
+    aligned = []
+    for start, end in intervals:
+        start = -(-start // step) * step
+        end = end // step * step
+        if start < end:
+            aligned.append([start, end])
+    return aligned
+
+
+def getPointCoverage(coverage, assetname, pointname):
+    """Sorted, disjoint half-open nanosecond intervals the store holds every value of a point in."""
+    return coverage["points"].get(assetname, {}).get(pointname, [])
+
+
+def getPeriods(timestamps, granularity):
+    """Names of the periods (e.g. 2022-05-16 for days, 2022-05 for months) nanosecond timestamps fall into."""
+    return (
+        np.asarray(timestamps, dtype=np.int64)
+        .astype("datetime64[ns]")
+        .astype(f"datetime64[{PERIOD_UNITS[granularity]}]")
+        .astype(str)
+    )
+
+
+def getIntervalPeriods(intervals, granularity):
+    """Names of every period that overlaps one of the half-open nanosecond intervals, in time order."""
+    unit = PERIOD_UNITS[granularity]
+    periods = {}
+    for start, end in intervals:
+        first = np.datetime64(int(start), "ns").astype(f"datetime64[{unit}]")
+        last = np.datetime64(int(end) - 1, "ns").astype(f"datetime64[{unit}]")
+        for period in np.arange(first, last + 1).astype(str):
+            periods[period] = None
+    return list(periods)
+
+
+class HistoryStore:
+    """History of a site's point values, compacted from the extracts of the inference pipeline.
+
+    Values are kept in one Parquet file per asset, point and period under
+    history/{site_id}/asset={assetname}/point={pointname}/{granularity}={period}/
+    (percent-encoded), with columns value and timestamp, sorted by timestamp and
+    with at most one value per timestamp. Values are stored as float32 where that
+    is lossless for the point (see site_schema.applySchema). Merging an extract
+    rewrites only the files of the periods it touches, so daily files stay cheap
+    to update every hour.
+
+    The time ranges the store holds every value of are kept per point in
+    history/{site_id}/_coverage.json, as sorted, disjoint half-open nanosecond
+    intervals by asset and point name (see getPointCoverage). A point that was
+    added to the site later, or that could not be read completely, is only
+    covered where its own values were stored. Readers only trust the store
+    within a point's intervals, and get the rest from the source. The coverage
+    is written after the files, so it never claims values that are not stored yet.
+
+    Args:
+        s3_client: boto3 s3 client (or a stand-in with the same methods).
+        bucket (str): bucket of the store.
+        site_id (str): site the store belongs to.
+        granularity (str): period length of the files of a new store, "day" or "month". An existing
+            store keeps the granularity recorded in its coverage.
+        workers (int): number of files read or written at the same time.
+    """
+
+    def __init__(self, s3_client, bucket, site_id, granularity="day", workers=DEFAULT_WORKERS):
+        if granularity not in PERIOD_UNITS:
+            raise ValueError(f"Unsupported history granularity {granularity}")
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = HISTORY_PREFIX + site_id + "/"
+        self.granularity = granularity
+        self.workers = workers
+
+    def getKey(self, assetname, pointname, granularity, period):
+        return (
+            f"{self.prefix}asset={quote(assetname, safe='')}/point={quote(pointname, safe='')}/"
+            f"{granularity}={period}/data.parquet"
+        )
+
+    def readCoverage(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + "_coverage.json")
+        except self.s3_client.exceptions.NoSuchKey:
+            return {"granularity": self.granularity, "points": {}}
+        return json.loads(response["Body"].read())
+
+    def writeCoverage(self, coverage):
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.prefix + "_coverage.json", Body=json.dumps(coverage)
+        )
+
+    def readFile(self, key, filters=None):
+        # returns None for a period the store has no values of
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return pq.read_table(BytesIO(response["Body"].read()), filters=filters).to_pandas()
+
+    def writeFile(self, key, data):
+        body = pa.BufferOutputStream()
+        data = applySchema(data, downcast=True)
+        pq.write_table(pa.Table.from_pandas(data, preserve_index=False), body, compression="zstd")
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body.getvalue().to_pybytes())
+
+    def mergeFile(self, key, data):
+        # newer extracts win over the values stored for the same timestamp
+        stored = self.readFile(key)
+        if stored is not None:
+            data = pd.concat([stored, data], ignore_index=True)
+        data = data.drop_duplicates("timestamp", keep="last").sort_values("timestamp", kind="stable")
+        self.writeFile(key, data)
+        return len(data)
+
+    def compact(self, data, lower, upper, points):
+        """Merges an extract into the store.
+
+        Args:
+            data (dataframe): the extract, with columns assetname, pointname, value and timestamp.
+            lower (int): inclusive start of the extract's time range, in nanoseconds.
+            upper (int): exclusive end of the extract's time range, in nanoseconds.
+            points (list): dict objects with keys assetname and pointname, the points the extract holds
+                every value of in its range. Only their coverage is extended.
+
+        Returns:
+            dict: the coverage of the store after the merge.
+        """
+        coverage = self.readCoverage()
+        granularity = coverage["granularity"]
+        data = data[["assetname", "pointname", "value", "timestamp"]]
+        periods = getPeriods(data["timestamp"].to_numpy(), granularity)
+        groups = data[["value", "timestamp"]].groupby(
+            [data["assetname"], data["pointname"], periods], observed=True, sort=False
+        )
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(
+                    self.mergeFile,
+                    self.getKey(str(assetname), str(pointname), granularity, period),
+                    group.astype({"value": np.float64, "timestamp": np.int64}),
+                )
+                for (assetname, pointname, period), group in groups
+            ]
+            stored = sum(future.result() for future in futures)
+        logger.info(f"Merged {len(data)} values into {len(futures)} files holding {stored} values")
+
+        for point in points:
+            asset = coverage["points"].setdefault(point["assetname"], {})
+            asset[point["pointname"]] = addInterval(asset.get(point["pointname"], []), lower, upper)
+        if points:
+            self.writeCoverage(coverage)
+        return coverage
+
+    def read(self, assetname, pointname, intervals, granularity=None):
+        """Reads the stored values of one point within the given half-open nanosecond intervals.
+
+        Returns:
+            dataframe: columns assetname, pointname, value and timestamp, in time order (see site_schema).
+        """
+        granularity = granularity or self.granularity
+        periods = getIntervalPeriods(intervals, granularity)
+        filters = [[("timestamp", ">=", start), ("timestamp", "<", end)] for start, end in intervals]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            frames = [
+                frame
+                for frame in executor.map(
+                    lambda period: self.readFile(
+                        self.getKey(assetname, pointname, granularity, period), filters
+                    ),
+                    periods,
+                )
+                if frame is not None
+            ]
+        if frames:
+            data = pd.concat(frames, ignore_index=True)
+        else:
+            data = pd.DataFrame(
+                {"value": np.empty(0, np.float64), "timestamp": np.empty(0, np.int64)}
+            )
+        codes = np.zeros(len(data), dtype=np.int8)
+        data.insert(0, "assetname", pd.Categorical.from_codes(codes, [assetname]))
+        data.insert(1, "pointname", pd.Categorical.from_codes(codes, [pointname]))
+        return applySchema(data)
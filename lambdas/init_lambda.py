@@ -1,44 +1,428 @@
 import os
 import json
+import time
+import operator
+import functools
 import boto3
+import numpy as np
 import pandas as pd
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from site_schema import CSV_DTYPES, applySchema
+from s3_stream_writer import S3StreamWriter, ParquetFrameWriter
+from results_report import ResultsReport, getSiteResultsKey, getSiteResultsPartKey, mergeSiteResults
+
+# most inference invocations in flight at the same time
+inference_max_in_flight = int(os.environ.get("inference_max_in_flight", "10"))
+# seconds to wait for an inference invocation to return before it counts as failed, a little longer than the
+# inference function's own timeout. an invocation never waits past the time this function has left
+inference_timeout_seconds = int(os.environ.get("inference_timeout_seconds", "330"))
+# times a failed inference invocation is repeated, as long as there is time left for it
+inference_retries = int(os.environ.get("inference_retries", "2"))
+# seconds of the invocation kept for merging the results and recording them once the inference calls are done
+results_margin_seconds = int(os.environ.get("results_margin_seconds", "120"))
+
+# fewest seconds an inference invocation is started with
+MIN_INVOKE_SECONDS = 30
+# errors of the Invoke API after which an invocation is repeated. an error of the function itself is not
+# repeated, as the same payload fails the same way again
+RETRYABLE_INVOKE_ERROR_CODES = {
+    "TooManyRequestsException",
+    "ServiceException",
+    "EC2ThrottledException",
+    "ResourceNotReadyException",
+}
 
-aws_lambda = boto3.client("lambda")
 aws_s3 = boto3.client("s3")
 
 # data bucket to read data from
 data_bucket = os.environ.get("data_bucket")
+# inference function shared by all sites, which loads the approved model of the site it is invoked for
+inference_function_name = os.environ.get("inference_function_name", "inference-lambda")
+# inference results bucket, which holds the results report of every site
+results_bucket = os.environ.get("bucket")
+# "point" lets every inference function write its results as a CSV file of its own, "site" writes the
+# results of all points of a site and run as one Parquet object, merged from the parts the inference
+# functions write (see results_report.mergeSiteResults)
+results_output = os.environ.get("results_output", "point")
+# number of partitions of a partitioned site dataset read at the same time
+partition_read_workers = int(os.environ.get("partition_read_workers", "8"))
+# claim check mode sends the inference function a reference to its point's data in S3 instead of the data
+# itself, so payloads stay small no matter how many values a point has
+claim_check = os.environ.get("claim_check", "false").lower() == "true"
+# most point groups and values sent to one inference invocation. a site is scored in shards within both limits
+inference_batch_points = int(os.environ.get("inference_batch_points", "1"))
+inference_batch_rows = int(os.environ.get("inference_batch_rows", "100000"))
+# most bytes of data sent inline to one inference invocation, which keeps the request below the 6 MB payload
+# limit of synchronous invocations. a value takes about 150 bytes as JSON, so without claim check a shard holds
+# far fewer values than inference_batch_rows. claim check references only count against the row limit
+inference_batch_bytes = int(os.environ.get("inference_batch_bytes", "5000000"))
+
+# partition keys of the partitioned layout and the columns they stand for
+PARTITION_COLUMNS = {"asset": "assetname", "point": "pointname"}
+
+
+# comparison operators of read filters, as in pyarrow's filters
+FILTER_OPERATORS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda column, values: column.isin(values),
+    "not in": lambda column, values: ~column.isin(values),
+}
+
+
+def hasParquetParts(s3_bucket_name, prefix):
+    """Tells whether the extraction wrote Parquet part files under prefix."""
+    response = aws_s3.list_objects_v2(Bucket=s3_bucket_name, Prefix=prefix, MaxKeys=1)
+    return response.get("KeyCount", 0) > 0
+
+
+def filterFrame(data, filters):
+    """Keeps the rows that meet all (column, operator, value) conditions."""
+    mask = np.ones(len(data), dtype=bool)
+    for column, op, value in filters:
+        mask &= FILTER_OPERATORS[op](data[column], value).to_numpy()
+    return data[mask].reset_index(drop=True)
+
+
+def readPartitionManifest(s3_bucket_name, prefix):
+    """Reads the manifest of a partitioned site dataset.
+
+    Returns:
+        dict: the manifest with the partitions, their row counts and time ranges,
+        or None if the data under prefix is not partitioned.
+    """
+    try:
+        response = aws_s3.get_object(Bucket=s3_bucket_name, Key=prefix + "_manifest.json")
+    except aws_s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(response["Body"].read())
+
+
+def readPartition(s3_bucket_name, prefix, partition, columns=None):
+    """Reads the data of a single asset/point partition, without touching the others.
+
+    Args:
+        s3_bucket_name (str): Name of the S3 bucket the data is in.
+        prefix (str): prefix of the partitioned dataset.
+        partition (dict): the partition, as listed in the manifest.
+        columns (list): optional columns to read.
+
+    Returns:
+        dataframe: data of the partition, with its assetname and pointname columns (see site_schema).
+    """
+    value_columns = None
+    if columns is not None:
+        value_columns = [column for column in columns if column not in PARTITION_COLUMNS.values()]
+    data = pd.read_parquet(
+        "s3://" + s3_bucket_name + "/" + prefix + partition["path"], columns=value_columns
+    )
+    codes = np.zeros(len(data), dtype=np.int8)
+    data.insert(0, "assetname", pd.Categorical.from_codes(codes, [partition["assetname"]]))
+    data.insert(1, "pointname", pd.Categorical.from_codes(codes, [partition["pointname"]]))
+    if columns is not None:
+        data = data[list(columns)]
+    return applySchema(data)
+
+
+def readPartitions(s3_bucket_name, prefix, partitions, columns=None):
+    """Reads asset/point partitions concurrently, partition_read_workers at a time.
+
+    A partition is only read once fewer than partition_read_workers partitions
+    are waiting to be taken, so a consumer that takes them as it needs them only
+    holds the partitions it works on plus the ones read ahead.
+
+    Yields:
+        tuple: (assetname, pointname) and the data of each partition, in the order of partitions.
+    """
+    with ThreadPoolExecutor(max_workers=partition_read_workers) as executor:
+        reads = deque()
+        for partition in partitions:
+            reads.append((partition, executor.submit(readPartition, s3_bucket_name, prefix, partition, columns)))
+            if len(reads) < partition_read_workers:
+                continue
+            done, future = reads.popleft()
+            yield (done["assetname"], done["pointname"]), future.result()
+        for done, future in reads:
+            yield (done["assetname"], done["pointname"]), future.result()
 
 
-def readFromS3(site_id, s3_bucket_name, pipeline_type, event_id):
+def readPartitionedDataset(s3_bucket_name, prefix, manifest, columns=None, filters=None):
+    """Reads a partitioned site dataset as one frame. Filters on assetname and pointname
+    select partitions, so only the matching partitions are read."""
+    keys = {column: key for key, column in PARTITION_COLUMNS.items()}
+    if not manifest["partitions"]:
+        data = pd.DataFrame({column: [] for column in manifest["columns"]})
+        if filters:
+            data = filterFrame(data, filters)
+    else:
+        data = pd.read_parquet(
+            "s3://" + s3_bucket_name + "/" + prefix,
+            columns=None if columns is None else [keys.get(column, column) for column in columns],
+            filters=None
+            if filters is None
+            else [(keys.get(column, column), op, value) for column, op, value in filters],
+        ).rename(columns=PARTITION_COLUMNS)
+    return applySchema(data[list(columns) if columns is not None else manifest["columns"]])
+
+
+def readFromS3(site_id, s3_bucket_name, pipeline_type, event_id, columns=None, filters=None):
     """Reads a file from S3
 
+    The data is read from the site's Parquet part files if the extraction wrote
+    them, and from its CSV file otherwise. Either way the CSV index column is
+    not part of the result, and the columns have the types of site_schema. A
+    partitioned dataset is read through its manifest.
+
     Args:
         site_id (str): The identifier of the building/site that this model pertains to.
         s3_bucket_name (str): Name of the S3 bucket the object is in.
         pipeline_type (str): Type of the pipeline (either inference or retrain)
         event_id (str): Unique identifier for the stepfunction event
+        columns (list): optional columns to read. Parquet files are only read for these columns.
+        filters (list): optional (column, operator, value) conditions all rows must meet, e.g.
+            [("pointname", "in", names)]. Parquet row groups that cannot match are skipped.
 
     Returns:
         dataframe: data from s3.
     """
+    prefix = pipeline_type + "/" + event_id + "/" + site_id
+    if hasParquetParts(s3_bucket_name, prefix + "/"):
+        manifest = readPartitionManifest(s3_bucket_name, prefix + "/")
+        if manifest is not None:
+            return readPartitionedDataset(s3_bucket_name, prefix + "/", manifest, columns, filters)
+        return applySchema(
+            pd.read_parquet(
+                "s3://" + s3_bucket_name + "/" + prefix + "/", columns=columns, filters=filters
+            )
+        )
+
+    usecols = lambda column: column != "Unnamed: 0"
+    if columns is not None:
+        usecols = list(dict.fromkeys(list(columns) + [column for column, _, _ in filters or []]))
     data = pd.read_csv(
-        filepath_or_buffer="s3://"
-        + s3_bucket_name
-        + "/"
-        + pipeline_type
-        + "/"
-        + event_id
-        + "/"
-        + site_id
-        + ".csv"
+        filepath_or_buffer="s3://" + s3_bucket_name + "/" + prefix + ".csv",
+        usecols=usecols,
+        dtype=CSV_DTYPES,
+    )
+    if filters:
+        data = filterFrame(data, filters)
+    if columns is not None:
+        data = data[list(columns)]
+    return applySchema(data)
+
+
+def getClaimKey(pipeline_type, event_id, site_id):
+    return "claims/" + pipeline_type + "/" + event_id + "/" + site_id + ".parquet"
+
+
+def writeClaimFile(s3_bucket_name, key, groups):
+    """Writes the data of every point group as one row group of a Parquet file.
+
+    Args:
+        s3_bucket_name (str): Name of the S3 bucket to write to.
+        key (str): key of the file.
+        groups: ((assetname, pointname), dataframe) pairs.
+
+    Returns:
+        list: (assetname, pointname), the index of its row group and its number of rows, for the groups
+        with data.
+    """
+    row_groups = []
+    with S3StreamWriter(aws_s3, s3_bucket_name, key) as stream:
+        writer = ParquetFrameWriter(stream)
+        for point_key, group in groups:
+            if len(group) == 0:
+                continue
+            row_groups.append((point_key, writer.row_groups, len(group)))
+            writer.writeFrame(group[["value", "timestamp"]])
+        if not writer.close():
+            stream.abort()
+    return row_groups
+
+
+def getInlineBytes(key, group):
+    """Upper bound of the size of a point group's data sent inline, as JSON records (see handler)."""
+    # the widest index, value and timestamp a row can have
+    row = {
+        "index": -(2**63),
+        "assetname": key[0],
+        "pointname": key[1],
+        "value": -2.2250738585072014e-308,
+        "timestamp": -(2**63),
+    }
+    return len(group) * (len(json.dumps(row)) + len(", "))
+
+
+def getShards(groups, max_points, max_rows, max_bytes):
+    """Splits point groups into consecutive shards of at most max_points groups, max_rows rows and
+    max_bytes bytes of inline data.
+
+    A group over the limits makes up a shard of its own.
+
+    Args:
+        groups: ((assetname, pointname), group) pairs, where a group is a dataframe sent inline or a
+            claim check reference with its number of rows.
+        max_points (int): most groups per shard.
+        max_rows (int): most rows per shard.
+        max_bytes (int): most bytes of inline data per shard (see getInlineBytes).
+
+    Yields:
+        list: the pairs of every shard.
+    """
+    shard = []
+    rows = 0
+    size = 0
+    for key, group in groups:
+        if isinstance(group, dict):
+            group_rows = group["rows"]
+            group_size = 0
+        else:
+            group_rows = len(group)
+            group_size = getInlineBytes(key, group)
+        if shard and (len(shard) >= max_points or rows + group_rows > max_rows or size + group_size > max_bytes):
+            yield shard
+            shard = []
+            rows = 0
+            size = 0
+        shard.append((key, group))
+        rows += group_rows
+        size += group_size
+    if shard:
+        yield shard
+
+
+def fanOut(function, items, max_in_flight):
+    """Calls function on every item in a thread pool, with at most max_in_flight calls at the same time.
+
+    Items are only taken from the iterable when a call can start, so a generator of large
+    items is not read ahead.
+
+    Yields:
+        tuple: item, result and exception of every call (result None if it raised, exception
+        None if it did not), in the order the calls finish.
+    """
+    items = iter(items)
+    pending = {}
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                pending[executor.submit(function, item)] = item
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                yield item, None if error is not None else future.result(), error
+
+
+@functools.lru_cache(maxsize=None)
+def getLambdaClient(read_timeout):
+    # invocations are retried by invokeInference, so the client does not repeat them itself. read timeouts are
+    # rounded by the caller, so only a few clients are created
+    return boto3.client(
+        "lambda",
+        config=Config(
+            read_timeout=read_timeout,
+            retries={"max_attempts": 0},
+            max_pool_connections=max(10, inference_max_in_flight),
+        ),
+    )
+
+
+def isRetryableInvokeError(err):
+    if isinstance(err, ClientError):
+        return err.response.get("Error", {}).get("Code") in RETRYABLE_INVOKE_ERROR_CODES
+    # read timeouts and connection errors
+    return isinstance(err, BotoCoreError)
+
+
+def invokeInference(payload, deadline=None):
+    """Invokes the inference function, repeating invocations that failed to get through up to
+    inference_retries times with exponential backoff. Returns the parsed response, raises the last error.
+
+    An invocation waits inference_timeout_seconds for the function to return, and never past the
+    deadline (epoch seconds), and is not repeated if that leaves less than MIN_INVOKE_SECONDS. Errors
+    of the function itself are not repeated.
+    """
+    for attempt in range(inference_retries + 1):
+        read_timeout = inference_timeout_seconds
+        if deadline is not None:
+            read_timeout = min(read_timeout, int(deadline - time.time()) // 10 * 10)
+        if read_timeout < MIN_INVOKE_SECONDS:
+            raise TimeoutError("No time left to invoke the inference lambda for " + payload["site_id"])
+        try:
+            response = getLambdaClient(read_timeout).invoke(
+                FunctionName=inference_function_name,
+                Payload=json.dumps(payload),
+            )
+        except (BotoCoreError, ClientError) as err:
+            if attempt == inference_retries or not isRetryableInvokeError(err):
+                raise
+            print("Inference attempt " + str(attempt + 1) + " failed, retrying: " + str(err))
+            time.sleep(min(2**attempt, 30))
+            continue
+        if "FunctionError" in response:
+            raise Exception(
+                "There's an error executing the inference lambda for "
+                + payload["site_id"]
+                + ": "
+                + response["Payload"].read().decode()
+            )
+        return json.loads(response["Payload"].read())
+
+
+def writeResults(site_id, event_id, key, parts, summaries):
+    """Merges the parts the inference functions wrote into the site's results object."""
+    return mergeSiteResults(
+        aws_s3,
+        results_bucket,
+        key,
+        parts,
+        {
+            "site_id": site_id,
+            "event_id": event_id,
+            "rows": sum(summary["rows"] for summary in summaries),
+            "anomalies": sum(summary["anomalies"] for summary in summaries),
+            "points": [
+                {name: value for name, value in summary.items() if name not in ("key", "hourly")}
+                for summary in summaries
+            ],
+        },
     )
-    return data
+
+
+def deleteResultsParts(keys):
+    """Deletes the results parts of a run, 1000 keys per request."""
+    for start in range(0, len(keys), 1000):
+        aws_s3.delete_objects(
+            Bucket=results_bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[start : start + 1000]], "Quiet": True},
+        )
 
 
 def handler(event, context):
     """Lamda function to read inference data and pass it to the
     inference lambda.
+
+    The site's shards are scored by up to inference_max_in_flight
+    invocations at the same time, which end results_margin_seconds before
+    this invocation would time out. The result has the status SUCCEEDED,
+    PARTIAL if some points could not be scored, FAILED if none could, or
+    SKIPPED without new data, and lists the failed invocations and points.
     """
     # Log trigger event and environment
     print(event)
@@ -47,33 +431,148 @@ def handler(event, context):
     site_id = event["Payload"]["site_id"]
     pipeline_type = event["Payload"]["pipeline_type"]
     event_id = event["Payload"]["event_id"]
+    # points with new data in this run (all points in the data if not given)
+    points = event["Payload"].get("points")
+    if points is not None and not points:
+        print("No point has new data, skipped " + str(event["Payload"].get("skippedPoints")))
+        return {"site_id": site_id, "event_id": event_id, "status": "SKIPPED"}
 
-    data_df = readFromS3(site_id, data_bucket, pipeline_type, event_id)
-    asset_groups = data_df.groupby(["assetname", "pointname"])
+    updated = None
+    if points is not None:
+        updated = {(point["assetname"], point["pointname"]) for point in points}
+    columns = ["assetname", "pointname", "value", "timestamp"]
 
-    # Invoke inference Lambda with data
-    for key in asset_groups.groups.keys():
-        try:
-            payload = {
-                "site_id": site_id,
-                "rtu": key[0],
-                "point": key[1],
-                "data": asset_groups.get_group(key)
-                .reset_index()
-                .to_dict(orient="records"),
-                "event_id": event_id,
-                "pipeline_type": pipeline_type,
-            }
-            response = aws_lambda.invoke(
-                FunctionName=site_id + "-inference-lambda",
-                Payload=json.dumps(payload),
-            )
-            print(response)
-            if "FunctionError" in response:
-                raise Exception(
-                    "There's an error executing " + site_id + " inference lambda"
+    prefix = pipeline_type + "/" + event_id + "/" + site_id + "/"
+    manifest = readPartitionManifest(data_bucket, prefix)
+    if manifest is not None:
+        # the fan-out is planned from the manifest, and each invocation's data is read from its own partition
+        partitions = [
+            partition
+            for partition in manifest["partitions"]
+            if partition["rows"] > 0
+            and (updated is None or (partition["assetname"], partition["pointname"]) in updated)
+        ]
+        if claim_check:
+            # in claim check mode the inference function reads the partition itself
+            groups = [
+                (
+                    (partition["assetname"], partition["pointname"]),
+                    {"bucket": data_bucket, "prefix": prefix + partition["path"], "rows": partition["rows"]},
                 )
-        except Exception as err:
-            print(err)
+                for partition in partitions
+            ]
+        else:
+            groups = readPartitions(data_bucket, prefix, partitions, columns)
+    else:
+        filters = None
+        if points is not None:
+            filters = [("pointname", "in", sorted({point["pointname"] for point in points}))]
+        data_df = readFromS3(site_id, data_bucket, pipeline_type, event_id, columns, filters)
+        asset_groups = data_df.groupby(["assetname", "pointname"], observed=True)
+        keys = list(asset_groups.groups.keys())
+        if updated is not None:
+            keys = [key for key in keys if key in updated]
+        groups = ((key, asset_groups.get_group(key)) for key in keys)
+        if claim_check:
+            # other layouts are regrouped into a file with one row group per point, which the inference
+            # function reads with ranged requests
+            claim_key = getClaimKey(pipeline_type, event_id, site_id)
+            groups = [
+                (key, {"bucket": data_bucket, "key": claim_key, "rowGroup": row_group, "rows": rows})
+                for key, row_group, rows in writeClaimFile(data_bucket, claim_key, groups)
+            ]
+
+    # Invoke inference Lambda with data, a shard of the site's point groups at a time
+    results_key = getSiteResultsKey(event_id, site_id) if results_output == "site" else None
+
+    def getPayload(part, shard):
+        batch = []
+        for key, group in shard:
+            point = {"rtu": key[0], "point": key[1]}
+            if claim_check:
+                point["dataRef"] = group
+            else:
+                point["data"] = group.reset_index().to_dict(orient="records")
+            batch.append(point)
+        payload = {
+            "site_id": site_id,
+            "event_id": event_id,
+            "pipeline_type": pipeline_type,
+            "points": batch,
+        }
+        if results_key is not None:
+            payload["resultsKey"] = results_key
+            payload["resultsPartKey"] = getSiteResultsPartKey(event_id, site_id, part)
+        return payload
+
+    # inference calls end in time to merge and record the results before this invocation times out
+    deadline = None
+    if context is not None:
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - results_margin_seconds
+
+    summaries = []
+    # invocations that failed after all retries, and points the inference function could not score
+    failed_invocations = []
+    point_errors = []
+    # key and number of anomalies of every results part written by a successful invocation
+    parts = []
+    part_keys = []
+    invocations = 0
+    for payload, response, error in fanOut(
+        lambda payload: invokeInference(payload, deadline),
+        (
+            getPayload(part, shard)
+            for part, shard in enumerate(
+                getShards(groups, inference_batch_points, inference_batch_rows, inference_batch_bytes)
+            )
+        ),
+        inference_max_in_flight,
+    ):
+        invocations += 1
+        if results_key is not None:
+            part_keys.append(payload["resultsPartKey"])
+        if error is not None:
+            print(error)
+            failed_invocations.append(
+                {"points": [[point["rtu"], point["point"]] for point in payload["points"]], "error": str(error)}
+            )
+            continue
+        scored = [summary for summary in response["points"] if "error" not in summary]
+        for summary in response["points"]:
+            if "error" in summary:
+                print(summary["rtu"] + " " + summary["point"] + ": " + summary["error"])
+                point_errors.append(summary)
+        if scored and results_key is not None:
+            parts.append((payload["resultsPartKey"], sum(summary["anomalies"] for summary in scored)))
+        summaries.extend(scored)
+    summaries.sort(key=lambda summary: (summary["rtu"], summary["point"]))
+
+    try:
+        if summaries:
+            if results_key is not None:
+                # parts in the order of the shards, so the results file does not depend on the order calls finished
+                parts.sort()
+                writeResults(site_id, event_id, results_key, parts, summaries)
+            ResultsReport(aws_s3, results_bucket, site_id).record(event_id, summaries)
+    finally:
+        # the parts are deleted even if the merge failed, as a new run scores the site again. failed
+        # invocations can leave a part behind as well
+        if part_keys:
+            deleteResultsParts(part_keys)
 
-    print("Completed execution")
+    if not failed_invocations and not point_errors:
+        status = "SUCCEEDED"
+    elif summaries:
+        status = "PARTIAL"
+    else:
+        status = "FAILED"
+    print("Completed execution: " + status)
+    return {
+        "site_id": site_id,
+        "event_id": event_id,
+        "status": status,
+        "invocations": invocations,
+        "scoredPoints": len(summaries),
+        "failedInvocations": failed_invocations,
+        "pointErrors": point_errors,
+    }
@@ -0,0 +1,45 @@
+import os
+import json
+import boto3
+from datetime import datetime, timezone
+
+aws_s3 = boto3.client("s3")
+
+# bucket holding the models of all sites
+model_artifact_bucket = os.environ.get("model_artifact_bucket")
+
+
+def getModelKey(site_id):
+    return "models/" + site_id + "/model.csv"
+
+
+def getApprovedModelKey(site_id):
+    return "models/" + site_id + "/approved.json"
+
+
+def handler(event, context):
+    """Lambda function to approve the model a retrain just uploaded for a site.
+
+    The shared inference function uses the version of the site's model file
+    that models/{site_id}/approved.json points to, so approving a model only
+    rewrites that pointer. Inference picks it up within its refresh interval.
+    """
+    # Log trigger event and environment
+    print(event)
+    print(os.environ)
+
+    site_id = event["site_id"]
+    key = getModelKey(site_id)
+    response = aws_s3.head_object(Bucket=model_artifact_bucket, Key=key)
+    approved = {
+        "site_id": site_id,
+        "key": key,
+        "versionId": response.get("VersionId"),
+        "etag": response["ETag"],
+        "approvedAt": datetime.now(timezone.utc).isoformat(),
+    }
+    aws_s3.put_object(
+        Bucket=model_artifact_bucket, Key=getApprovedModelKey(site_id), Body=json.dumps(approved)
+    )
+    print("Approved model " + str(approved["versionId"] or approved["etag"]) + " of " + site_id)
+    return approved
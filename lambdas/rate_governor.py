@@ -0,0 +1,197 @@
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# tolerance for the refilled tokens, which float rounding can leave just short of a whole token
+TOKEN_EPSILON = 1e-6
+MIN_WAIT_SECONDS = 0.01
+
+
+class LocalStateStore:
+    """In-memory stand-in for the shared governor state, for a single process or offline runs."""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            item = self.items.get(name)
+            return dict(item) if item is not None else None
+
+    def put(self, name, item, expected_version):
+        """Stores the item if the stored version is still expected_version (None if absent)."""
+        with self.lock:
+            current = self.items.get(name)
+            if (current["version"] if current is not None else None) != expected_version:
+                return False
+            self.items[name] = dict(item)
+            return True
+
+
+class DynamoDBStateStore:
+    """Governor state shared by all invocations, kept in a DynamoDB table with partition key "name".
+
+    Every write is conditional on the version read before it, so concurrent
+    invocations never overwrite each other's updates.
+    """
+
+    FIELDS = ("rate", "tokens", "updated", "decreasedAt", "version")
+
+    def __init__(self, dynamodb_client, table_name):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+
+    def get(self, name):
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name, Key={"name": {"S": name}}, ConsistentRead=True
+        )
+        if "Item" not in response:
+            return None
+        item = {field: float(response["Item"][field]["N"]) for field in self.FIELDS}
+        item["version"] = int(item["version"])
+        return item
+
+    def put(self, name, item, expected_version):
+        attributes = {field: {"N": repr(item[field])} for field in self.FIELDS}
+        attributes["name"] = {"S": name}
+        if expected_version is None:
+            condition = {
+                "ConditionExpression": "attribute_not_exists(#name)",
+                "ExpressionAttributeNames": {"#name": "name"},
+            }
+        else:
+            condition = {
+                "ConditionExpression": "#version = :expected",
+                "ExpressionAttributeNames": {"#version": "version"},
+                "ExpressionAttributeValues": {":expected": {"N": str(expected_version)}},
+            }
+        try:
+            self.dynamodb_client.put_item(TableName=self.table_name, Item=attributes, **condition)
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+
+class RateGovernor:
+    """Token bucket shared by every caller of an API, with AIMD adaptation of its rate.
+
+    The bucket refills at the shared rate, up to burst tokens. Callers take
+    tokens from it in leases of lease_size, so the shared state is only touched
+    once every few requests. A throttling response cuts the shared rate by
+    decrease_factor (at most once per cooldown seconds, so one congestion event
+    is not counted by every caller that saw it). While no caller is throttled,
+    the rate grows by additive_increase for every rate tokens granted, i.e. about
+    once a second no matter how many callers share the bucket, up to max_rate.
+
+    Args:
+        store: shared state (DynamoDBStateStore, or LocalStateStore as a stand-in).
+        name (str): key of the bucket in the store, e.g. the API name.
+        max_rate (float): upper bound of the rate in requests per second, e.g. the account quota.
+        min_rate (float): lower bound of the rate.
+        burst (float): size of the bucket.
+        lease_size (int): number of tokens taken from the shared bucket at once.
+        additive_increase (float): rate increase per second's worth of granted tokens.
+        decrease_factor (float): rate multiplier on throttling.
+        cooldown (float): minimum seconds between two decreases.
+        clock (callable): returns the current epoch time in seconds.
+        sleep (callable): waits for the given number of seconds.
+    """
+
+    def __init__(
+        self,
+        store,
+        name,
+        max_rate,
+        min_rate=1.0,
+        burst=None,
+        lease_size=5,
+        additive_increase=1.0,
+        decrease_factor=0.5,
+        cooldown=2.0,
+        clock=time.time,
+        sleep=time.sleep,
+    ):
+        self.store = store
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst if burst is not None else max_rate
+        self.lease_size = lease_size
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.reserve = 0
+        self.throttled = False
+        self.lock = threading.Lock()
+
+    def readState(self, now):
+        item = self.store.get(self.name)
+        if item is None:
+            return (
+                {
+                    "rate": self.max_rate,
+                    "tokens": self.burst,
+                    "updated": now,
+                    "decreasedAt": 0.0,
+                    "version": 0,
+                },
+                None,
+            )
+        return item, item["version"]
+
+    def acquire(self):
+        """Blocks until the caller may send one request."""
+        with self.lock:
+            while self.reserve == 0:
+                self.lease()
+            self.reserve -= 1
+
+    def lease(self):
+        while True:
+            now = self.clock()
+            item, version = self.readState(now)
+            tokens = min(self.burst, item["tokens"] + max(0.0, now - item["updated"]) * item["rate"])
+            take = min(self.lease_size, math.floor(tokens + TOKEN_EPSILON))
+            if take < 1:
+                self.sleep(max(MIN_WAIT_SECONDS, (1 - tokens) / item["rate"]))
+                continue
+            rate = item["rate"]
+            if not self.throttled:
+                rate = min(self.max_rate, rate + self.additive_increase * take / rate)
+            updated = dict(
+                item, rate=rate, tokens=tokens - take, updated=now, version=item["version"] + 1
+            )
+            if self.store.put(self.name, updated, version):
+                self.reserve += take
+                self.throttled = False
+                return
+
+    def onThrottle(self):
+        """Reports a throttling response. Cuts the shared rate and drops the tokens held locally."""
+        with self.lock:
+            self.reserve = 0
+        self.throttled = True
+        while True:
+            now = self.clock()
+            item, version = self.readState(now)
+            if now - item["decreasedAt"] < self.cooldown:
+                return
+            rate = max(self.min_rate, item["rate"] * self.decrease_factor)
+            tokens = min(self.burst, item["tokens"] + max(0.0, now - item["updated"]) * item["rate"])
+            updated = dict(
+                item,
+                rate=rate,
+                tokens=min(tokens, rate),
+                updated=now,
+                decreasedAt=now,
+                version=item["version"] + 1,
+            )
+            if self.store.put(self.name, updated, version):
+                logger.warning(f"{self.name} throttled, shared rate lowered to {rate:.1f}/s")
+                return
@@ -0,0 +1,98 @@
+import json
+import numpy as np
+import pandas as pd
+
+AGGREGATIONS = ("mean", "last", "max")
+# aggregation per BRICK point class. a rule applies to the class of the same name and to every class whose name
+# ends in _{rule}, e.g. Temperature_Sensor to Zone_Air_Temperature_Sensor. the longest matching rule wins
+DEFAULT_AGGREGATIONS = {
+    "Sensor": "mean",
+    "Setpoint": "last",
+    "Command": "last",
+    "Status": "last",
+    "Alarm": "max",
+}
+DEFAULT_AGGREGATION = "mean"
+
+
+def parseAggregations(text):
+    """Reads aggregation rules from a JSON object of BRICK class to mean, last or max.
+
+    An empty text gives DEFAULT_AGGREGATIONS. The key "default" sets the
+    aggregation of points that no rule matches.
+    """
+    rules = json.loads(text) if text else dict(DEFAULT_AGGREGATIONS)
+    for point_class, aggregation in rules.items():
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(
+                f"Unsupported aggregation {aggregation} for {point_class}, use one of {', '.join(AGGREGATIONS)}"
+            )
+    return rules
+
+
+def getAggregation(pointname, rules):
+    """The aggregation of a point, by the longest rule its BRICK class ends in."""
+    point_class = pointname.replace("brick:", "")
+    matches = [
+        rule
+        for rule in rules
+        if rule != "default" and (point_class == rule or point_class.endswith("_" + rule))
+    ]
+    if not matches:
+        return rules.get("default", DEFAULT_AGGREGATION)
+    return rules[max(matches, key=len)]
+
+
+def resampleFrame(data, interval_seconds, rules):
+    """Downsamples site data to one row per point and fixed interval.
+
+    Intervals are aligned to multiples of interval_seconds since the epoch, and
+    every row is stamped with the start of its interval. The values of an
+    interval are combined with the aggregation of the point's BRICK class (see
+    getAggregation). Points keep their order, and their rows stay in time order.
+
+    Args:
+        data (dataframe): columns assetname, pointname (categorical), value and timestamp, with the
+            rows of a point in time order.
+        interval_seconds (int): length of the intervals.
+        rules (dict): aggregation rules (see parseAggregations).
+
+    Returns:
+        dataframe: the resampled data, with the same columns and column types.
+    """
+    if len(data) == 0:
+        return data
+    interval = interval_seconds * 1_000_000_000
+    buckets = data["timestamp"].to_numpy() // interval * interval
+    grouped = data["value"].groupby(
+        [data["assetname"], data["pointname"], buckets], observed=True, sort=False
+    )
+    point_categories = data["pointname"].cat.categories
+    point_aggregations = np.array(
+        [getAggregation(pointname, rules) for pointname in point_categories], dtype=object
+    )
+
+    # every aggregation in use is computed over all groups at once, and each group takes the one of its point
+    present = np.unique(data["pointname"].cat.codes.to_numpy())
+    results = {
+        aggregation: getattr(grouped, aggregation)()
+        for aggregation in dict.fromkeys(point_aggregations[present])
+    }
+    index = next(iter(results.values())).index
+    points = pd.Categorical(index.get_level_values(1), categories=point_categories)
+    group_aggregations = point_aggregations[points.codes]
+    values = np.empty(len(index), dtype=np.float64)
+    for aggregation, result in results.items():
+        selected = group_aggregations == aggregation
+        values[selected] = result.to_numpy()[selected]
+
+    return pd.DataFrame(
+        {
+            "assetname": pd.Categorical(
+                index.get_level_values(0), categories=data["assetname"].cat.categories
+            ),
+            "pointname": points,
+            "value": values,
+            "timestamp": index.get_level_values(2).to_numpy(dtype=np.int64),
+        }
+    )
@@ -0,0 +1,265 @@
+import json
+import time
+import random
+import logging
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import BytesIO
+from botocore.exceptions import ClientError
+from s3_stream_writer import S3StreamWriter
+
+logger = logging.getLogger(__name__)
+
+REPORTS_PREFIX = "reports/"
+# schema metadata key of the summary of a site results file
+SUMMARY_METADATA_KEY = b"summary"
+# columns of a site results file. parts are converted to it before they are merged, as their
+# category codes can have different widths
+SITE_RESULTS_SCHEMA = pa.schema(
+    [
+        ("assetname", pa.dictionary(pa.int32(), pa.string())),
+        ("pointname", pa.dictionary(pa.int32(), pa.string())),
+        ("value", pa.float64()),
+        ("timestamp", pa.int64()),
+        ("is_anomaly", pa.int8()),
+    ]
+)
+# numpy datetime units of the rollup periods, and of the files each period's rollups are kept in
+ROLLUP_UNITS = {"hourly": ("h", "D"), "daily": ("D", "M")}
+# times a rollup file is read and written again after another run changed it in between
+ROLLUP_WRITE_ATTEMPTS = 10
+# errors of a conditional write to an object that changed since it was read, or that another request is writing
+CONFLICT_ERRORS = ("PreconditionFailed", "ConditionalRequestConflict")
+
+
+def getPeriodName(timestamp, unit):
+    """Name of the period (e.g. 2022-05-16T13 for hours, 2022-05-16 for days) a nanosecond timestamp falls into."""
+    return str(np.datetime64(int(timestamp), "ns").astype(f"datetime64[{unit}]"))
+
+
+def addCounts(counts, period, rows, anomalies):
+    totals = counts.setdefault(period, {"rows": 0, "anomalies": 0})
+    totals["rows"] += rows
+    totals["anomalies"] += anomalies
+
+
+def getSiteResultsKey(event_id, site_id):
+    return event_id + "/" + site_id + ".parquet"
+
+
+def getSiteResultsPartKey(event_id, site_id, part):
+    """Key of the part of a site's results that one inference invocation writes (see mergeSiteResults)."""
+    return f"{event_id}/{site_id}.parts/{part:05d}.parquet"
+
+
+def writeSiteResults(s3_client, bucket, key, results, summary):
+    """Writes the results of every point of a site and run as one Parquet object, built in memory.
+
+    The anomalies come first, in their own row group, followed by the rows that
+    are not anomalies, so the whole file holds every point and the first
+    summary["anomalyRowGroups"] row groups are the anomalies only view. The
+    summary is stored in the file's schema metadata, and can be read from the
+    footer without reading any rows.
+
+    Args:
+        s3_client: boto3 s3 client (or a stand-in with the same methods).
+        bucket (str): inference results bucket.
+        key (str): key of the object, see getSiteResultsKey.
+        results (dataframe): columns assetname, pointname, value, timestamp and is_anomaly.
+        summary (dict): summary of the results, stored with them.
+
+    Returns:
+        dict: the summary, with anomalyRowGroups.
+    """
+    results = results.astype({"assetname": "category", "pointname": "category", "is_anomaly": np.int8})
+    results = results.sort_values(["assetname", "pointname", "timestamp"], kind="stable")
+    is_anomaly = results["is_anomaly"].to_numpy() == 1
+    parts = [part for part in (results[is_anomaly], results[~is_anomaly]) if len(part) > 0]
+    summary = {**summary, "anomalyRowGroups": int(is_anomaly.any())}
+
+    schema = pa.Schema.from_pandas(results, preserve_index=False).with_metadata(
+        {SUMMARY_METADATA_KEY: json.dumps(summary)}
+    )
+    body = pa.BufferOutputStream()
+    with pq.ParquetWriter(body, schema, compression="zstd") as writer:
+        for part in parts:
+            writer.write_table(
+                pa.Table.from_pandas(part, schema=schema, preserve_index=False), row_group_size=len(part)
+            )
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body.getvalue().to_pybytes())
+    return summary
+
+
+def readPart(s3_client, bucket, key):
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    file = pq.ParquetFile(BytesIO(response["Body"].read()))
+    return file, json.loads(file.schema_arrow.metadata[SUMMARY_METADATA_KEY])["anomalyRowGroups"]
+
+
+def mergeSiteResults(s3_client, bucket, key, parts, summary):
+    """Merges parts with the layout of a site results file into the site's results file.
+
+    The parts are the results of the shards of a site, each written by its own
+    inference invocation. The anomaly row groups of every part come first, in
+    the order of parts, followed by the other row groups of every part, so the
+    merged file has the layout of writeSiteResults, with one anomaly row group
+    per part that has anomalies. The file is streamed to S3 while the parts are
+    read, and only one part is held in memory at a time.
+
+    Args:
+        s3_client: boto3 s3 client (or a stand-in with the same methods).
+        bucket (str): inference results bucket, which holds the parts.
+        key (str): key of the object, see getSiteResultsKey.
+        parts (list): (key, anomalies) of every part, with its number of anomalies.
+        summary (dict): summary of the results, stored with them.
+
+    Returns:
+        dict: the summary, with anomalyRowGroups.
+    """
+    summary = {**summary, "anomalyRowGroups": sum(1 for _, anomalies in parts if anomalies > 0)}
+    schema = SITE_RESULTS_SCHEMA.with_metadata({SUMMARY_METADATA_KEY: json.dumps(summary)})
+    with S3StreamWriter(s3_client, bucket, key) as stream:
+        with pq.ParquetWriter(stream, schema, compression="zstd") as writer:
+            for anomalies_only in (True, False):
+                for part_key, anomalies in parts:
+                    if anomalies_only and anomalies == 0:
+                        continue
+                    file, anomaly_row_groups = readPart(s3_client, bucket, part_key)
+                    if anomalies_only:
+                        row_groups = range(anomaly_row_groups)
+                    else:
+                        row_groups = range(anomaly_row_groups, file.num_row_groups)
+                    for row_group in row_groups:
+                        table = file.read_row_group(row_group).replace_schema_metadata(None)
+                        writer.write_table(table.cast(SITE_RESULTS_SCHEMA), row_group_size=table.num_rows)
+    return summary
+
+
+def readSiteResults(s3_client, bucket, key, anomalies_only=False):
+    """Reads a site results file (see writeSiteResults).
+
+    Returns:
+        tuple: the summary, and the results (only the anomalies with anomalies_only).
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    file = pq.ParquetFile(BytesIO(response["Body"].read()))
+    summary = json.loads(file.schema_arrow.metadata[SUMMARY_METADATA_KEY])
+    if anomalies_only:
+        table = file.read_row_groups(range(summary["anomalyRowGroups"]))
+    else:
+        table = file.read()
+    return summary, table.to_pandas()
+
+
+class ResultsReport:
+    """Manifest and anomaly rollups of a site's inference results, so they can be
+    queried without listing and reading every result file.
+
+    The manifest is append-only: every run adds one JSON Lines object under
+    reports/{site_id}/manifest/{date}/{event_id}.jsonl, dated by the start of
+    its results, with one line per result file (key, rtu, point, rows, anomalies
+    and the time range of its values). Objects are never rewritten, so the runs
+    of the last days are found by listing a few date prefixes.
+
+    Rollups count the values and anomalies per RTU and period:
+    reports/{site_id}/hourly/{day}.json holds the hours of a day, and
+    reports/{site_id}/daily/{month}.json the days of a month. A run only
+    rewrites the rollup files of the periods its results fall into, and every
+    file lists the runs it counts, so a retried run is not counted twice. A
+    rollup file is only written if it did not change since it was read, and is
+    read again otherwise, so runs that overlap never lose each other's counts.
+
+    Args:
+        s3_client: boto3 s3 client (or a stand-in with the same methods).
+        bucket (str): inference results bucket.
+        site_id (str): site the report belongs to.
+    """
+
+    def __init__(self, s3_client, bucket, site_id):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.site_id = site_id
+        self.prefix = REPORTS_PREFIX + site_id + "/"
+
+    def getManifestKey(self, date, event_id):
+        return f"{self.prefix}manifest/{date}/{event_id}.jsonl"
+
+    def getRollupKey(self, rollup, period):
+        return f"{self.prefix}{rollup}/{period}.json"
+
+    def readRollup(self, key):
+        """Reads a rollup file. Returns its counts and ETag, which is None if the file does not exist yet."""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return {"site_id": self.site_id, "events": [], "total": {}, "rtus": {}}, None
+        return json.loads(response["Body"].read()), response["ETag"]
+
+    def writeRollup(self, key, counts, etag):
+        """Writes a rollup file if it is still the version read with etag. Returns False if it is not."""
+        condition = {"IfNoneMatch": "*"} if etag is None else {"IfMatch": etag}
+        try:
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=json.dumps(counts), **condition)
+        except ClientError as err:
+            if err.response["Error"]["Code"] in CONFLICT_ERRORS:
+                return False
+            raise
+        return True
+
+    def writeManifest(self, event_id, summaries):
+        starts = [summary["startTime"] for summary in summaries if summary["startTime"] is not None]
+        date = getPeriodName(min(starts), "D") if starts else "undated"
+        key = self.getManifestKey(date, event_id)
+        lines = [
+            json.dumps({"event_id": event_id, **{k: v for k, v in summary.items() if k != "hourly"}})
+            for summary in summaries
+        ]
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body="\n".join(lines) + "\n")
+        return key
+
+    def updateRollups(self, event_id, summaries):
+        for rollup, (unit, file_unit) in ROLLUP_UNITS.items():
+            # counts of the run, by rollup file, rtu and period
+            files = {}
+            for summary in summaries:
+                for hour, rows, anomalies in summary["hourly"]:
+                    rtus = files.setdefault(getPeriodName(hour, file_unit), {})
+                    addCounts(rtus.setdefault(summary["rtu"], {}), getPeriodName(hour, unit), rows, anomalies)
+
+            for file_period, rtus in files.items():
+                key = self.getRollupKey(rollup, file_period)
+                for attempt in range(ROLLUP_WRITE_ATTEMPTS):
+                    counts, etag = self.readRollup(key)
+                    if event_id in counts["events"]:
+                        logger.info(f"{key} already counts event {event_id}")
+                        break
+                    counts["events"].append(event_id)
+                    for rtu, periods in rtus.items():
+                        for period, totals in periods.items():
+                            addCounts(counts["rtus"].setdefault(rtu, {}), period, **totals)
+                            addCounts(counts["total"], period, **totals)
+                    if self.writeRollup(key, counts, etag):
+                        break
+                    logger.info(f"{key} changed while it was updated, attempt {attempt + 1}")
+                    time.sleep(random.uniform(0, 0.05 * 2**attempt))
+                else:
+                    raise RuntimeError(f"{key} kept changing, {ROLLUP_WRITE_ATTEMPTS} updates failed")
+
+    def record(self, event_id, summaries):
+        """Adds the results of a run to the manifest and the rollups.
+
+        Args:
+            event_id (str): the run.
+            summaries (list): summary of every result file of the run, as returned by the
+                inference function: key, rtu, point, rows, anomalies, startTime and endTime
+                (nanoseconds, None without values), and hourly, a list of (hour, rows,
+                anomalies) for every hour with values.
+
+        Returns:
+            str: key of the run's manifest object.
+        """
+        key = self.writeManifest(event_id, summaries)
+        self.updateRollups(event_id, summaries)
+        logger.info(f"Recorded {len(summaries)} results of {event_id} in {key}")
+        return key
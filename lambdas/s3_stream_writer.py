@@ -0,0 +1,309 @@
+import json
+import logging
+import numpy as np
+import pyarrow as pa
+from urllib.parse import quote
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+# every part of a multipart upload except the last must be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+
+class S3StreamWriter:
+    """Writes an S3 object in fixed-size parts while it is being produced.
+
+    Bytes are buffered until a full part is available, which is then sent with
+    UploadPart, so at most one part is held in memory regardless of the size of
+    the object. Objects smaller than one part are written with a single PutObject.
+    Used as a context manager, the upload is completed on success and aborted if
+    an exception is raised, so no partial object becomes visible.
+
+    An upload can be suspended and continued by a later process: suspend()
+    returns the state of the multipart upload and the bytes not uploaded yet,
+    which are passed back as state and buffer.
+
+    Args:
+        s3_client: boto3 s3 client (or a stand-in with the same methods).
+        bucket (str): destination bucket.
+        key (str): destination key.
+        part_size (int): size of the uploaded parts in bytes.
+        state (dict): optional state of a suspended upload (see suspend).
+        buffer (bytes): bytes of a suspended upload that were not uploaded yet.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=DEFAULT_PART_SIZE, state=None, buffer=b""):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.buffer = bytearray(buffer)
+        self.upload_id = state["uploadId"] if state is not None else None
+        self.parts = list(state["parts"]) if state is not None else []
+        self.suspended = False
+        # file-like objects report whether they were closed, which pyarrow checks before writing
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self.uploadPart(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+
+    def uploadPart(self, body):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = response["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self.uploadPart(bytes(self.buffer))
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        logger.info(f"Wrote s3://{self.bucket}/{self.key} in {max(len(self.parts), 1)} parts")
+        self.buffer = bytearray()
+        self.closed = True
+
+    def suspend(self):
+        """Leaves the upload open for a later process.
+
+        Returns:
+            tuple: the state of the upload (JSON-serializable) and the bytes not uploaded yet.
+        """
+        self.suspended = True
+        return {"uploadId": self.upload_id, "parts": self.parts}, bytes(self.buffer)
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+        self.buffer = bytearray()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.suspended or self.closed:
+            return
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CsvFrameWriter:
+    """Renders a sequence of DataFrames as one CSV document on a byte stream.
+
+    The output is the same as DataFrame.to_csv of the concatenated frames: one
+    header line, followed by the rows with a running index as the first column.
+
+    Args:
+        stream: object with a write(bytes) method, e.g. an S3StreamWriter.
+        rows (int): number of rows already written, when continuing a suspended document.
+        header_written (bool): whether the header was already written.
+    """
+
+    def __init__(self, stream, rows=0, header_written=False):
+        self.stream = stream
+        self.rows = rows
+        self.header_written = header_written
+
+    def writeFrame(self, data_frame):
+        data_frame = data_frame.set_axis(range(self.rows, self.rows + len(data_frame)))
+        self.stream.write(data_frame.to_csv(header=not self.header_written).encode("utf-8"))
+        self.header_written = True
+        self.rows += len(data_frame)
+
+
+class ParquetFrameWriter:
+    """Renders a sequence of DataFrames as one Parquet file on a byte stream.
+
+    Every frame becomes a row group, so readers can skip row groups using their
+    column statistics. The index is not written, and column types (categorical
+    asset and point names, float values, int64 timestamps) are kept. The file is
+    only complete once close() has written its footer.
+
+    Args:
+        stream: object with a write(bytes) method, e.g. an S3StreamWriter.
+        compression (str): Parquet compression codec.
+    """
+
+    def __init__(self, stream, compression="zstd"):
+        self.stream = stream
+        self.compression = compression
+        self.writer = None
+        self.rows = 0
+        self.row_groups = 0
+
+    def writeFrame(self, data_frame):
+        """Writes the frame as the next row group, whose index is row_groups before the call."""
+        table = pa.Table.from_pandas(data_frame, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.stream, table.schema, compression=self.compression)
+        self.writer.write_table(table, row_group_size=max(1, len(data_frame)))
+        self.rows += len(data_frame)
+        self.row_groups += 1
+
+    def close(self):
+        """Writes the footer. Returns False if no frame was written, in which case nothing was."""
+        if self.writer is None:
+            return False
+        self.writer.close()
+        return True
+
+
+class PartitionedParquetWriter:
+    """Writes a sequence of DataFrames as Parquet files partitioned by asset and point.
+
+    The rows of each (assetname, pointname) pair go to files under
+    {prefix}asset={assetname}/point={pointname}/ (percent-encoded), which
+    readers can read on their own or as a hive-partitioned dataset. The two
+    columns are implied by the path and not stored in the files. Rows come in
+    runs per property, so only the file of the current partition is open at a
+    time; a partition that comes back later, e.g. in the next invocation of a
+    suspended extraction, gets another file.
+
+    Every partition's row count, time range and number of files are kept in
+    partitions, and written by writeManifest to {prefix}_manifest.json, which
+    dataset readers ignore.
+
+    Args:
+        s3_client: boto3 s3 client (or a stand-in with the same methods).
+        bucket (str): destination bucket.
+        prefix (str): prefix of the dataset, ending in "/".
+        part_size (int): size of the uploaded parts in bytes.
+        files (int): number of files written before, when continuing a suspended dataset.
+        partitions (list): partitions written before.
+        columns (list): columns of the dataset, recorded in the manifest.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket,
+        prefix,
+        part_size=DEFAULT_PART_SIZE,
+        files=0,
+        partitions=None,
+        columns=None,
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        self.files = files
+        self.partitions = list(partitions or [])
+        self.columns = columns
+        self.index = {(item["assetname"], item["pointname"]): item for item in self.partitions}
+        self.current = None
+        self.stream = None
+        self.writer = None
+
+    def openFile(self, key):
+        partition = self.index.get(key)
+        if partition is None:
+            partition = {
+                "assetname": key[0],
+                "pointname": key[1],
+                "path": f"asset={quote(key[0], safe='')}/point={quote(key[1], safe='')}/",
+                "rows": 0,
+                "minTimestamp": None,
+                "maxTimestamp": None,
+                "files": 0,
+            }
+            self.index[key] = partition
+            self.partitions.append(partition)
+        self.stream = S3StreamWriter(
+            self.s3_client,
+            self.bucket,
+            f"{self.prefix}{partition['path']}part-{self.files:05d}.parquet",
+            part_size=self.part_size,
+        )
+        self.writer = ParquetFrameWriter(self.stream)
+        self.current = partition
+        self.files += 1
+        partition["files"] += 1
+
+    def closeFile(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.stream.close()
+        self.current = self.stream = self.writer = None
+
+    def writeFrame(self, data_frame):
+        if self.columns is None:
+            self.columns = list(data_frame.columns)
+        if len(data_frame) == 0:
+            return
+        assets = data_frame["assetname"].to_numpy()
+        points = data_frame["pointname"].to_numpy()
+        # positions where a new run of rows of one property begins
+        starts = np.flatnonzero((assets[1:] != assets[:-1]) | (points[1:] != points[:-1])) + 1
+        bounds = [0] + starts.tolist() + [len(data_frame)]
+        values = data_frame.drop(columns=["assetname", "pointname"])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            key = (str(assets[start]), str(points[start]))
+            if self.current is None or (self.current["assetname"], self.current["pointname"]) != key:
+                self.closeFile()
+                self.openFile(key)
+            run = values.iloc[start:end]
+            self.writer.writeFrame(run)
+            min_timestamp = int(run["timestamp"].min())
+            max_timestamp = int(run["timestamp"].max())
+            partition = self.current
+            partition["rows"] += end - start
+            if partition["minTimestamp"] is None or min_timestamp < partition["minTimestamp"]:
+                partition["minTimestamp"] = min_timestamp
+            if partition["maxTimestamp"] is None or max_timestamp > partition["maxTimestamp"]:
+                partition["maxTimestamp"] = max_timestamp
+
+    def close(self):
+        """Completes the file of the current partition. Returns whether any file was written."""
+        self.closeFile()
+        return self.files > 0
+
+    def abort(self):
+        if self.stream is not None:
+            self.stream.abort()
+        self.current = self.stream = self.writer = None
+
+    def writeManifest(self):
+        manifest = {
+            "layout": "asset/point",
+            "columns": self.columns,
+            "rows": sum(partition["rows"] for partition in self.partitions),
+            "partitions": self.partitions,
+        }
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.prefix + "_manifest.json", Body=json.dumps(manifest)
+        )
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.closeFile()
+        else:
+            self.abort()
@@ -8,19 +8,88 @@ import numpy as np
 import logging
 from SPARQLWrapper import SPARQLWrapper2
 import datetime
-from io import StringIO
+from io import BytesIO
+from botocore.config import Config
+from sitewise_history import (
+    fetchHistory,
+    fetchAggregates,
+    fetchLatestTimestamps,
+    selectUpdatedProperties,
+)
+from s3_stream_writer import (
+    S3StreamWriter,
+    CsvFrameWriter,
+    ParquetFrameWriter,
+    PartitionedParquetWriter,
+)
+from rate_governor import RateGovernor, DynamoDBStateStore
+from history_store import HistoryStore, alignIntervals, getPointCoverage, intersectIntervals, subtractIntervals
+from site_schema import validateSchema
+from resampling import parseAggregations, resampleFrame
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 aws_s3 = boto3.client("s3")
-sitewise_client = boto3.client("iotsitewise")
+
+# number of concurrent SiteWise request chains per site
+sitewise_fetch_workers = int(os.environ.get("sitewise_fetch_workers", "8"))
+# the client is shared by all fetch workers, so its connection pool must fit them
+sitewise_client = boto3.client(
+    "iotsitewise", config=Config(max_pool_connections=max(10, sitewise_fetch_workers))
+)
 
 neptune_cluster_writer_endpoint = os.environ.get("neptune_cluster_writer_endpoint")
 sparql = SPARQLWrapper2("https://" + neptune_cluster_writer_endpoint + ":8182/sparql")
 
 data_bucket = os.environ.get("data_bucket")
 
+# end of the query window, in epoch seconds or "now". can be overridden per run with the event's end_time
+query_end_time = os.environ.get("query_end_time", "now")
+# length of the aligned time slices that long windows are split into. 0 disables slicing
+history_slice_seconds = int(os.environ.get("history_slice_seconds", "86400"))
+# incremental extraction only fetches values newer than the per-property watermarks of earlier runs
+incremental_extraction = os.environ.get("incremental_extraction", "false").lower() == "true"
+# "aggregates" makes the retrain pipeline read count/average/standard deviation per aggregate_resolution
+# interval instead of every raw value. training combines them into the exact overall mean and std
+retrain_extraction_mode = os.environ.get("retrain_extraction_mode", "raw")
+aggregate_resolution = os.environ.get("aggregate_resolution", "1h")
+# points whose latest value is older than the query window are skipped before any history query
+skip_unchanged_points = os.environ.get("skip_unchanged_points", "true").lower() == "true"
+# seconds left to an invocation when the extraction is suspended and checkpointed, to continue in the next one
+checkpoint_margin_seconds = int(os.environ.get("checkpoint_margin_seconds", "120"))
+# format the site data is written in. "csv" writes one object, "parquet" writes typed, compressed part files
+# (one per invocation) under the site's prefix, which consumers can read with column projection and filters.
+# "partitioned" writes the Parquet files to asset=.../point=... partitions with a _manifest.json listing them
+data_format = os.environ.get("data_format", "csv")
+# size of the multipart upload parts the site data is streamed to S3 in
+s3_part_size = int(os.environ.get("s3_part_size", str(8 * 1024 * 1024)))
+# DynamoDB table holding the request rate shared by all concurrent site extractions. empty disables the governor
+rate_governor_table = os.environ.get("rate_governor_table", "")
+# upper bound of the shared request rate per SiteWise API, in requests per second (the account quota)
+sitewise_max_request_rate = float(os.environ.get("sitewise_max_request_rate", "10"))
+
+# raw retrain extractions read what the history store compacted from inference extracts covers, and only query
+# SiteWise for the gaps (see compaction_lambda)
+history_store = os.environ.get("history_store", "false").lower() == "true"
+# raw values are downsampled to one value per point and interval of this many seconds before they are written.
+# 0 keeps every value. the interval has to divide history_slice_seconds, and should divide an hour so the
+# inference windows line up with it
+resample_interval_seconds = int(os.environ.get("resample_interval_seconds", "0"))
+# JSON object of BRICK point class to the aggregation of its intervals (mean, last or max), see resampling.py
+resample_aggregations = parseAggregations(os.environ.get("resample_aggregations", ""))
+
+rate_governor_store = (
+    DynamoDBStateStore(boto3.client("dynamodb"), rate_governor_table) if rate_governor_table else None
+)
+
+
+def getRateGovernor(operation):
+    # every SiteWise API has its own quota, so each gets its own shared bucket named after it
+    if rate_governor_store is None:
+        return None
+    return RateGovernor(rate_governor_store, operation, sitewise_max_request_rate)
+
 
 def getRTUsandPointForAs(site_id):
     # this query returns all RTUs (and their SiteWise ID) for the specified site,
@@ -70,112 +139,318 @@ def getRTUsandPointForAs(site_id):
     return results
 
 
-def getTimeInterval(pipeline_type):
+def getTimeInterval(pipeline_type, end_time=None):
+    ## Function Inputs:
+    #  pipeline_type - either inference or retrain
+    #  end_time - epoch seconds, or "now", of the end of the window. defaults to the query_end_time environment variable
+
     # Adjust timeframe as needed
-    end_time = datetime.datetime.fromtimestamp(1652732267)
+    if end_time is None:
+        end_time = query_end_time
+    if str(end_time) == "now":
+        end_time = datetime.datetime.now()
+    else:
+        end_time = datetime.datetime.fromtimestamp(int(end_time))
+    # resampled windows end on an interval boundary, so no interval is split between two runs
+    if resample_interval_seconds > 0:
+        end_time = datetime.datetime.fromtimestamp(
+            int(end_time.timestamp()) // resample_interval_seconds * resample_interval_seconds
+        )
     if pipeline_type == "inference":
         start_time = int((end_time + datetime.timedelta(hours=-1)).timestamp())
     if pipeline_type == "retrain":
         start_time = int((end_time + datetime.timedelta(days=-90)).timestamp())
+    # the query range is exclusive at its start and inclusive at its end, in whole seconds, so the values in
+    # the boundary second would land in the last interval of one run and the first of the next. one second
+    # earlier on both ends, a run reads exactly the intervals from its aligned start to its aligned end
+    if resample_interval_seconds > 0:
+        end_time = end_time + datetime.timedelta(seconds=-1)
+        start_time = start_time - 1
     return end_time, start_time
 
 
-def getHistoricalDatawithinTimeInterval(assetProperties, start_time, end_time):
+def getPointsWithNewData(assetProperties, start_time, watermarks=None):
+    ## Function Inputs:
+    #  assetProperties - list of dict objects with keys: assetName, assetSiteWiseId, pointName, pointSiteWiseId
+    #  start_time - the exclusive start of the range, expressed in seconds in Unix epoch time
+    #  watermarks - optional dict of pointSiteWiseId to the nanosecond timestamp of the newest value already ingested
+
+    # returns the properties that may have values in the range, and the ones that were skipped. the latest value
+    # of every property is read with batched BatchGetAssetPropertyValue calls (see sitewise_history.fetchLatestTimestamps)
+    latest = fetchLatestTimestamps(
+        sitewise_client, assetProperties, getRateGovernor("BatchGetAssetPropertyValue")
+    )
+    return selectUpdatedProperties(assetProperties, latest, start_time, watermarks)
+
+
+def getHistoricalDatawithinTimeInterval(
+    assetProperties,
+    start_time,
+    end_time,
+    watermarks=None,
+    sink=None,
+    checkpoint=None,
+    should_stop=None,
+    ranges=None,
+    failures=None,
+):
     ## Function Inputs:
     #  assetProperties - list of dict objects with keys: assetName, assetSiteWiseId, pointName, pointSiteWiseId
     #  start_time - timestamp value (datetime.datetime type) the exclusive start of the range from which to query historical data, expressed in seconds in Unix epoch time
     #  end_time - timestamp value (datetime.datetime type) the inclusive end of the range from which to query historical data, expressed in seconds in Unix epoch time
     #  end_time must always occur before start_time
+    #  watermarks - optional dict of pointSiteWiseId to the nanosecond timestamp of the newest value already ingested. updated in place
+    #  sink - optional function that receives the data as a sequence of dataframes while it is fetched
+    #  checkpoint - optional checkpoint of a suspended fetch to continue
+    #  should_stop - optional function that returns True once the fetch has to be suspended
+    #  ranges - optional half-open nanosecond ranges to read instead of the whole range, e.g. the gaps of the history store
+    #  failures - optional list that receives the entries that could not be read
+
+    # returns a dataframe (or passes a sequence of dataframes to sink) with columns assetname, pointname, value, timestamp,
+    # or a checkpoint if the fetch was suspended. the range is split into
+    # history_slice_seconds long slices that are fetched by sitewise_fetch_workers concurrent request chains
+    # (see sitewise_history.fetchHistory). requests are paced by the governor shared with the other sites
+    return fetchHistory(
+        sitewise_client,
+        assetProperties,
+        start_time,
+        end_time,
+        workers=sitewise_fetch_workers,
+        slice_seconds=history_slice_seconds,
+        watermarks=watermarks,
+        sink=sink,
+        governor=getRateGovernor("BatchGetAssetPropertyValueHistory"),
+        checkpoint=checkpoint,
+        should_stop=should_stop,
+        ranges=ranges,
+        failures=failures,
+    )
 
-    # defining query_results list
-    query_results = []
-
-    for i in assetProperties:
-        ap = {
-            "entryId": i["assetName"] + "_-_" + i["pointName"].replace("brick:", ""),
-            "assetId": i["assetSiteWiseId"],
-            "propertyId": i["pointSiteWiseId"],
-            "startDate": start_time,
-            "endDate": end_time,
-            "timeOrdering": "ASCENDING",
-        }
-        response = sitewise_client.batch_get_asset_property_value_history(entries=[ap])
 
-        # the response is paginated. the below logic helps the function work with the paginated response
-        if "nextToken" in response:
-            nt = response["nextToken"]
-        else:
-            nt = None
+def getAggregatesWithinTimeInterval(
+    assetProperties, start_time, end_time, sink=None, checkpoint=None, should_stop=None
+):
+    ## Function Inputs:
+    #  assetProperties - list of dict objects with keys: assetName, assetSiteWiseId, pointName, pointSiteWiseId
+    #  start_time - the exclusive start of the range, expressed in seconds in Unix epoch time
+    #  end_time - timestamp value (datetime.datetime type) the inclusive end of the range
+    #  sink - optional function that receives the data as a sequence of dataframes while it is fetched
+    #  checkpoint, should_stop - see getHistoricalDatawithinTimeInterval
+
+    # returns a dataframe (or passes a sequence of dataframes to sink) with columns assetname, pointname,
+    # count, mean, std, timestamp, with one row per aggregate_resolution interval, or a checkpoint. a 90 day window at hourly
+    # resolution fits on a single page per property, so the window is not split into time slices
+    return fetchAggregates(
+        sitewise_client,
+        assetProperties,
+        start_time,
+        end_time,
+        aggregate_resolution,
+        workers=sitewise_fetch_workers,
+        sink=sink,
+        governor=getRateGovernor("BatchGetAssetPropertyAggregates"),
+        checkpoint=checkpoint,
+        should_stop=should_stop,
+    )
 
-        for entry in response["successEntries"]:
-            assetname = entry["entryId"].split("_-_")[0]
-            pointname = entry["entryId"].split("_-_")[1]
-            for item in entry["assetPropertyValueHistory"]:
-                for key in item["value"]:
-                    datatype = key
 
-                value = item["value"][datatype]
+def getWatermarkManifestKey(pipeline_type, site_id):
+    return "watermarks/" + pipeline_type + "/" + site_id + ".json"
 
-                timestamp = int(
-                    str(item["timestamp"]["timeInSeconds"])
-                    + str(item["timestamp"]["offsetInNanos"])
-                )
-                result = {
-                    "assetname": assetname,
-                    "pointname": pointname,
-                    "value": value,
-                    "timestamp": timestamp,
-                }
-                query_results.append(result)
 
-        while nt is not None:
-            response = sitewise_client.batch_get_asset_property_value_history(
-                entries=[ap], nextToken=nt
-            )
-            for entry in response["successEntries"]:
-                assetname = entry["entryId"].split("_-_")[0]
-                pointname = entry["entryId"].split("_-_")[1]
-                for item in entry["assetPropertyValueHistory"]:
-                    for key in item["value"]:
-                        datatype = key
-
-                    value = item["value"][datatype]
-
-                    timestamp = int(
-                        str(item["timestamp"]["timeInSeconds"])
-                        + str(item["timestamp"]["offsetInNanos"])
-                    )
-                    result = {
-                        "assetname": assetname,
-                        "pointname": pointname,
-                        "value": value,
-                        "timestamp": timestamp,
-                    }
-                    query_results.append(result)
+def readWatermarkManifest(s3_bucket_name, pipeline_type, site_id):
+    # the manifest holds the watermark of every property of the site, and the increments written so far
+    # that still overlap the pipeline's time window
+    try:
+        response = aws_s3.get_object(
+            Bucket=s3_bucket_name, Key=getWatermarkManifestKey(pipeline_type, site_id)
+        )
+    except aws_s3.exceptions.NoSuchKey:
+        return {"watermarks": {}, "increments": []}
+    return json.loads(response["Body"].read())
 
-            if "nextToken" in response:
-                nt = response["nextToken"]
-            else:
-                nt = None
-    return query_results
-
-
-def s3Writer(event_id, data_frame, s3_bucket_name, pipeline_type, site_id):
-    path = (
-        # "s3://"
-        # + s3_bucket_name
-        # + "/"
-        pipeline_type
-        + "/"
-        + event_id
-        + "/"
-        + site_id
-        + ".csv"
+
+def writeWatermarkManifest(manifest, s3_bucket_name, pipeline_type, site_id):
+    aws_s3.put_object(
+        Bucket=s3_bucket_name,
+        Key=getWatermarkManifestKey(pipeline_type, site_id),
+        Body=json.dumps(manifest),
+    )
+
+
+def addToSummary(summary, data_frame):
+    # keeps row count and time range of the data written so far
+    if len(data_frame) == 0:
+        return
+    min_timestamp = int(data_frame["timestamp"].min())
+    max_timestamp = int(data_frame["timestamp"].max())
+    summary["rows"] += len(data_frame)
+    if summary["minTimestamp"] is None or min_timestamp < summary["minTimestamp"]:
+        summary["minTimestamp"] = min_timestamp
+    if summary["maxTimestamp"] is None or max_timestamp > summary["maxTimestamp"]:
+        summary["maxTimestamp"] = max_timestamp
+
+
+def addIncrement(manifest, event_id, summary, key, start_time):
+    ## Function Inputs:
+    #  manifest - watermark manifest of the site (see readWatermarkManifest)
+    #  event_id - unique identifier of the run that wrote the increment
+    #  summary - row count and time range of the increment (see addToSummary)
+    #  key - S3 key the increment was written to
+    #  start_time - epoch seconds of the start of the pipeline's time window
+
+    # increments that ended before the window are no longer needed by consumers
+    window_start = start_time * 1_000_000_000
+    increments = [
+        increment
+        for increment in manifest["increments"]
+        if increment["maxTimestamp"] is not None and increment["maxTimestamp"] >= window_start
+    ]
+    increments.append({"event_id": event_id, "key": key, **summary})
+    manifest["increments"] = increments
+    manifest["windowStart"] = window_start
+
+
+def getQueryWindow(start_time, end_time):
+    # the values the query range in seconds reads, as half-open nanosecond range, the form the history store keeps
+    # its coverage in. the start second is excluded and the end second included with all of its values
+    return [(start_time + 1) * 1_000_000_000, (int(end_time.timestamp()) + 1) * 1_000_000_000]
+
+
+def getHistoryPlan(site_id, points, window):
+    ## Function Inputs:
+    #  site_id - the site whose history store is read
+    #  points - dict objects with keys assetname, pointname
+    #  window - the query window as half-open nanosecond range (see getQueryWindow)
+
+    # returns the granularity of the store, the intervals of the window the store covers and the gaps to read from
+    # SiteWise, one list each per point, and the index of the next point to copy. a point the store has no
+    # coverage of, e.g. one added to the site after the store was compacted, is read over the whole window
+    coverage = HistoryStore(aws_s3, data_bucket, site_id).readCoverage()
+    history = {"granularity": coverage["granularity"], "covered": [], "gaps": [], "index": 0}
+    for point in points:
+        intervals = getPointCoverage(coverage, point["assetname"], point["pointname"])
+        # the boundaries between stored and fetched values must not split a resampling interval
+        if resample_interval_seconds > 0:
+            intervals = alignIntervals(intervals, resample_interval_seconds * 1_000_000_000)
+        history["covered"].append(intersectIntervals(intervals, *window))
+        history["gaps"].append(subtractIntervals(intervals, *window))
+    covered = sum(end - start for intervals in history["covered"] for start, end in intervals)
+    logger.info(
+        f'History store covers {covered / max(1, len(points) * (window[1] - window[0])):.1%} of the window '
+        f'of {len(points)} points, {sum(map(len, history["gaps"]))} gaps are read from SiteWise'
+    )
+    return history
+
+
+def copyFromHistory(site_id, history, points, sink, should_stop=None):
+    ## Function Inputs:
+    #  site_id - the site whose history store is read
+    #  history - granularity of the store, the covered intervals of every point and the index of the next point
+    #  to copy (see getHistoryPlan). updated in place
+    #  points - dict objects with keys assetname, pointname
+    #  sink - function that receives the data of every point as a dataframe
+    #  should_stop - optional function that returns True once the copy has to be suspended
+    store = HistoryStore(aws_s3, data_bucket, site_id, history["granularity"])
+    while history["index"] < len(points):
+        if should_stop is not None and should_stop():
+            return
+        point = points[history["index"]]
+        covered = history["covered"][history["index"]]
+        if covered:
+            data = store.read(point["assetname"], point["pointname"], covered)
+            if len(data):
+                sink(data)
+        history["index"] += 1
+
+
+def getCheckpointPrefix(pipeline_type, event_id, site_id):
+    return "checkpoints/" + pipeline_type + "/" + event_id + "/" + site_id + "/"
+
+
+def readCheckpoint(s3_bucket_name, pipeline_type, event_id, site_id):
+    # returns the checkpoint of a suspended extraction, with the buffered values and the bytes not uploaded
+    # yet under "arrays", or None if the extraction has not started or already finished
+    prefix = getCheckpointPrefix(pipeline_type, event_id, site_id)
+    try:
+        response = aws_s3.get_object(Bucket=s3_bucket_name, Key=prefix + "checkpoint.json")
+    except aws_s3.exceptions.NoSuchKey:
+        return None
+    checkpoint = json.loads(response["Body"].read())
+    response = aws_s3.get_object(Bucket=s3_bucket_name, Key=checkpoint["arraysKey"])
+    with np.load(BytesIO(response["Body"].read())) as arrays:
+        checkpoint["arrays"] = dict(arrays)
+    return checkpoint
+
+
+def writeCheckpoint(checkpoint, arrays, s3_bucket_name, pipeline_type, event_id, site_id):
+    # the arrays go to a new object on every checkpoint, and the checkpoint only points to them once they are
+    # written, so an invocation that dies in between leaves the previous checkpoint intact
+    prefix = getCheckpointPrefix(pipeline_type, event_id, site_id)
+    checkpoint["sequence"] = checkpoint.get("sequence", 0) + 1
+    checkpoint["arraysKey"] = prefix + "arrays-" + str(checkpoint["sequence"]) + ".npz"
+    body = BytesIO()
+    np.savez(body, **arrays)
+    aws_s3.put_object(Bucket=s3_bucket_name, Key=checkpoint["arraysKey"], Body=body.getvalue())
+    aws_s3.put_object(
+        Bucket=s3_bucket_name, Key=prefix + "checkpoint.json", Body=json.dumps(checkpoint)
+    )
+
+
+def deleteCheckpoint(s3_bucket_name, pipeline_type, event_id, site_id):
+    paginator = aws_s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=s3_bucket_name, Prefix=getCheckpointPrefix(pipeline_type, event_id, site_id)
+    ):
+        objects = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+        if objects:
+            aws_s3.delete_objects(Bucket=s3_bucket_name, Delete={"Objects": objects})
+
+
+def getStopCondition(context):
+    # returns a function that tells the fetch when to suspend, leaving checkpoint_margin_seconds of the
+    # invocation to finish the requests in flight and write the checkpoint
+    if context is None:
+        return None
+    deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - checkpoint_margin_seconds
+    return lambda: time.time() >= deadline
+
+
+def getDataKey(pipeline_type, event_id, site_id, data_format):
+    # the key consumers read the site's data from: the CSV object, or the prefix of the Parquet files
+    if data_format in ("parquet", "partitioned"):
+        return pipeline_type + "/" + event_id + "/" + site_id + "/"
+    return pipeline_type + "/" + event_id + "/" + site_id + ".csv"
+
+
+def s3Writer(
+    event_id, s3_bucket_name, pipeline_type, site_id, state=None, buffer=b"", part=None
+):
+    # returns a writer that streams the site's data to S3 in fixed-size multipart upload parts while it is
+    # being fetched, so the complete data set is never held in memory. use it as a context manager.
+    # state and buffer continue the upload of a suspended extraction. part selects a Parquet part file
+    # instead of the CSV object
+    if part is None:
+        path = getDataKey(pipeline_type, event_id, site_id, "csv")
+    else:
+        path = getDataKey(pipeline_type, event_id, site_id, "parquet") + f"part-{part:05d}.parquet"
+    return S3StreamWriter(
+        aws_s3, s3_bucket_name, path, part_size=s3_part_size, state=state, buffer=buffer
+    )
+
+
+def partitionedWriter(event_id, s3_bucket_name, pipeline_type, site_id, writer_checkpoint):
+    # returns a writer that streams the site's data to one Parquet file per asset and point, continuing the
+    # partitions and file numbering of earlier invocations. use it as a context manager
+    return PartitionedParquetWriter(
+        aws_s3,
+        s3_bucket_name,
+        getDataKey(pipeline_type, event_id, site_id, "partitioned"),
+        part_size=s3_part_size,
+        files=writer_checkpoint["parts"],
+        partitions=writer_checkpoint["partitions"],
+        columns=writer_checkpoint["columns"],
     )
-    csv_buffer = StringIO()
-    data_frame.to_csv(csv_buffer)
-    s3_resource = boto3.resource('s3')
-    s3_resource.Object(s3_bucket_name, path).put(Body=csv_buffer.getvalue())
 
 
 def handler(event, context):
@@ -185,18 +460,234 @@ def handler(event, context):
     site_id = event["site_id"]
     pipeline_type = event["pipeline_type"]
     event_id = event["event_id"]
-    
-    logger.info(f'Starting to get data from Neptune')
-    site_asset_data = getRTUsandPointForAs(site_id)
-    logger.info(f'Data from Neptune: {site_asset_data[0]}')
-    end_time, start_time = getTimeInterval(pipeline_type)
-    logger.info(f'Starting to get data from SiteWise')
-    data = getHistoricalDatawithinTimeInterval(site_asset_data, start_time, end_time)
-    dataframe = pd.DataFrame.from_records(data)
-    logger.info(f'Data from SiteWise: {dataframe.head()}')
-
-    logger.info(f'Writing data to S3')
-    s3Writer(event_id, dataframe, data_bucket, pipeline_type, site_id)
-    logger.info(f'Data written to S3')
-
-    return {"site_id": site_id, "pipeline_type": pipeline_type, "event_id": event_id}
+
+    # a chunk of fetched values ends on a time slice boundary, which must not split an interval
+    if resample_interval_seconds > 0 and history_slice_seconds % resample_interval_seconds != 0:
+        raise ValueError(
+            f"resample_interval_seconds {resample_interval_seconds} does not divide "
+            f"history_slice_seconds {history_slice_seconds}"
+        )
+
+    # an extraction that did not fit into one invocation continues from its checkpoint. the state machine
+    # invokes the function again as long as it returns the CONTINUE status
+    checkpoint = readCheckpoint(data_bucket, pipeline_type, event_id, site_id)
+    if checkpoint is None:
+        logger.info(f'Starting to get data from Neptune')
+        site_asset_data = getRTUsandPointForAs(site_id)
+        logger.info(f'Data from Neptune: {site_asset_data[0]}')
+        end_time, start_time = getTimeInterval(pipeline_type, event.get("end_time"))
+
+        use_aggregates = pipeline_type == "retrain" and retrain_extraction_mode == "aggregates"
+
+        # aggregates are cheap to read in full, and an interval's aggregate keeps changing until the interval
+        # is over, so they are not extracted incrementally
+        watermarks = None
+        if incremental_extraction and not use_aggregates:
+            manifest = readWatermarkManifest(data_bucket, pipeline_type, site_id)
+            # a retried run finds its increment already listed, and must not replace it with an empty one
+            if any(increment["event_id"] == event_id for increment in manifest["increments"]):
+                logger.info(f'Increment for event {event_id} already written')
+                return {
+                    "site_id": site_id,
+                    "pipeline_type": pipeline_type,
+                    "event_id": event_id,
+                    "status": "COMPLETE",
+                }
+            watermarks = manifest["watermarks"]
+
+        window = getQueryWindow(start_time, end_time)
+
+        skipped_points = []
+        if skip_unchanged_points:
+            site_asset_data, skipped_points = getPointsWithNewData(site_asset_data, start_time, watermarks)
+            logger.info(
+                f'Skipping {len(skipped_points)} of {len(site_asset_data) + len(skipped_points)} points without new data'
+            )
+        points = [
+            {"assetname": point["assetName"], "pointname": point["pointName"].replace("brick:", "")}
+            for point in site_asset_data
+        ]
+
+        history = None
+        if history_store and pipeline_type == "retrain" and not use_aggregates and watermarks is None:
+            history = getHistoryPlan(site_id, points, window)
+
+        checkpoint = {
+            "startTime": start_time,
+            "window": window,
+            "history": history,
+            # the fetch of the gaps only starts after the copy from the history store
+            "assetProperties": site_asset_data if history is not None else None,
+            "useAggregates": use_aggregates,
+            "incremental": watermarks is not None,
+            "points": points,
+            "skippedPoints": len(skipped_points),
+            "summary": {"rows": 0, "minTimestamp": None, "maxTimestamp": None},
+            "writer": {
+                "format": data_format,
+                "state": None,
+                "rows": 0,
+                "headerWritten": False,
+                "parts": 0,
+                "partitions": [],
+                "columns": None,
+            },
+            "fetch": None,
+        }
+        arrays = {"buffer": np.empty(0, np.uint8)}
+    else:
+        logger.info(f'Continuing suspended extraction from checkpoint {checkpoint["sequence"]}')
+        site_asset_data = checkpoint["assetProperties"]
+        end_time = None
+        start_time = checkpoint["startTime"]
+        use_aggregates = checkpoint["useAggregates"]
+        watermarks = None
+        if checkpoint["incremental"]:
+            manifest = readWatermarkManifest(data_bucket, pipeline_type, site_id)
+            watermarks = manifest["watermarks"]
+        arrays = checkpoint.pop("arrays")
+        if checkpoint["fetch"] is not None:
+            checkpoint["fetch"]["buffers"] = arrays
+
+    logger.info(f'Starting to stream data from SiteWise to S3')
+    summary = checkpoint["summary"]
+    writer_checkpoint = checkpoint["writer"]
+    use_parquet = writer_checkpoint["format"] == "parquet"
+    use_partitions = writer_checkpoint["format"] == "partitioned"
+    if use_partitions:
+        output = partitionedWriter(event_id, data_bucket, pipeline_type, site_id, writer_checkpoint)
+    else:
+        output = s3Writer(
+            event_id,
+            data_bucket,
+            pipeline_type,
+            site_id,
+            state=writer_checkpoint["state"],
+            buffer=arrays["buffer"].tobytes(),
+            part=writer_checkpoint["parts"] if use_parquet else None,
+        )
+    with output as stream:
+        if use_partitions:
+            frame_writer = stream
+        elif use_parquet:
+            frame_writer = ParquetFrameWriter(stream)
+        else:
+            frame_writer = CsvFrameWriter(
+                stream, rows=writer_checkpoint["rows"], header_written=writer_checkpoint["headerWritten"]
+            )
+
+        resample = resample_interval_seconds > 0 and not use_aggregates
+        history = checkpoint["history"]
+        # values copied from the history store and values fetched from SiteWise get the same categories, so both
+        # are written with the same schema
+        categories = None
+        if history is not None:
+            categories = {
+                column: list(dict.fromkeys(point[column] for point in checkpoint["points"]))
+                for column in ("assetname", "pointname")
+            }
+
+        def writeChunk(data_frame):
+            if resample:
+                data_frame = resampleFrame(data_frame, resample_interval_seconds, resample_aggregations)
+            if categories is not None:
+                data_frame = data_frame.assign(
+                    **{
+                        column: pd.Categorical(data_frame[column], categories=column_categories)
+                        for column, column_categories in categories.items()
+                    }
+                )
+            # every consumer reads the data with the column types of site_schema
+            frame_writer.writeFrame(validateSchema(data_frame))
+            addToSummary(summary, data_frame)
+
+        should_stop = getStopCondition(context)
+        copying = False
+        if history is not None:
+            copyFromHistory(site_id, history, checkpoint["points"], writeChunk, should_stop)
+            copying = history["index"] < len(checkpoint["points"])
+
+        fetch_checkpoint = None
+        # entries SiteWise could not return, which keep the extract out of the history store's coverage
+        failures = []
+        if copying:
+            logger.info(f'Suspended after copying {history["index"]} points from the history store')
+        elif use_aggregates:
+            fetch_checkpoint = getAggregatesWithinTimeInterval(
+                site_asset_data,
+                start_time,
+                end_time,
+                sink=writeChunk,
+                checkpoint=checkpoint["fetch"],
+                should_stop=should_stop,
+            )
+        else:
+            fetch_checkpoint = getHistoricalDatawithinTimeInterval(
+                site_asset_data,
+                start_time,
+                end_time,
+                watermarks,
+                sink=writeChunk,
+                checkpoint=checkpoint["fetch"],
+                should_stop=should_stop,
+                ranges=history["gaps"] if history is not None else None,
+                failures=failures,
+            )
+        suspended = copying or fetch_checkpoint is not None
+
+        buffer = b""
+        if use_partitions:
+            frame_writer.close()
+            writer_checkpoint["parts"] = frame_writer.files
+            writer_checkpoint["partitions"] = frame_writer.partitions
+            writer_checkpoint["columns"] = frame_writer.columns
+            if not suspended:
+                frame_writer.writeManifest()
+        elif use_parquet:
+            # every invocation writes a complete part file, so a suspended extraction leaves no open upload
+            if frame_writer.close():
+                writer_checkpoint["parts"] += 1
+            else:
+                stream.abort()
+        elif suspended:
+            writer_checkpoint["state"], buffer = stream.suspend()
+            writer_checkpoint["rows"] = frame_writer.rows
+            writer_checkpoint["headerWritten"] = frame_writer.header_written
+
+        if suspended:
+            arrays = fetch_checkpoint.pop("buffers") if fetch_checkpoint is not None else {}
+            arrays["buffer"] = np.frombuffer(buffer, dtype=np.uint8)
+            checkpoint["fetch"] = fetch_checkpoint
+            writeCheckpoint(checkpoint, arrays, data_bucket, pipeline_type, event_id, site_id)
+            logger.info(f'{summary["rows"]} rows written so far, continuing in the next invocation')
+            return {
+                "site_id": site_id,
+                "pipeline_type": pipeline_type,
+                "event_id": event_id,
+                "status": "CONTINUE",
+            }
+    key = getDataKey(pipeline_type, event_id, site_id, writer_checkpoint["format"])
+    logger.info(f'{summary["rows"]} rows written to S3')
+
+    # the watermarks only move once the increment they cover has landed
+    if watermarks is not None:
+        addIncrement(manifest, event_id, summary, key, start_time)
+        writeWatermarkManifest(manifest, data_bucket, pipeline_type, site_id)
+        logger.info('Watermark manifest updated')
+    deleteCheckpoint(data_bucket, pipeline_type, event_id, site_id)
+
+    # init_lambda only fans out for the points listed here. the compaction merges the extract into the history
+    # store, and extends the coverage of the points whose every entry was read by the window
+    failed_points = {(assetname, pointname) for assetname, pointname, _, _ in failures}
+    return {
+        "site_id": site_id,
+        "pipeline_type": pipeline_type,
+        "event_id": event_id,
+        "status": "COMPLETE",
+        "points": checkpoint["points"],
+        "skippedPoints": checkpoint["skippedPoints"],
+        "window": checkpoint["window"],
+        "coveredPoints": [
+            point for point in checkpoint["points"] if (point["assetname"], point["pointname"]) not in failed_points
+        ],
+    }
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+# column types every stage of the pipeline keeps site data in. the asset and point names repeat on every row,
+# so they are categorical, which stores each name once and a small integer code per row
+CATEGORY_COLUMNS = ("assetname", "pointname")
+TIMESTAMP_COLUMN = "timestamp"
+# value columns (value, or count/mean/std of aggregates) are float64, or float32 where that loses nothing
+VALUE_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+# dtypes to parse CSV files with, so the names never exist as one string object per row
+CSV_DTYPES = {"assetname": "category", "pointname": "category", "timestamp": np.int64}
+
+
+def getValueDtype(values):
+    """float32 if every value survives the round trip through float32 unchanged, float64 otherwise."""
+    values = np.asarray(values, dtype=np.float64)
+    narrowed = values.astype(np.float32).astype(np.float64)
+    if np.array_equal(narrowed, values, equal_nan=True):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def getPointValueDtypes(data, column="value"):
+    """The value dtype of every (assetname, pointname) pair of a frame, see getValueDtype.
+
+    A frame without name columns holds a single point, e.g. a partition file, and is keyed None.
+    """
+    if not all(name in data.columns for name in CATEGORY_COLUMNS):
+        return {None: getValueDtype(data[column])}
+    return {
+        key: getValueDtype(group)
+        for key, group in data[column].groupby(
+            [data["assetname"], data["pointname"]], observed=True, sort=False
+        )
+    }
+
+
+def applySchema(data, downcast=False):
+    """Converts a site frame to the pipeline's column types.
+
+    Asset and point names become categorical, timestamps int64 nanoseconds and
+    every other column float64. With downcast, value columns become float32 if
+    that is lossless for every point of the frame: the dtype is chosen per point,
+    and a frame holding several points only narrows if all of them allow it.
+
+    Args:
+        data (dataframe): site data, e.g. as read from a CSV file.
+        downcast (bool): whether value columns may be narrowed to float32.
+
+    Returns:
+        dataframe: the converted frame. Columns that already have their type are not copied.
+    """
+    columns = {}
+    for column in data.columns:
+        if column in CATEGORY_COLUMNS:
+            if not isinstance(data[column].dtype, pd.CategoricalDtype):
+                columns[column] = data[column].astype("category")
+        elif column == TIMESTAMP_COLUMN:
+            if data[column].dtype != np.int64:
+                columns[column] = data[column].astype(np.int64)
+        else:
+            dtype = np.dtype(np.float64)
+            if downcast and len(data) > 0:
+                if all(
+                    value_dtype == np.float32
+                    for value_dtype in getPointValueDtypes(data, column).values()
+                ):
+                    dtype = np.dtype(np.float32)
+            if data[column].dtype != dtype:
+                columns[column] = data[column].astype(dtype)
+    if not columns:
+        return data
+    return data.assign(**columns)
+
+
+def validateSchema(data):
+    """Raises ValueError if a site frame does not have the pipeline's column types. Returns the frame."""
+    errors = []
+    for column in data.columns:
+        dtype = data[column].dtype
+        if column in CATEGORY_COLUMNS:
+            if not isinstance(dtype, pd.CategoricalDtype):
+                errors.append(f"{column} is {dtype}, not category")
+        elif column == TIMESTAMP_COLUMN:
+            if dtype != np.int64:
+                errors.append(f"{column} is {dtype}, not int64")
+        elif dtype not in VALUE_DTYPES:
+            errors.append(f"{column} is {dtype}, not float32 or float64")
+    missing = [column for column in CATEGORY_COLUMNS + (TIMESTAMP_COLUMN,) if column not in data.columns]
+    if missing:
+        errors.append(f"missing columns {', '.join(missing)}")
+    if errors:
+        raise ValueError("Site data does not match the schema: " + "; ".join(errors))
+    return data
+
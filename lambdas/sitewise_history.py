@@ -0,0 +1,931 @@
+import math
+import time
+import queue
+import bisect
+import random
+import logging
+import datetime
+import numpy as np
+import pandas as pd
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# SiteWise accepts up to 16 entries per BatchGetAssetPropertyValueHistory request
+MAX_BATCH_ENTRIES = 16
+# and up to 128 entries per BatchGetAssetPropertyValue (latest value) request
+MAX_LATEST_VALUE_ENTRIES = 128
+# maximum number of values (or aggregates) SiteWise returns per entry on each page
+MAX_RESULTS_PER_PAGE = 20000
+MAX_AGGREGATE_RESULTS_PER_PAGE = 4000
+# columns of an aggregates query and the aggregates they hold
+AGGREGATE_COLUMNS = {"count": "count", "mean": "average", "std": "standardDeviation"}
+# entry error codes that are worth another attempt, and how often an entry is attempted
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "InternalFailureException",
+    "LimitExceededException",
+}
+MAX_ENTRY_ATTEMPTS = 3
+# number of rows handed on at once when the rows are streamed to a sink
+DEFAULT_CHUNK_ROWS = 500_000
+# variants whose values are already numbers (booleans included)
+NUMERIC_VARIANTS = {"doubleValue", "integerValue", "booleanValue"}
+# a request rejected with ThrottlingException is retried with full-jitter exponential backoff
+MAX_THROTTLE_RETRIES = 6
+BACKOFF_BASE_SECONDS = 0.2
+BACKOFF_CAP_SECONDS = 10
+# errors with which SiteWise rejects a nextToken saved by an earlier invocation
+INVALID_TOKEN_ERROR_CODES = {"InvalidRequestException", "ValidationException"}
+# put on the queue of finished entries by every worker when it stops
+WORKER_EXITED = object()
+
+
+def getEpochSeconds(value):
+    """Start/end times are passed around either as epoch seconds or as datetime objects."""
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp())
+    return int(value)
+
+
+def getTimeSlices(start_time, end_time, slice_seconds):
+    """Splits a query range into sub-windows aligned to multiples of slice_seconds.
+
+    SiteWise ranges have second granularity, so every interior boundary second is
+    requested by both neighbouring slices. Each slice then keeps only the values
+    in its own half-open nanosecond range [lowerBound, upperBound), so a value on
+    a boundary lands in exactly one slice. The outer ends keep the semantics of
+    the overall range (lowerBound/upperBound of None means no filter).
+
+    Args:
+        start_time (int or datetime): exclusive start of the query range.
+        end_time (int or datetime): inclusive end of the query range.
+        slice_seconds (int): slice length, e.g. 86400 for daily slices. 0 disables slicing.
+
+    Returns:
+        list: dict objects with keys startDate, endDate, lowerBound, upperBound, in time order.
+    """
+    start_seconds = getEpochSeconds(start_time)
+    end_seconds = getEpochSeconds(end_time)
+    boundaries = []
+    if slice_seconds > 0:
+        boundary = (start_seconds // slice_seconds + 1) * slice_seconds
+        while boundary < end_seconds:
+            boundaries.append(boundary)
+            boundary += slice_seconds
+
+    slices = []
+    lower = None
+    for boundary in boundaries + [None]:
+        slices.append(
+            {
+                "startDate": start_time if lower is None else lower - 1,
+                "endDate": end_time if boundary is None else boundary,
+                "lowerBound": None if lower is None else lower * 1_000_000_000,
+                "upperBound": None if boundary is None else boundary * 1_000_000_000,
+            }
+        )
+        lower = boundary
+    return slices
+
+
+def getRangeSlices(ranges, slice_seconds):
+    """Time slices (see getTimeSlices) that cover only the given half-open nanosecond ranges.
+
+    Each range [lower, upper) is requested in whole seconds, and the values
+    outside of it are dropped while parsing.
+    """
+    slices = []
+    for lower, upper in ranges:
+        # the start of a query is exclusive and its end inclusive, both in whole seconds
+        range_slices = getTimeSlices(
+            lower // 1_000_000_000 - 1, -(-(upper - 1) // 1_000_000_000), slice_seconds
+        )
+        range_slices[0]["lowerBound"] = lower
+        range_slices[-1]["upperBound"] = upper
+        slices.extend(range_slices)
+    return slices
+
+
+def buildHistoryRequestEntry(state, query):
+    """Builds the request entry for the next request that reads an entry.
+
+    An entry that already delivered data resumes from the second holding its last
+    value. The start of a request is exclusive, so the request starts one second
+    before it. Values at or before the cursor are dropped again while parsing, so
+    resuming never duplicates or skips a value.
+
+    Args:
+        state (dict): per-entry fetch state (see fetchHistory).
+        query (dict): the kind of query (see HISTORY_QUERY).
+
+    Returns:
+        dict: the request entry, or None if nothing is left to read.
+    """
+    start_time = state["startDate"]
+    if state["cursor"] is not None:
+        cursor_seconds = state["cursor"] // 1_000_000_000
+        if cursor_seconds > getEpochSeconds(state["endDate"]):
+            return None
+        start_time = cursor_seconds - 1
+    return {
+        "entryId": state["entryId"],
+        "assetId": state["assetId"],
+        "propertyId": state["propertyId"],
+        "startDate": start_time,
+        "endDate": state["endDate"],
+        "timeOrdering": "ASCENDING",
+        **query["entryFields"],
+    }
+
+
+def decodeVariantValues(history, variant):
+    """Decodes the values of a history page into floats.
+
+    A property keeps its data type, so the variant key is looked up once per page.
+    Booleans become 0/1, strings are parsed as numbers, and anything else
+    (including null values) becomes NaN.
+    """
+    if variant in NUMERIC_VARIANTS:
+        return [item["value"].get(variant, math.nan) for item in history]
+    return [parseNumber(item["value"].get(variant)) for item in history]
+
+
+def parseNumber(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def getNewRange(state, timestamps):
+    """Finds the part of a page that is new to an entry and owned by its slice.
+
+    Values come in ascending order, so everything already received (or owned by
+    the previous slice) sits at the front of the page, and everything owned by
+    the next slice sits at the end.
+
+    Returns:
+        tuple: first and last (exclusive) position of the new values.
+    """
+    first = 0
+    last = len(timestamps)
+    if state["cursor"] is not None:
+        first = bisect.bisect_right(timestamps, state["cursor"])
+    if state["lowerBound"] is not None:
+        first = max(first, bisect.bisect_left(timestamps, state["lowerBound"]))
+    if state["upperBound"] is not None:
+        last = bisect.bisect_left(timestamps, state["upperBound"], first)
+    return first, last
+
+
+def parseHistoryEntry(state, entry):
+    """Appends the values of one successEntry to the entry's column buffers and advances its cursor."""
+    history = entry["assetPropertyValueHistory"]
+    if not history:
+        return
+
+    timestamps = [
+        item["timestamp"]["timeInSeconds"] * 1_000_000_000
+        + item["timestamp"].get("offsetInNanos", 0)
+        for item in history
+    ]
+    first, last = getNewRange(state, timestamps)
+    if first >= last:
+        return
+    if first > 0 or last < len(timestamps):
+        history = history[first:last]
+        timestamps = timestamps[first:last]
+
+    state["timestamps"].extend(timestamps)
+    variant = next((key for item in history for key in item["value"] if key != "nullValue"), None)
+    state["columns"]["value"].extend(decodeVariantValues(history, variant))
+    state["cursor"] = timestamps[-1]
+
+
+def parseAggregatesEntry(state, entry):
+    """Appends the aggregates of one successEntry to the entry's column buffers and advances its cursor.
+
+    Each aggregated value is stamped with the start of its interval.
+    """
+    aggregates = entry["aggregatedValues"]
+    if not aggregates:
+        return
+
+    timestamps = [int(item["timestamp"].timestamp()) * 1_000_000_000 for item in aggregates]
+    first, last = getNewRange(state, timestamps)
+    if first >= last:
+        return
+    aggregates = aggregates[first:last]
+
+    state["timestamps"].extend(timestamps[first:last])
+    for column, aggregate in AGGREGATE_COLUMNS.items():
+        state["columns"][column].extend(
+            [item["value"].get(aggregate, math.nan) for item in aggregates]
+        )
+    state["cursor"] = timestamps[last - 1]
+
+
+# the two batch queries share entry packing, pagination and error handling, and differ in these settings
+HISTORY_QUERY = {
+    "operation": "batch_get_asset_property_value_history",
+    "maxResults": MAX_RESULTS_PER_PAGE,
+    "entryFields": {},
+    "columns": ["value"],
+    "parse": parseHistoryEntry,
+}
+
+
+def getAggregatesQuery(resolution):
+    """Settings of a BatchGetAssetPropertyAggregates query with the given resolution (e.g. 1h or 1d)."""
+    return {
+        "operation": "batch_get_asset_property_aggregates",
+        "maxResults": MAX_AGGREGATE_RESULTS_PER_PAGE,
+        "entryFields": {
+            "aggregateTypes": ["COUNT", "AVERAGE", "STANDARD_DEVIATION"],
+            "resolution": resolution,
+        },
+        "columns": list(AGGREGATE_COLUMNS),
+        "parse": parseAggregatesEntry,
+    }
+
+
+def getColumn(buffer, dtype):
+    # wraps an array.array without copying it
+    if len(buffer) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(buffer, dtype=dtype)
+
+
+def getCategoryCodes(states):
+    """Numbers the asset and point names of the entries in order of first appearance."""
+    asset_codes = {}
+    point_codes = {}
+    for state in states:
+        asset_codes.setdefault(state["assetName"], len(asset_codes))
+        point_codes.setdefault(state["pointName"], len(point_codes))
+    return asset_codes, point_codes
+
+
+def buildHistoryFrame(states, asset_codes, point_codes, columns):
+    """Builds a DataFrame from the column buffers of a run of entries in one step.
+
+    Args:
+        states (list): entry states in output order.
+        asset_codes (dict): category code of every asset name (see getCategoryCodes).
+        point_codes (dict): category code of every point name.
+        columns (list): names of the value columns of the query.
+
+    Returns:
+        dataframe: columns assetname and pointname (categorical), the value columns
+        (float64) and timestamp (int64 nanoseconds).
+    """
+    counts = [len(state["timestamps"]) for state in states]
+    timestamps = np.concatenate(
+        [getColumn(state["timestamps"], np.int64) for state in states] or [np.empty(0, np.int64)]
+    )
+    asset_column = pd.Categorical.from_codes(
+        np.repeat([asset_codes[state["assetName"]] for state in states], counts).astype(np.int32),
+        categories=list(asset_codes),
+    )
+    point_column = pd.Categorical.from_codes(
+        np.repeat([point_codes[state["pointName"]] for state in states], counts).astype(np.int32),
+        categories=list(point_codes),
+    )
+    data = {"assetname": asset_column, "pointname": point_column}
+    for column in columns:
+        data[column] = np.concatenate(
+            [getColumn(state["columns"][column], np.float64) for state in states]
+            or [np.empty(0, np.float64)]
+        )
+    data["timestamp"] = timestamps
+    return pd.DataFrame(data)
+
+
+def requeueHistoryEntry(state, error_code, error_message, retry_queue):
+    """Puts a failed entry at the back of the queue, up to MAX_ENTRY_ATTEMPTS times.
+
+    A re-queued entry resumes from its cursor.
+
+    Returns:
+        bool: whether the entry was re-queued.
+    """
+    state["attempts"] += 1
+    if error_code in RETRYABLE_ERROR_CODES and state["attempts"] < MAX_ENTRY_ATTEMPTS:
+        logger.warning(
+            f'Retrying {state["assetName"]}/{state["pointName"]} after {error_code}: {error_message}'
+        )
+        retry_queue.append(state)
+        return True
+    logger.error(
+        f'Giving up on {state["assetName"]}/{state["pointName"]} after {error_code}: {error_message}'
+    )
+    state["failed"] = True
+    return False
+
+
+def callWithBackoff(sitewise_client, operation, request, governor=None):
+    """Sends one SiteWise request, retrying it while it is throttled.
+
+    Args:
+        sitewise_client: boto3 iotsitewise client (or a stand-in with the same methods).
+        operation (str): name of the client method.
+        request (dict): keyword arguments of the request.
+        governor (RateGovernor): optional rate governor shared with other invocations.
+
+    Returns:
+        dict: the SiteWise response.
+    """
+    attempt = 0
+    while True:
+        if governor is not None:
+            governor.acquire()
+        try:
+            return getattr(sitewise_client, operation)(**request)
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") != "ThrottlingException":
+                raise
+            if governor is not None:
+                governor.onThrottle()
+            if attempt >= MAX_THROTTLE_RETRIES:
+                raise
+            delay = random.uniform(
+                0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+            )
+            logger.warning(f"Request throttled, retrying in {delay:.2f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def takeFromQueue(pending):
+    # the queue is shared between workers, so it can run empty between a check and the pop
+    try:
+        return pending.popleft()
+    except IndexError:
+        return None
+
+
+def fetchHistoryChains(sitewise_client, run):
+    """Worker that reads entries from the shared queue until it is drained.
+
+    The response is paginated with a single nextToken for the whole request.
+    Whenever entries finish while others are still waiting, the free slots are
+    refilled by starting a new request, in which the unfinished entries resume
+    from their cursors.
+
+    When run["shouldStop"] returns True, the worker stops before its next
+    request and leaves the request it was paginating through in
+    run["suspended"], so a later invocation can continue it with the same
+    nextToken. Saved requests in run["chains"] are continued before anything
+    else; if SiteWise no longer accepts a saved token, the entries resume from
+    their cursors instead.
+
+    Args:
+        sitewise_client: boto3 iotsitewise client.
+        run (dict): state shared by all workers of a fetch (see fetchHistory).
+
+    Returns:
+        int: the number of requests sent.
+    """
+    pending = run["pending"]
+    completed = run["completed"]
+    query = run["query"]
+    slots = run["slots"]
+    # entries that are part of the current request, keyed by entryId
+    live = {}
+    entries = []
+    nt = None
+    resumed = False
+    request_count = 0
+
+    while pending or live or run["chains"]:
+        if run["shouldStop"] is not None and run["shouldStop"]():
+            if live:
+                run["suspended"].append(
+                    {
+                        "entryIds": list(live),
+                        "entries": entries if nt is not None else None,
+                        "nextToken": nt,
+                    }
+                )
+            break
+
+        if not live and run["chains"]:
+            chain = takeFromQueue(run["chains"])
+            if chain is None:
+                continue
+            live = {entry_id: run["states"][int(entry_id)] for entry_id in chain["entryIds"]}
+            entries = chain["entries"]
+            nt = chain["nextToken"]
+            resumed = nt is not None
+
+        # a resumed request is continued as it was, so its saved token stays valid
+        if nt is None or (pending and len(live) < slots and not resumed):
+            nt = None
+            while len(live) < slots:
+                state = takeFromQueue(pending)
+                if state is None:
+                    break
+                live[state["entryId"]] = state
+
+            entries = []
+            for entry_id in list(live):
+                request_entry = buildHistoryRequestEntry(live[entry_id], query)
+                if request_entry is None:
+                    completed.put(live.pop(entry_id))
+                else:
+                    entries.append(request_entry)
+            if not entries:
+                continue
+
+        request = {"entries": entries, "maxResults": query["maxResults"]}
+        if nt is not None:
+            request["nextToken"] = nt
+        try:
+            response = callWithBackoff(sitewise_client, query["operation"], request, run["governor"])
+        except ClientError as err:
+            if not resumed or err.response.get("Error", {}).get("Code") not in INVALID_TOKEN_ERROR_CODES:
+                raise
+            logger.warning(f"Saved nextToken not accepted, resuming {len(live)} entries from their cursors")
+            nt = None
+            resumed = False
+            continue
+        resumed = False
+        request_count += 1
+
+        for entry in response.get("successEntries", []):
+            state = live.get(entry["entryId"])
+            if state is not None:
+                query["parse"](state, entry)
+
+        for entry in response.get("errorEntries", []):
+            if run["governor"] is not None and entry["errorCode"] == "ThrottlingException":
+                run["governor"].onThrottle()
+            state = live.pop(entry["entryId"], None)
+            if state is not None and not requeueHistoryEntry(
+                state, entry["errorCode"], entry.get("errorMessage"), pending
+            ):
+                completed.put(state)
+
+        # skipped entries were completely processed by an earlier page of this request
+        for entry in response.get("skippedEntries", []):
+            state = live.pop(entry["entryId"], None)
+            if state is None:
+                continue
+            if entry["completionStatus"] == "ERROR":
+                error_info = entry.get("errorInfo", {})
+                if requeueHistoryEntry(state, error_info.get("errorCode"), None, pending):
+                    continue
+            completed.put(state)
+
+        nt = response.get("nextToken")
+        if nt is None:
+            # the last page of a request completes every entry still in it
+            for state in live.values():
+                completed.put(state)
+            live.clear()
+
+    return request_count
+
+
+def runHistoryWorker(sitewise_client, run):
+    # hands a worker's failure to the thread collecting the results, which would otherwise wait forever,
+    # and tells it when the worker is gone, so it can tell a finished fetch from a suspended one
+    try:
+        return fetchHistoryChains(sitewise_client, run)
+    except Exception as err:
+        run["completed"].put(err)
+        raise
+    finally:
+        run["completed"].put(WORKER_EXITED)
+
+
+def updateWatermarks(states, watermarks):
+    """Advances each property's watermark to the newest value read for it.
+
+    A watermark only moves over the slices that completed, in time order, so a
+    slice that failed is read again by the next incremental run.
+
+    Args:
+        states (list): entry states in property and slice order.
+        watermarks (dict): nanosecond watermarks keyed by pointSiteWiseId, updated in place.
+    """
+    blocked = set()
+    for state in states:
+        if state["propertyId"] in blocked:
+            continue
+        if state["failed"]:
+            blocked.add(state["propertyId"])
+        elif state["cursor"] is not None and state["cursor"] > watermarks.get(state["propertyId"], -1):
+            watermarks[state["propertyId"]] = state["cursor"]
+
+
+def buildFetchStates(assetProperties, property_slices, start_time, watermarks, columns):
+    """Creates the state of every (property, time slice) entry of a fetch, in output order.
+
+    property_slices holds the time slices of every property, in the order of assetProperties.
+    """
+    start_nanos = getEpochSeconds(start_time) * 1_000_000_000
+    states = []
+    for asset_property, time_slices in zip(assetProperties, property_slices):
+        watermark = (watermarks or {}).get(asset_property["pointSiteWiseId"])
+        for time_slice in time_slices:
+            # slices that end before the watermark were read by an earlier run. in the slice holding the
+            # watermark, the watermark is where reading resumes, exactly like the cursor of a resumed request
+            cursor = None
+            if watermark is not None:
+                if time_slice["upperBound"] is not None and time_slice["upperBound"] <= watermark:
+                    continue
+                if watermark >= (time_slice["lowerBound"] or start_nanos):
+                    cursor = watermark
+            states.append(
+                {
+                    "entryId": str(len(states)),
+                    "assetName": asset_property["assetName"],
+                    "pointName": asset_property["pointName"].replace("brick:", ""),
+                    "assetId": asset_property["assetSiteWiseId"],
+                    "propertyId": asset_property["pointSiteWiseId"],
+                    **time_slice,
+                    "cursor": cursor,
+                    "attempts": 0,
+                    "failed": False,
+                    "timestamps": array("q"),
+                    "columns": {column: array("d") for column in columns},
+                }
+            )
+    return states
+
+
+def getJsonTime(value):
+    # request times are either epoch seconds or datetime objects, and SiteWise accepts both
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value
+
+
+def suspendFetch(states, finished, next_index, run, counts):
+    """Captures everything a later invocation needs to continue a fetch (see fetchHistory).
+
+    Returns:
+        dict: JSON-serializable state, plus the column buffers of the entries that
+        were not passed on yet as numpy arrays under "buffers".
+    """
+    held = [
+        state
+        for state in states[next_index:]
+        if state["timestamps"] is not None and len(state["timestamps"]) > 0
+    ]
+    buffers = {
+        "index": np.array([int(state["entryId"]) for state in held], dtype=np.int64),
+        "counts": np.array([len(state["timestamps"]) for state in held], dtype=np.int64),
+        "timestamps": np.concatenate(
+            [getColumn(state["timestamps"], np.int64) for state in held] or [np.empty(0, np.int64)]
+        ),
+    }
+    for column in run["query"]["columns"]:
+        buffers["column_" + column] = np.concatenate(
+            [getColumn(state["columns"][column], np.float64) for state in held]
+            or [np.empty(0, np.float64)]
+        )
+    chains = [
+        dict(
+            chain,
+            entries=None
+            if chain["entries"] is None
+            else [
+                dict(entry, startDate=getJsonTime(entry["startDate"]), endDate=getJsonTime(entry["endDate"]))
+                for entry in chain["entries"]
+            ],
+        )
+        for chain in list(run["chains"]) + run["suspended"]
+    ]
+    return {
+        "states": [
+            {
+                **{key: value for key, value in state.items() if key not in ("timestamps", "columns")},
+                "startDate": getJsonTime(state["startDate"]),
+                "endDate": getJsonTime(state["endDate"]),
+                "finished": finished[index],
+            }
+            for index, state in enumerate(states)
+        ],
+        "pending": [int(state["entryId"]) for state in run["pending"]],
+        "chains": chains,
+        "nextIndex": next_index,
+        **counts,
+        "buffers": buffers,
+    }
+
+
+def resumeFetch(checkpoint, columns):
+    """Restores the entry states, queue and saved requests of a suspended fetch (see suspendFetch)."""
+    states = []
+    finished = []
+    for saved in checkpoint["states"]:
+        state = {key: value for key, value in saved.items() if key != "finished"}
+        if len(states) < checkpoint["nextIndex"]:
+            # already passed on by an earlier invocation
+            state["timestamps"] = state["columns"] = None
+        else:
+            state["timestamps"] = array("q")
+            state["columns"] = {column: array("d") for column in columns}
+        states.append(state)
+        finished.append(saved["finished"])
+
+    buffers = checkpoint["buffers"]
+    offset = 0
+    for index, count in zip(buffers["index"], buffers["counts"]):
+        state = states[int(index)]
+        state["timestamps"].frombytes(buffers["timestamps"][offset : offset + count].tobytes())
+        for column in columns:
+            state["columns"][column].frombytes(
+                buffers["column_" + column][offset : offset + count].tobytes()
+            )
+        offset += count
+
+    pending = deque(states[index] for index in checkpoint["pending"])
+    chains = deque(checkpoint["chains"])
+    return states, finished, pending, chains
+
+
+def fetchHistory(
+    sitewise_client,
+    assetProperties,
+    start_time,
+    end_time,
+    workers=1,
+    slice_seconds=0,
+    watermarks=None,
+    sink=None,
+    chunk_rows=DEFAULT_CHUNK_ROWS,
+    query=HISTORY_QUERY,
+    governor=None,
+    checkpoint=None,
+    should_stop=None,
+    ranges=None,
+    failures=None,
+):
+    """Reads the value history of many asset properties with a pool of workers.
+
+    Long ranges are split into aligned time slices (see getTimeSlices), and every
+    (property, slice) pair becomes its own entry, so deep history is read by many
+    short pagination chains instead of one long one per property. Each worker
+    packs up to 16 entries into its requests and follows their pagination
+    independently of the other workers. Results are merged in the order of
+    assetProperties and slices, each property in ascending time order, so the
+    output does not depend on how the work was scheduled.
+
+    A fetch that cannot finish in one invocation is suspended when should_stop
+    returns True: the workers stop before their next request, and the state of
+    every entry, the requests in flight with their nextTokens and the values not
+    passed on yet are returned as a checkpoint. Calling fetchHistory again with
+    that checkpoint continues exactly where it stopped, and the sink receives the
+    same sequence of rows as in an uninterrupted fetch.
+
+    Args:
+        sitewise_client: boto3 iotsitewise client (or a stand-in with the same method).
+        assetProperties (list): dict objects with keys assetName, assetSiteWiseId, pointName, pointSiteWiseId.
+        start_time (int or datetime): exclusive start of the query range.
+        end_time (int or datetime): inclusive end of the query range.
+        workers (int): number of concurrent request chains.
+        slice_seconds (int): length of the time slices. 0 reads the range as a single slice.
+        watermarks (dict): optional nanosecond timestamps of the newest value already ingested, keyed by
+            pointSiteWiseId. Only newer values are read, and the dict is updated in place.
+        sink (callable): optional function that receives the rows as a sequence of DataFrames in output
+            order, of about chunk_rows rows each, while the fetch is still running.
+        chunk_rows (int): number of rows collected before a DataFrame is passed on.
+        query (dict): the kind of query, raw values by default (see HISTORY_QUERY and getAggregatesQuery).
+        governor (RateGovernor): optional rate governor that every request waits for.
+        checkpoint (dict): optional checkpoint of a suspended fetch to continue. assetProperties, the range
+            and the watermark seeds are then taken from the checkpoint.
+        should_stop (callable): optional function that returns True once the fetch has to be suspended.
+            Requires a sink.
+        ranges (list): optional half-open [lower, upper) nanosecond ranges to read instead of the whole
+            range, as one list per property in the order of assetProperties, e.g. the gaps of a store
+            that already holds the rest. A property without ranges is not read.
+        failures (list): optional list that receives a (assetName, pointName, lowerBound, upperBound) tuple
+            for every entry that could not be read once the fetch is complete.
+
+    Returns:
+        dataframe: one row per value (see buildHistoryFrame), or None if the rows went to sink, or the
+        checkpoint if the fetch was suspended.
+    """
+    if checkpoint is None:
+        if ranges is None:
+            property_slices = [getTimeSlices(start_time, end_time, slice_seconds)] * len(assetProperties)
+        else:
+            property_slices = [getRangeSlices(property_ranges, slice_seconds) for property_ranges in ranges]
+        states = buildFetchStates(assetProperties, property_slices, start_time, watermarks, query["columns"])
+        finished = [False] * len(states)
+        pending = deque(states)
+        chains = deque()
+        next_index = 0
+        counts = {
+            "propertyCount": len(assetProperties),
+            "sliceCount": max(map(len, property_slices), default=0),
+            "rowCount": 0,
+            "requestCount": 0,
+        }
+    else:
+        states, finished, pending, chains = resumeFetch(checkpoint, query["columns"])
+        next_index = checkpoint["nextIndex"]
+        counts = {
+            key: checkpoint[key] for key in ("propertyCount", "sliceCount", "rowCount", "requestCount")
+        }
+    asset_codes, point_codes = getCategoryCodes(states)
+
+    # spread the entries over the workers before packing requests full, so small sites still run in parallel
+    unfinished = len(states) - sum(finished)
+    workers = max(1, min(workers, unfinished))
+    run = {
+        "states": states,
+        "pending": pending,
+        "chains": chains,
+        "suspended": [],
+        "completed": queue.Queue(),
+        "slots": max(1, min(MAX_BATCH_ENTRIES, -(-unfinished // workers))),
+        "query": query,
+        "governor": governor,
+        "shouldStop": should_stop,
+    }
+
+    # entries finish roughly in queue order. finished entries are passed on as soon as all entries before
+    # them are finished too, and their buffers are released, so only the entries in flight are held in memory
+    frames = []
+    ready = []
+    ready_rows = 0
+
+    def emit():
+        frame = buildHistoryFrame(ready, asset_codes, point_codes, query["columns"])
+        if sink is None:
+            frames.append(frame)
+        else:
+            sink(frame)
+        for state in ready:
+            state["timestamps"] = state["columns"] = None
+        ready.clear()
+
+    def collectFinished():
+        nonlocal next_index, ready_rows
+        while next_index < len(states) and finished[next_index]:
+            ready.append(states[next_index])
+            ready_rows += len(states[next_index]["timestamps"])
+            next_index += 1
+
+    collectFinished()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(runHistoryWorker, sitewise_client, run) for _ in range(workers)]
+        exited = 0
+        while next_index < len(states) and exited < workers:
+            state = run["completed"].get()
+            if state is WORKER_EXITED:
+                exited += 1
+                continue
+            if isinstance(state, Exception):
+                # let the other workers stop after their current request
+                pending.clear()
+                chains.clear()
+                raise state
+            finished[int(state["entryId"])] = True
+            collectFinished()
+            if ready_rows >= chunk_rows:
+                emit()
+                counts["rowCount"] += ready_rows
+                ready_rows = 0
+        counts["requestCount"] += sum(future.result() for future in futures)
+
+    # an empty site still produces one (empty) frame
+    if ready or (counts["rowCount"] == 0 and next_index == len(states)):
+        emit()
+        counts["rowCount"] += ready_rows
+
+    if next_index < len(states):
+        logger.info(
+            f"Suspended after {next_index} of {len(states)} entries, {counts['rowCount']} values "
+            f"and {counts['requestCount']} {query['operation']} calls"
+        )
+        return suspendFetch(states, finished, next_index, run, counts)
+
+    if watermarks is not None:
+        updateWatermarks(states, watermarks)
+    if failures is not None:
+        failures.extend(
+            (state["assetName"], state["pointName"], state["lowerBound"], state["upperBound"])
+            for state in states
+            if state["failed"]
+        )
+
+    logger.info(
+        f"Read {counts['rowCount']} values for {counts['propertyCount']} properties "
+        f"in {counts['sliceCount']} time slices "
+        f"in {counts['requestCount']} {query['operation']} calls using {workers} workers"
+    )
+    if sink is None:
+        return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+
+def fetchAggregates(sitewise_client, assetProperties, start_time, end_time, resolution, **kwargs):
+    """Reads count, average and standard deviation per interval instead of the raw values.
+
+    Takes the same arguments as fetchHistory, plus the aggregation resolution
+    (1m, 15m, 1h or 1d). The rows have the value columns count, mean and std,
+    and are stamped with the start of their interval.
+    """
+    return fetchHistory(
+        sitewise_client,
+        assetProperties,
+        start_time,
+        end_time,
+        query=getAggregatesQuery(resolution),
+        **kwargs,
+    )
+
+
+def fetchLatestTimestamps(sitewise_client, assetProperties, governor=None):
+    """Reads the timestamp of the latest value of every property with BatchGetAssetPropertyValue.
+
+    A single request covers up to 128 properties, so this costs a small fraction
+    of the history queries it can save.
+
+    Args:
+        sitewise_client: boto3 iotsitewise client (or a stand-in with the same method).
+        assetProperties (list): dict objects with keys assetName, assetSiteWiseId, pointName, pointSiteWiseId.
+        governor (RateGovernor): optional rate governor that every request waits for.
+
+    Returns:
+        dict: nanosecond timestamp of the latest value (None if the property has no value yet), keyed by
+        position in assetProperties. Properties whose entry failed are left out.
+    """
+    latest = {}
+    for batch_start in range(0, len(assetProperties), MAX_LATEST_VALUE_ENTRIES):
+        entries = [
+            {
+                "entryId": str(index),
+                "assetId": asset_property["assetSiteWiseId"],
+                "propertyId": asset_property["pointSiteWiseId"],
+            }
+            for index, asset_property in enumerate(
+                assetProperties[batch_start : batch_start + MAX_LATEST_VALUE_ENTRIES], batch_start
+            )
+        ]
+        nt = None
+        while True:
+            request = {"entries": entries}
+            if nt is not None:
+                request["nextToken"] = nt
+            response = callWithBackoff(
+                sitewise_client, "batch_get_asset_property_value", request, governor
+            )
+            for entry in response.get("successEntries", []):
+                value = entry.get("assetPropertyValue")
+                latest[int(entry["entryId"])] = (
+                    None
+                    if value is None
+                    else value["timestamp"]["timeInSeconds"] * 1_000_000_000
+                    + value["timestamp"].get("offsetInNanos", 0)
+                )
+            for entry in response.get("errorEntries", []):
+                logger.warning(
+                    f'Latest value of {assetProperties[int(entry["entryId"])]["pointSiteWiseId"]} '
+                    f'unavailable after {entry["errorCode"]}: {entry.get("errorMessage")}'
+                )
+            nt = response.get("nextToken")
+            if nt is None:
+                break
+    return latest
+
+
+def selectUpdatedProperties(assetProperties, latest, start_time, watermarks=None):
+    """Drops the properties that have no value after the start of the query range.
+
+    A property whose latest value is older than the start of the range (or not
+    newer than its watermark) cannot have a value that would be read. The start
+    second itself counts as inside, as it is part of the first request. Properties
+    whose latest value is unknown are kept, so a failed pre-check never loses data.
+
+    Args:
+        assetProperties (list): dict objects with keys assetName, assetSiteWiseId, pointName, pointSiteWiseId.
+        latest (dict): latest value timestamps by position (see fetchLatestTimestamps).
+        start_time (int or datetime): exclusive start of the query range.
+        watermarks (dict): optional nanosecond watermarks keyed by pointSiteWiseId.
+
+    Returns:
+        tuple: the properties to query, and the properties that were skipped.
+    """
+    start_nanos = getEpochSeconds(start_time) * 1_000_000_000
+    updated = []
+    skipped = []
+    for index, asset_property in enumerate(assetProperties):
+        if index not in latest:
+            updated.append(asset_property)
+            continue
+        watermark = (watermarks or {}).get(asset_property["pointSiteWiseId"], -1)
+        if latest[index] is not None and latest[index] >= start_nanos and latest[index] > watermark:
+            updated.append(asset_property)
+        else:
+            skipped.append(asset_property)
+    return updated, skipped
@@ -4,7 +4,6 @@ from aws_cdk import (
     aws_s3,
     aws_ec2 as ec2,
     aws_ecs as ecs,
-    aws_ecr as ecr,
     aws_batch as batch,
     aws_ecr_assets,
     aws_ssm as ssm,
@@ -14,14 +13,13 @@ from aws_cdk import (
     aws_cloudwatch as cloudwatch,
     aws_stepfunctions as sfn,
     aws_stepfunctions_tasks as tasks,
-    aws_codebuild as codebuild,
     aws_s3_deployment as s3deploy,
     aws_events as events,
     aws_events_targets as targets,
     Duration,
     aws_lambda_python_alpha as aws_alambda,
     Fn,
-    aws_kms as kms
+    aws_dynamodb as dynamodb
 )
 from cdk_nag import NagSuppressions, NagPackSuppression
 
@@ -60,7 +58,16 @@ class RetrainStack(cdk.Stack):
             block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL,
             encryption=aws_s3.BucketEncryption.S3_MANAGED,
             enforce_ssl=True,
-            object_ownership=aws_s3.ObjectOwnership.BUCKET_OWNER_PREFERRED
+            object_ownership=aws_s3.ObjectOwnership.BUCKET_OWNER_PREFERRED,
+            lifecycle_rules=[
+                # results parts the init function could not delete, e.g. when it timed out, and the old versions
+                # of the deleted ones
+                aws_s3.LifecycleRule(
+                    tag_filters={"results-part": "true"},
+                    expiration=Duration.days(7),
+                    noncurrent_version_expiration=Duration.days(1),
+                ),
+            ],
         )
         # bucket to hold inference/retrain data for inference/retraining process
         data_bucket = aws_s3.Bucket(
@@ -72,7 +79,16 @@ class RetrainStack(cdk.Stack):
             block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL,
             encryption=aws_s3.BucketEncryption.S3_MANAGED,
             enforce_ssl=True,
-            object_ownership=aws_s3.ObjectOwnership.BUCKET_OWNER_PREFERRED
+            object_ownership=aws_s3.ObjectOwnership.BUCKET_OWNER_PREFERRED,
+            # uploads and checkpoints left behind by extractions that failed for good, and claim check files,
+            # which are only read during their run. history files are rewritten by every compaction, so their
+            # replaced versions are not kept
+            lifecycle_rules=[
+                aws_s3.LifecycleRule(abort_incomplete_multipart_upload_after=Duration.days(7)),
+                aws_s3.LifecycleRule(prefix="checkpoints/", expiration=Duration.days(7)),
+                aws_s3.LifecycleRule(prefix="claims/", expiration=Duration.days(7)),
+                aws_s3.LifecycleRule(prefix="history/", noncurrent_version_expiration=Duration.days(1)),
+            ],
         )
 
         # upload sample sitewise data to s3
@@ -177,23 +193,12 @@ class RetrainStack(cdk.Stack):
         
         # add permissions for IotSitewise
         sitewise_statement = aws_iam.PolicyStatement(
-            actions=["iotsitewise:BatchGetAssetPropertyValueHistory"], resources=["*"]
-        )
-
-        # allowing function to invoke inference lambda
-        invoke_inference_lambda_statement = aws_iam.PolicyStatement(
-            actions=["lambda:InvokeFunction"],
-            resources=[
-                "arn:aws:lambda:"
-                + cdk.Aws.REGION
-                + ":"
-                + cdk.Aws.ACCOUNT_ID
-                + ":function:*-inference-lambda"
+            actions=[
+                "iotsitewise:BatchGetAssetPropertyValueHistory",
+                "iotsitewise:BatchGetAssetPropertyAggregates",
+                "iotsitewise:BatchGetAssetPropertyValue",
             ],
-        )
-
-        codebuild_statement = aws_iam.PolicyStatement(
-            actions=["codebuild:StartBuild", "codebuild:BatchGetBuilds"], resources=["*"]
+            resources=["*"],
         )
 
         vpc_statement = aws_iam.PolicyStatement(
@@ -223,12 +228,27 @@ class RetrainStack(cdk.Stack):
             environment={
                 "bucket": inference_results_bucket.bucket_name,
                 "data_bucket": data_bucket.bucket_name,
+                # send the inference functions S3 references to their data instead of the data
+                "claim_check": "true",
+                # one results object per site and run instead of one per point
+                "results_output": "site",
+                # a site is scored in a few invocations of up to 100 points and 100k values each. the
+                # payloads only hold claim check references, data sent inline would also be capped at
+                # inference_batch_bytes per invocation
+                "inference_batch_points": "100",
+                "inference_batch_rows": "100000",
+                # invocations of a site in flight at the same time, and their retries. an invocation waits a
+                # little longer than the inference function's timeout, so a timed out function is reported as
+                # its error, and never past the time the init function keeps to record the results
+                "inference_max_in_flight": "10",
+                "inference_timeout_seconds": "330",
+                "inference_retries": "2",
+                "results_margin_seconds": "120",
             },
             reserved_concurrent_executions=30,
             tracing=aws_lambda.Tracing.ACTIVE,
         )
         init_lambda.role.add_to_policy(kms_statement)
-        init_lambda.role.add_to_policy(invoke_inference_lambda_statement)
         
         NagSuppressions.add_resource_suppressions(
             construct=init_lambda,
@@ -252,39 +272,81 @@ class RetrainStack(cdk.Stack):
             apply_to_children = True,
         )
         
-        codebuild_lambda = aws_alambda.PythonFunction(
+        # lambda to approve the model a retrain uploaded, by pointing the site's approved model to it
+        model_approval_lambda = aws_alambda.PythonFunction(
             self,
-            "codebuild-function",
-            function_name="codebuild-function",
+            "model-approval-function",
+            function_name="model-approval-function",
             entry="./lambdas",
             runtime=aws_lambda.Runtime.PYTHON_3_9,
-            index="codebuild_lambda.py",
+            index="model_approval_lambda.py",
             handler="handler",
-            timeout=cdk.Duration.minutes(15),
+            timeout=cdk.Duration.minutes(1),
+            environment={
+                "model_artifact_bucket": model_artifact_bucket.bucket_name,
+            },
             reserved_concurrent_executions=30,
             tracing=aws_lambda.Tracing.ACTIVE,
         )
         
         NagSuppressions.add_resource_suppressions(
-            construct=codebuild_lambda,
+            construct=model_approval_lambda,
             suppressions=[
                 NagPackSuppression(
                     id="AwsSolutions-IAM4",
                     reason="This error is for policies that are CDK generated and is acceptable for use",
-                    )
+                    ),
+                NagPackSuppression(
+                    id="AwsSolutions-IAM5",
+                    reason="Suppression errors for policies with '*' in resource",
+                    ),
             ],
             apply_to_children=True,
         )
 
+        # request rate to SiteWise shared by all concurrent site_id_and_rtu_lambda invocations
+        sitewise_rate_governor_table = dynamodb.Table(
+            self,
+            "sitewise-rate-governor",
+            partition_key=dynamodb.Attribute(name="name", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            point_in_time_recovery=True,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        # lambda to merge the hourly inference extracts of a site into its history store
+        compaction_lambda = aws_alambda.PythonFunction(
+            self,
+            "compaction-function",
+            function_name="compaction-function",
+            entry="./lambdas",
+            runtime=aws_lambda.Runtime.PYTHON_3_9,
+            index="compaction_lambda.py",
+            handler="handler",
+            timeout=cdk.Duration.minutes(15),
+            environment={
+                "data_bucket": data_bucket.bucket_name,
+                "history_granularity": "day",
+            },
+            memory_size=1024,
+            reserved_concurrent_executions=30,
+            tracing=aws_lambda.Tracing.ACTIVE,
+        )
+        compaction_lambda.role.add_to_policy(kms_statement)
+
         NagSuppressions.add_resource_suppressions(
-            construct=codebuild_lambda,
+            construct=compaction_lambda,
             suppressions=[
                 NagPackSuppression(
-                    id="AwsSolutions-IAM5",
+                    id="AwsSolutions-IAM4", 
+                    reason="This error is for policies that are CDK generated and is acceptable for use",
+                    ),
+                NagPackSuppression(
+                    id="AwsSolutions-IAM5", 
                     reason="Suppression errors for policies with '*' in resource",
-                    )
+                    ),
             ],
-            apply_to_children = True,
+            apply_to_children=True,
         )
 
         # helper lambda to get site ids and rtus
@@ -303,6 +365,24 @@ class RetrainStack(cdk.Stack):
                 "bucket": inference_results_bucket.bucket_name,
                 "data_bucket": data_bucket.bucket_name,
                 "neptune_cluster_writer_endpoint": neptune_cluster_writer_endpoint,
+                "sitewise_fetch_workers": "8",
+                "history_slice_seconds": "86400",
+                "incremental_extraction": "false",
+                "retrain_extraction_mode": "raw",
+                "aggregate_resolution": "1h",
+                "skip_unchanged_points": "true",
+                "data_format": "partitioned",
+                # extractions that would outlast the timeout are checkpointed this long before it
+                "checkpoint_margin_seconds": "120",
+                "rate_governor_table": sitewise_rate_governor_table.table_name,
+                # requests per second per SiteWise API, shared by all sites
+                "sitewise_max_request_rate": "10",
+                # retrain extractions read the history compacted from inference extracts, and SiteWise for the gaps
+                "history_store": "true",
+                # seconds per value after downsampling, 0 keeps every raw value
+                "resample_interval_seconds": "0",
+                # the sample data loaded into SiteWise ends at this time. set to "now" for live data
+                "query_end_time": "1652732267",
             },
             memory_size=1024,
             reserved_concurrent_executions=30,
@@ -311,6 +391,7 @@ class RetrainStack(cdk.Stack):
         site_id_and_rtu_lambda.role.add_to_policy(sitewise_statement)
         site_id_and_rtu_lambda.role.add_to_policy(kms_statement)
         site_id_and_rtu_lambda.role.add_managed_policy(vpc_statement)
+        sitewise_rate_governor_table.grant_read_write_data(site_id_and_rtu_lambda)
         
         NagSuppressions.add_resource_suppressions(
             construct=site_id_and_rtu_lambda,
@@ -400,8 +481,11 @@ class RetrainStack(cdk.Stack):
         data_bucket.grant_read_write(site_id_lambda)
         data_bucket.grant_read_write(site_id_and_rtu_lambda)
         data_bucket.grant_read_write(init_lambda)
+        data_bucket.grant_read_write(compaction_lambda)
+        # the init lambda keeps the results report of every site in the results bucket
+        inference_results_bucket.grant_read_write(init_lambda)
 
-        codebuild_lambda.role.add_to_policy(codebuild_statement)
+        model_artifact_bucket.grant_read_write(model_approval_lambda)
 
         # deploy retrain EC2 in public subnet so it has internet access and to save cost on NAT Gateway. The subnet sg allows no inbound traffic for security.
         retrain_subnet_configuration = ec2.SubnetConfiguration(
@@ -536,8 +620,9 @@ class RetrainStack(cdk.Stack):
                     batch.CfnJobDefinition.ResourceRequirementProperty(
                         type="VCPU", value="4"
                     ),
+                    # the streaming training mode only holds one chunk and the per-sensor statistics
                     batch.CfnJobDefinition.ResourceRequirementProperty(
-                        type="MEMORY", value="30720"
+                        type="MEMORY", value="4096"
                     ),
                 ],
             ),
@@ -560,166 +645,35 @@ class RetrainStack(cdk.Stack):
         )
 
         inference_results_bucket.grant_read_write(inference_lambda_execution_role)
-
-        # codebuild step to compile inference image and push to ECR
-        codebuild_artifacts_bucket = aws_s3.Bucket(
-            self,
-            "codebuild-bucket",
-            bucket_name="retrain-codebuild-artifacts-bucket-" + cdk.Aws.ACCOUNT_ID,
-            versioned=True,
-            server_access_logs_prefix="logs_",
-            block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL,
-            encryption=aws_s3.BucketEncryption.S3_MANAGED,
-            enforce_ssl=True,
-            object_ownership=aws_s3.ObjectOwnership.BUCKET_OWNER_PREFERRED
-        )
-
-        inference_image_codebuild_bucket_deployment = s3deploy.BucketDeployment(
-            self,
-            "inference-image-populate-codebuild-artifacts-bucket",
-            sources=[
-                s3deploy.Source.asset("inference_lambda"),
-                s3deploy.Source.asset("inference_image_codebuild"),
-            ],
-            destination_bucket=codebuild_artifacts_bucket,
-            destination_key_prefix="source-inference-image-build",
-        )
-
-        inference_lambda_update_codebuild_bucket_deployment = s3deploy.BucketDeployment(
-            self,
-            "inference-lambda-update-populate-codebuild-artifacts-bucket",
-            sources=[
-                s3deploy.Source.asset("create_or_update_inference_lambda_codebuild")
-            ],
-            destination_bucket=codebuild_artifacts_bucket,
-            destination_key_prefix="source-inference-lambda-update",
-        )
-        
-        inference_image_codebuild_s3_source = codebuild.Source.s3(
-            bucket=codebuild_artifacts_bucket, path="source-inference-image-build/"
-        )
-
-        inference_lambda_update_codebuild_s3_source = codebuild.Source.s3(
-            bucket=codebuild_artifacts_bucket, path="source-inference-lambda-update/"
-        )
-
-        retrained_inference_ecr = ecr.Repository(
-            self, "retrained-inference-ecr", repository_name="retrained-inference-ecr"
-        )
-
-        codebuild_encryption_key = kms.Key(self, "codebuild-encryption", enable_key_rotation=True
-        )
-
-        inference_image_build_project = codebuild.Project(
-            self,
-            "inference-image-build-project",
-            project_name="inference-image-build-project",
-            source=inference_image_codebuild_s3_source,
-            environment=codebuild.BuildEnvironment(privileged=True), #must run as true to connect to docker daemon
-            environment_variables={
-                "AWS_ACCOUNT_ID": codebuild.BuildEnvironmentVariable(
-                    value=cdk.Aws.ACCOUNT_ID
-                ),
-                "IMAGE_REPO_NAME": codebuild.BuildEnvironmentVariable(
-                    value=retrained_inference_ecr.repository_name
-                ),
-                "MODEL_ARTIFACTS_BUCKET": codebuild.BuildEnvironmentVariable(
-                    value=model_artifact_bucket.bucket_name
-                ),
+        # claim check payloads point the inference functions to their data in the data bucket
+        data_bucket.grant_read(inference_lambda_execution_role)
+
+        # inference function shared by all sites. it loads the approved model of the site it is invoked for
+        # from the model artifact bucket, so a retrained model is deployed by approving it, without a build
+        inference_lambda = aws_lambda.DockerImageFunction(
+            self,
+            "inference-function",
+            function_name="inference-lambda",
+            code=aws_lambda.DockerImageCode.from_image_asset("inference_lambda"),
+            role=inference_lambda_execution_role,
+            memory_size=10240,
+            # a shard is scored well within this, which leaves the init function time to repeat a failed one
+            timeout=cdk.Duration.minutes(5),
+            environment={
+                "bucket": inference_results_bucket.bucket_name,
+                "model_artifact_bucket": model_artifact_bucket.bucket_name,
+                # site models kept in memory between invocations, and how often a cached one is checked
+                "model_cache_size": "32",
+                "model_refresh_seconds": "60",
+                "timestream_db_name": "testdb",
+                "timestream_table_name": "test_eo",
             },
-            encryption_key=codebuild_encryption_key
-        )
-        NagSuppressions.add_resource_suppressions(
-            construct=inference_image_build_project,
-            suppressions=[
-                NagPackSuppression(
-                    id="AwsSolutions-IAM5",
-                    reason="Suppression errors for policies with '*' in resource",
-                    )
-            ],
-            apply_to_children=True,
+            tracing=aws_lambda.Tracing.ACTIVE,
         )
+        model_artifact_bucket.grant_read(inference_lambda_execution_role)
+        inference_lambda.grant_invoke(init_lambda)
+        init_lambda.add_environment("inference_function_name", inference_lambda.function_name)
 
-        model_artifact_bucket.grant_read(inference_image_build_project.role)
-        codebuild_artifacts_bucket.grant_read(inference_image_build_project.role)
-        retrained_inference_ecr.grant_pull_push(inference_image_build_project.role)
-
-        # codebuild step to create/update inference lambda using ECR image
-        create_or_update_inference_lambda_project = codebuild.Project(
-            self,
-            "create-or-update-inference-lambda-project",
-            project_name="create-or-update-inference-lambda-project",
-            source=inference_lambda_update_codebuild_s3_source,
-            environment_variables={
-                "AWS_ACCOUNT_ID": codebuild.BuildEnvironmentVariable(
-                    value=cdk.Aws.ACCOUNT_ID
-                ),
-                "IMAGE_REPO_NAME": codebuild.BuildEnvironmentVariable(
-                    value=retrained_inference_ecr.repository_name
-                ),
-                "INFERENCE_IMAGE_URI": codebuild.BuildEnvironmentVariable(
-                    value=cdk.Aws.ACCOUNT_ID
-                    + ".dkr.ecr."
-                    + cdk.Aws.REGION
-                    + ".amazonaws.com/"
-                    + retrained_inference_ecr.repository_name
-                ),
-                "INFERENCE_LAMBDA_EXECUTION_ROLE_ARN": codebuild.BuildEnvironmentVariable(
-                    value=inference_lambda_execution_role.role_arn
-                ),
-                "INFERENCE_RESULTS_ARTIFACTS_BUCKET": codebuild.BuildEnvironmentVariable(
-                    value=inference_results_bucket.bucket_name
-                )
-            },
-            environment=codebuild.BuildEnvironment(
-                privileged = False
-            ),
-            encryption_key=codebuild_encryption_key
-        )
-        create_or_update_inference_lambda_project.role.attach_inline_policy(
-            aws_iam.Policy(
-                self,
-                "inference-lambda-update-policy",
-                statements=[
-                    aws_iam.PolicyStatement(
-                        actions=[
-                            "lambda:GetFunction",
-                            "lambda:CreateFunction",
-                            "lambda:UpdateFunctionCode",
-                        ],
-                        resources=[f"arn:aws:lambda:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:function:*"],
-                    ),
-                    aws_iam.PolicyStatement(
-                        actions=["iam:GetRole", "iam:PassRole"],
-                        resources=[inference_lambda_execution_role.role_arn],
-                    ),
-                    aws_iam.PolicyStatement(
-                        actions=["kms:*"],
-                        resources=[codebuild_encryption_key.key_arn],
-                    ),
-                ],
-            )
-        )
-        create_or_update_inference_lambda_project.role.attach_inline_policy(
-            aws_iam.Policy(
-                self,
-                "inference-lambda-update-ecr-access-policy",
-                statements=[
-                    aws_iam.PolicyStatement(
-                        actions=["ecr:BatchGetImage", "ecr:SetRepositoryPolicy", "ecr:GetRepositoryPolicy", "ecr:PutImage"],
-                        resources=[retrained_inference_ecr.repository_arn],
-                    ),
-                    aws_iam.PolicyStatement(
-                        actions=["ecr:GetAuthorizationToken"], resources=["*"]
-                    ),
-                    aws_iam.PolicyStatement(
-                        actions=["kms:*"],
-                        resources=[codebuild_encryption_key.key_arn],
-                    ),
-                ],
-            )
-        )
-        
         NagSuppressions.add_resource_suppressions(
             construct=inference_lambda_execution_role,
             suppressions=[
@@ -732,11 +686,7 @@ class RetrainStack(cdk.Stack):
         )
 
         NagSuppressions.add_resource_suppressions(
-            construct=[
-                inference_lambda_execution_role, 
-                create_or_update_inference_lambda_project, 
-                create_or_update_inference_lambda_project.role,
-                ],
+            construct=inference_lambda_execution_role,
             suppressions=[
                 NagPackSuppression(
                     id="AwsSolutions-IAM5",
@@ -745,13 +695,8 @@ class RetrainStack(cdk.Stack):
             ],
             apply_to_children = True,
         )
-               
-        # allowing the create or update inference lambda project to read the codebuild artifacts bucket
-        codebuild_artifacts_bucket.grant_read(
-            create_or_update_inference_lambda_project.role
-        )
 
-        # step function to tie batch retrain task and codebuild image build task together. change out to use resultspath
+        # step function to tie batch retrain task and model approval task together. change out to use resultspath
         site_id_task = tasks.LambdaInvoke(
             self, "Get Site IDs for model retraining", lambda_function=site_id_lambda
         )
@@ -782,6 +727,7 @@ class RetrainStack(cdk.Stack):
                     "pipeline_type": sfn.JsonPath.string_at("$.Payload.pipeline_type"),
                     "data_bucket": data_bucket.bucket_name,
                     "model_artifact_bucket": model_artifact_bucket.bucket_name,
+                    "training_mode": "streaming",
                 }
             ),
             result_path=sfn.JsonPath.string_at("$.result"),
@@ -811,36 +757,33 @@ class RetrainStack(cdk.Stack):
 
         model_map.iterator(site_id_and_rtu_task)
 
-        inference_image_update_task = tasks.LambdaInvoke(
+        approve_model_task = tasks.LambdaInvoke(
             self,
-            "inference-image-update",
-            lambda_function=codebuild_lambda,
+            "approve-model",
+            lambda_function=model_approval_lambda,
             payload=sfn.TaskInput.from_object(
                 {
-                    "project_name": inference_image_build_project.project_name,
                     "site_id": sfn.JsonPath.string_at("$.Payload.site_id"),
                 }
             ),
             result_path=sfn.JsonPath.string_at("$.result"),
         )
 
-        create_or_update_inference_lambda_task = tasks.LambdaInvoke(
-            self,
-            "create-or-update-inference-lambda",
-            lambda_function=codebuild_lambda,
-            payload=sfn.TaskInput.from_object(
-                {
-                    "project_name": create_or_update_inference_lambda_project.project_name,
-                    "site_id": sfn.JsonPath.string_at("$.Payload.site_id"),
-                }
-            ),
-            result_path=sfn.JsonPath.string_at("$.result"),
+        # a site extraction that does not fit into one invocation returns the CONTINUE status and is invoked
+        # again with its own output, until it completes
+        site_id_and_rtu_task_continue = sfn.Pass(
+            self, "Continue site data extraction", input_path="$.Payload"
+        )
+        site_id_and_rtu_task_continue.next(site_id_and_rtu_task)
+        site_id_and_rtu_task_complete = sfn.Choice(self, "Site data extraction complete?")
+        site_id_and_rtu_task_complete.when(
+            sfn.Condition.string_equals("$.Payload.status", "CONTINUE"), site_id_and_rtu_task_continue
         )
+        site_id_and_rtu_task_complete.otherwise(retrain_batch_task)
 
         # defining the sequence of events inside map state
-        site_id_and_rtu_task.next(retrain_batch_task)
-        retrain_batch_task.next(inference_image_update_task)
-        inference_image_update_task.next(create_or_update_inference_lambda_task)
+        site_id_and_rtu_task.next(site_id_and_rtu_task_complete)
+        retrain_batch_task.next(approve_model_task)
         retrain_definition = site_id_task.next(model_map)
 
         # creating a log group for the step function
@@ -898,9 +841,47 @@ class RetrainStack(cdk.Stack):
         init_job.add_catch(init_job_value_error, errors=["ValueError"])
         init_job.add_catch(init_job_failed)
         init_job_succeeded = sfn.Pass(self, "Init Job Succeeded")
-        init_job.next(init_job_succeeded)
+        # points that could not be scored are listed in the output of the init job
+        init_job_partially_failed = sfn.Pass(self, "Init Job Could Not Score All Points")
+        init_job_scored_nothing = sfn.Fail(
+            self,
+            "Init Job Could Not Score Any Point",
+            error="InferenceFailed",
+            cause="No point of the site could be scored, the init job output lists the errors",
+        )
+        init_job_complete = sfn.Choice(self, "Init Job scored all points?")
+        init_job_complete.when(
+            sfn.Condition.string_equals("$.Payload.status", "FAILED"), init_job_scored_nothing
+        )
+        init_job_complete.when(
+            sfn.Condition.string_equals("$.Payload.status", "PARTIAL"), init_job_partially_failed
+        )
+        init_job_complete.otherwise(init_job_succeeded)
+        init_job.next(init_job_complete)
+
+        # the extract is merged into the site's history store while inference runs on it
+        compaction_job = tasks.LambdaInvoke(
+            self, "Compaction Job", lambda_function=compaction_lambda
+        )
+        compaction_job_failed = sfn.Pass(self, "Compaction Job Caught Exception")
+        compaction_job.add_catch(compaction_job_failed)
+        inference_and_compaction = sfn.Parallel(
+            self, "Inference and Compaction", output_path=sfn.JsonPath.DISCARD
+        )
+        inference_and_compaction.branch(init_job)
+        inference_and_compaction.branch(compaction_job)
+
+        site_id_and_rtu_job_continue = sfn.Pass(
+            self, "Continue Site ID and RTU Job", input_path="$.Payload"
+        )
+        site_id_and_rtu_job_continue.next(site_id_and_rtu_job)
+        site_id_and_rtu_job_complete = sfn.Choice(self, "Site ID and RTU Job complete?")
+        site_id_and_rtu_job_complete.when(
+            sfn.Condition.string_equals("$.Payload.status", "CONTINUE"), site_id_and_rtu_job_continue
+        )
+        site_id_and_rtu_job_complete.otherwise(inference_and_compaction)
 
-        site_id_and_rtu_job.next(init_job)
+        site_id_and_rtu_job.next(site_id_and_rtu_job_complete)
 
         infer_definition = site_id_job.next(rtu_map)
 
@@ -993,8 +974,6 @@ class RetrainStack(cdk.Stack):
                 "RetrainStack/Custom::CDKBucketDeployment8693BB64968944B69AAFB0CC9EB8756C/ServiceRole/DefaultPolicy/Resource",
                 "RetrainStack/Custom::CDKBucketDeployment8693BB64968944B69AAFB0CC9EB8756C/ServiceRole/Resource",
                 "RetrainStack/neptune-read-from-s3/Resource",
-                "RetrainStack/inference-lambda-update-policy/Resource",
-                "RetrainStack/inference-lambda-update-ecr-access-policy/Resource",
                 "RetrainStack/LogRetentionaae0aa3c5b4d4f87b02d85b201efdd8a/ServiceRole/Resource",
                 "RetrainStack/LogRetentionaae0aa3c5b4d4f87b02d85b201efdd8a/ServiceRole/DefaultPolicy/Resource",
             ],
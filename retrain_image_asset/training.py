@@ -1,24 +1,384 @@
 import os
+import json
 import boto3
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
+# delta degrees of freedom of the standard deviations in SiteWise aggregates
+AGGREGATE_STD_DDOF = 0
+# partition keys of the partitioned layout and the columns they stand for
+PARTITION_COLUMNS = {"asset": "assetname", "point": "pointname"}
+# number of partitions of a partitioned dataset read at the same time
+PARTITION_READ_WORKERS = 8
+# column types of site data, as in lambdas/site_schema.py, which the image is built without. tests/test_site_schema.py
+# checks that the two agree. the repeated asset and point names are categorical, timestamps int64 nanoseconds and
+# values float64, which the statistics are computed in
+CATEGORY_COLUMNS = ("assetname", "pointname")
+TIMESTAMP_COLUMN = "timestamp"
+VALUE_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+CSV_DTYPES = {"assetname": "category", "pointname": "category", "timestamp": np.int64}
+# rows per chunk of the streaming training mode
+CHUNK_ROWS = 1_000_000
 
-def readFromS3(site_id, s3_bucket_name, pipeline_type, event_id):
+
+def apply_schema(data):
+    """Converts site data to the pipeline's column types. Columns that already have their type are not copied."""
+    columns = {}
+    for column in data.columns:
+        if column in CATEGORY_COLUMNS:
+            if not isinstance(data[column].dtype, pd.CategoricalDtype):
+                columns[column] = data[column].astype("category")
+        elif column == TIMESTAMP_COLUMN:
+            if data[column].dtype != np.int64:
+                columns[column] = data[column].astype(np.int64)
+        elif data[column].dtype != np.float64:
+            columns[column] = data[column].astype(np.float64)
+    if not columns:
+        return data
+    return data.assign(**columns)
+
+
+def validate_schema(data):
+    """Raises ValueError if site data does not have the pipeline's column types. Returns the data."""
+    errors = []
+    for column in data.columns:
+        dtype = data[column].dtype
+        if column in CATEGORY_COLUMNS:
+            if not isinstance(dtype, pd.CategoricalDtype):
+                errors.append(f"{column} is {dtype}, not category")
+        elif column == TIMESTAMP_COLUMN:
+            if dtype != np.int64:
+                errors.append(f"{column} is {dtype}, not int64")
+        elif dtype not in VALUE_DTYPES:
+            errors.append(f"{column} is {dtype}, not float32 or float64")
+    missing = [column for column in CATEGORY_COLUMNS + (TIMESTAMP_COLUMN,) if column not in data.columns]
+    if missing:
+        errors.append(f"missing columns {', '.join(missing)}")
+    if errors:
+        raise ValueError("Site data does not match the schema: " + "; ".join(errors))
+    return data
+
+
+def concat_frames(frames):
+    """Concatenates site data without turning the categorical columns into strings, which
+    pandas.concat does unless all frames have the same categories."""
+    frames = list(frames)
+    for column in CATEGORY_COLUMNS:
+        if not any(column in frame.columns for frame in frames):
+            continue
+        categories = pd.api.types.union_categoricals(
+            [frame[column].astype("category") for frame in frames if column in frame.columns]
+        ).categories
+        frames = [
+            frame.assign(**{column: pd.Categorical(frame[column], categories=categories)})
+            if column in frame.columns
+            else frame
+            for frame in frames
+        ]
+    return pd.concat(frames, ignore_index=True)
+
+
+def readFromS3(site_id, s3_bucket_name, pipeline_type, event_id, columns=None):
     """Reads a file from S3
 
+    The data is read from the site's Parquet part files if the extraction wrote
+    them, and from its CSV file otherwise.
+
     Args:
         site_id (str): The identifier of the building/site that this model pertains to.
         s3_bucket_name (str): Name of the S3 bucket the object is in.
         pipeline_type (str): Type of the pipeline (either inference or retrain)
         event_id (str): Unique identifier for the stepfunction event
+        columns (list): optional columns to read. Parquet files are only read for these columns.
 
     Returns:
         dataframe: data from s3.
     """
-    filepath = f"s3://{s3_bucket_name}/{pipeline_type}/{event_id}/{site_id}.csv"
-    data = pd.read_csv(filepath_or_buffer=filepath)
-    return data
+    manifest = read_watermark_manifest(site_id, s3_bucket_name, pipeline_type)
+    if manifest is not None and any(
+        increment["event_id"] == event_id for increment in manifest["increments"]
+    ):
+        return read_increments(manifest, s3_bucket_name, columns)
+    prefix = f"{pipeline_type}/{event_id}/{site_id}/"
+    if not has_parquet_parts(s3_bucket_name, prefix):
+        prefix = f"{pipeline_type}/{event_id}/{site_id}.csv"
+    return read_data(s3_bucket_name, prefix, columns)
+
+
+def has_parquet_parts(s3_bucket_name, prefix):
+    """Tells whether the extraction wrote Parquet part files under prefix."""
+    s3 = boto3.client("s3")
+    response = s3.list_objects_v2(Bucket=s3_bucket_name, Prefix=prefix, MaxKeys=1)
+    return response.get("KeyCount", 0) > 0
+
+
+def read_partition_manifest(s3_bucket_name, prefix):
+    """Reads the manifest of a partitioned dataset, or returns None if the data under prefix is not partitioned."""
+    s3 = boto3.client("s3")
+    try:
+        response = s3.get_object(Bucket=s3_bucket_name, Key=prefix + "_manifest.json")
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(response["Body"].read())
+
+
+def read_data(s3_bucket_name, key, columns=None, min_timestamp=None):
+    """Reads extracted data, either a CSV file or the prefix of a set of Parquet part files.
+
+    Args:
+        s3_bucket_name (str): Name of the S3 bucket the data is in.
+        key (str): key of the CSV file, or prefix (ending in "/") of the Parquet files, which may be
+            partitioned by asset and point.
+        columns (list): optional columns to read.
+        min_timestamp (int): optional nanosecond timestamp of the oldest row to keep. Parquet row
+            groups that only hold older rows are skipped.
+
+    Returns:
+        dataframe: data from s3, without the CSV index column, with the column types of apply_schema.
+    """
+    filepath = f"s3://{s3_bucket_name}/{key}"
+    if key.endswith("/"):
+        manifest = read_partition_manifest(s3_bucket_name, key)
+        if manifest is None:
+            filters = None if min_timestamp is None else [("timestamp", ">=", min_timestamp)]
+            return apply_schema(pd.read_parquet(filepath, columns=columns, filters=filters))
+        columns = list(columns) if columns is not None else manifest["columns"]
+        # partitions that are empty, or whose data is all older than min_timestamp, are not read
+        partitions = [
+            partition
+            for partition in manifest["partitions"]
+            if partition["rows"] > 0
+            and (min_timestamp is None or partition["maxTimestamp"] >= min_timestamp)
+        ]
+        with ThreadPoolExecutor(max_workers=PARTITION_READ_WORKERS) as executor:
+            frames = list(
+                executor.map(
+                    lambda partition: read_partition(
+                        filepath + partition["path"], partition, columns, min_timestamp
+                    ),
+                    partitions,
+                )
+            )
+        if not frames:
+            return apply_schema(pd.DataFrame({column: [] for column in columns}))
+        return concat_frames(frames)
+
+    usecols = lambda column: column != "Unnamed: 0"
+    if columns is not None:
+        usecols = list(dict.fromkeys(list(columns) + (["timestamp"] if min_timestamp is not None else [])))
+    data = pd.read_csv(filepath_or_buffer=filepath, usecols=usecols, dtype=CSV_DTYPES)
+    if min_timestamp is not None:
+        data = data[data["timestamp"] >= min_timestamp].reset_index(drop=True)
+    if columns is not None:
+        data = data[list(columns)]
+    return apply_schema(data)
+
+
+def read_watermark_manifest(site_id, s3_bucket_name, pipeline_type):
+    """Reads the watermark manifest written by incremental extraction runs.
+
+    Args:
+        site_id (str): The identifier of the building/site that this model pertains to.
+        s3_bucket_name (str): Name of the S3 bucket the object is in.
+        pipeline_type (str): Type of the pipeline (either inference or retrain)
+
+    Returns:
+        dict: the manifest, or None if the site was never extracted incrementally.
+    """
+    s3 = boto3.client("s3")
+    try:
+        response = s3.get_object(
+            Bucket=s3_bucket_name, Key=f"watermarks/{pipeline_type}/{site_id}.json"
+        )
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(response["Body"].read())
+
+
+def read_partition(filepath, partition, columns, min_timestamp=None):
+    """Reads one asset/point partition and adds the asset and point names its path stands for.
+
+    Args:
+        filepath (str): s3 path of the partition.
+        partition (dict): the partition, as listed in the manifest.
+        columns (list): columns to read.
+        min_timestamp (int): optional nanosecond timestamp of the oldest row to keep.
+
+    Returns:
+        dataframe: data of the partition.
+    """
+    data = pd.read_parquet(
+        filepath,
+        columns=[column for column in columns if column not in PARTITION_COLUMNS.values()],
+        filters=None if min_timestamp is None else [("timestamp", ">=", min_timestamp)],
+    )
+    codes = np.zeros(len(data), dtype=np.int8)
+    data.insert(0, "assetname", pd.Categorical.from_codes(codes, [partition["assetname"]]))
+    data.insert(1, "pointname", pd.Categorical.from_codes(codes, [partition["pointname"]]))
+    return apply_schema(data[columns])
+
+
+def read_increments(manifest, s3_bucket_name, columns=None):
+    """Combines the increments listed in a watermark manifest into the data of the whole time window.
+
+    Args:
+        manifest (dict): watermark manifest of the site.
+        s3_bucket_name (str): Name of the S3 bucket the increments are in.
+        columns (list): optional columns to read.
+
+    Returns:
+        dataframe: data from s3.
+    """
+    increments = [
+        read_data(s3_bucket_name, increment["key"], columns, min_timestamp=manifest["windowStart"])
+        for increment in manifest["increments"]
+    ]
+    return concat_frames(increments)
+
+
+def iter_parquet(filepath, columns=None, min_timestamp=None, chunk_rows=CHUNK_ROWS):
+    """Reads Parquet files as a sequence of frames of at most chunk_rows rows, one record batch at a time."""
+    dataset = ds.dataset(filepath, format="parquet")
+    row_filter = None if min_timestamp is None else ds.field("timestamp") >= min_timestamp
+    for batch in dataset.to_batches(columns=columns, filter=row_filter, batch_size=chunk_rows):
+        yield apply_schema(batch.to_pandas())
+
+
+def iter_data(s3_bucket_name, key, columns=None, min_timestamp=None, chunk_rows=CHUNK_ROWS):
+    """Reads extracted data like read_data, as a sequence of frames of at most chunk_rows rows.
+
+    Partitions are read one after the other, so only one chunk is held in memory at a time.
+
+    Yields:
+        dataframe: the next chunk, with the column types of apply_schema.
+    """
+    filepath = f"s3://{s3_bucket_name}/{key}"
+    if key.endswith("/"):
+        manifest = read_partition_manifest(s3_bucket_name, key)
+        if manifest is None:
+            yield from iter_parquet(filepath, columns, min_timestamp, chunk_rows)
+            return
+        columns = list(columns) if columns is not None else manifest["columns"]
+        value_columns = [column for column in columns if column not in PARTITION_COLUMNS.values()]
+        for partition in manifest["partitions"]:
+            if partition["rows"] == 0 or (
+                min_timestamp is not None and partition["maxTimestamp"] < min_timestamp
+            ):
+                continue
+            for chunk in iter_parquet(
+                filepath + partition["path"], value_columns, min_timestamp, chunk_rows
+            ):
+                codes = np.zeros(len(chunk), dtype=np.int8)
+                chunk.insert(0, "assetname", pd.Categorical.from_codes(codes, [partition["assetname"]]))
+                chunk.insert(1, "pointname", pd.Categorical.from_codes(codes, [partition["pointname"]]))
+                yield chunk[columns]
+        return
+
+    usecols = lambda column: column != "Unnamed: 0"
+    if columns is not None:
+        usecols = list(dict.fromkeys(list(columns) + (["timestamp"] if min_timestamp is not None else [])))
+    for chunk in pd.read_csv(filepath, usecols=usecols, dtype=CSV_DTYPES, chunksize=chunk_rows):
+        if min_timestamp is not None:
+            chunk = chunk[chunk["timestamp"] >= min_timestamp]
+        if columns is not None:
+            chunk = chunk[list(columns)]
+        yield apply_schema(chunk)
+
+
+def iter_from_s3(site_id, s3_bucket_name, pipeline_type, event_id, columns=None, chunk_rows=CHUNK_ROWS):
+    """Reads the same data as readFromS3, as a sequence of frames of at most chunk_rows rows."""
+    manifest = read_watermark_manifest(site_id, s3_bucket_name, pipeline_type)
+    if manifest is not None and any(
+        increment["event_id"] == event_id for increment in manifest["increments"]
+    ):
+        for increment in manifest["increments"]:
+            yield from iter_data(
+                s3_bucket_name, increment["key"], columns, manifest["windowStart"], chunk_rows
+            )
+        return
+    prefix = f"{pipeline_type}/{event_id}/{site_id}/"
+    if not has_parquet_parts(s3_bucket_name, prefix):
+        prefix = f"{pipeline_type}/{event_id}/{site_id}.csv"
+    yield from iter_data(s3_bucket_name, prefix, columns, chunk_rows=chunk_rows)
+
+
+def chunk_statistics(data_df):
+    """Count, mean and sum of squared deviations from the mean (m2) per sensor of one chunk.
+
+    Raw values and the per-interval count, mean and std of the aggregates extraction
+    mode are both reduced to the same statistics, which merge_statistics combines.
+
+    Returns:
+        dataframe: columns count, mean and m2, indexed by assetname and pointname.
+    """
+    if "count" in data_df.columns:
+        data_df = data_df[data_df["count"] > 0]
+        keys = [data_df["assetname"], data_df["pointname"]]
+        count = data_df["count"]
+        total = count.groupby(keys, observed=True).sum()
+        mean = (count * data_df["mean"]).groupby(keys, observed=True).sum() / total
+        interval_mean = mean.reindex(pd.MultiIndex.from_arrays(keys)).to_numpy()
+        squares = data_df["std"].fillna(0) ** 2 * (count - AGGREGATE_STD_DDOF)
+        squares = squares + count * (data_df["mean"] - interval_mean) ** 2
+        m2 = squares.groupby(keys, observed=True).sum()
+    else:
+        values = data_df["value"].groupby([data_df["assetname"], data_df["pointname"]], observed=True)
+        total = values.count()
+        mean = values.mean()
+        m2 = values.var(ddof=0) * total
+    # the categories differ between chunks, so the statistics are keyed by the plain names
+    index = pd.MultiIndex.from_arrays(
+        [total.index.get_level_values(level).astype(str) for level in (0, 1)],
+        names=["assetname", "pointname"],
+    )
+    total, mean, m2 = (series.set_axis(index) for series in (total, mean, m2))
+    return pd.DataFrame({"count": total.astype(np.float64), "mean": mean, "m2": m2})
+
+
+def merge_statistics(totals, chunk):
+    """Combines the statistics of two sets of values per sensor (Chan et al.'s parallel algorithm)."""
+    if totals is None:
+        return chunk
+    index = totals.index.union(chunk.index)
+    totals = totals.reindex(index).fillna(0)
+    chunk = chunk.reindex(index).fillna(0)
+    count = totals["count"] + chunk["count"]
+    delta = chunk["mean"] - totals["mean"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = totals["mean"] + delta * (chunk["count"] / count)
+        m2 = totals["m2"] + chunk["m2"] + delta**2 * (totals["count"] * chunk["count"] / count)
+    return pd.DataFrame({"count": count, "mean": mean, "m2": m2})
+
+
+def create_model_streaming(chunks):
+    """calculates the mean and standard deviation for each sensor from a sequence of
+    chunks, keeping only running statistics per sensor, so memory does not grow with
+    the number of values. The result matches create_model (or create_model_from_aggregates)
+    on the whole data, up to floating point rounding.
+
+    Args:
+        chunks: dataframes of raw values, or of aggregates, e.g. from iter_from_s3.
+
+    Returns:
+        dataframe: dataframe containing mean and std for each device
+    """
+    totals = None
+    for chunk in chunks:
+        totals = merge_statistics(totals, chunk_statistics(chunk))
+    if totals is None:
+        return pd.DataFrame(columns=["assetname", "pointname", "mean", "std"])
+    totals = totals.sort_index()
+    count = totals["count"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std = np.sqrt(totals["m2"] / (count - 1))
+    std[count <= 1] = float("nan")
+    mean = totals["mean"].where(count > 0)
+    result_df = pd.DataFrame({"mean": mean, "std": std}).reset_index()
+    result_df.columns = ["assetname", "pointname", "mean", "std"]
+    return result_df
 
 
 def create_model(data_df):
@@ -31,7 +391,7 @@ def create_model(data_df):
     Returns:
         dataframe: dataframe containing mean and std for each device
     """
-    asset_groups = data_df.groupby(["assetname", "pointname"])
+    asset_groups = data_df.groupby(["assetname", "pointname"], observed=True)
     std_df = asset_groups["value"].std()
     mean_df = asset_groups["value"].mean()
 
@@ -47,6 +407,38 @@ def create_model(data_df):
     return result_df
 
 
+def create_model_from_aggregates(data_df):
+    """calculates the mean and standard deviation for each sensor from per-interval
+    count, mean and std aggregates, as written by the aggregates extraction mode.
+    The partial results are combined exactly, so the model matches create_model on
+    the raw values.
+
+    Args:
+        data_df (dataframe): input data with columns assetname, pointname, count, mean and std.
+
+    Returns:
+        dataframe: dataframe containing mean and std for each device
+    """
+    data_df = data_df[data_df["count"] > 0]
+    count = data_df["count"]
+    # sum of squared deviations from each interval's own mean. SiteWise reports the population standard
+    # deviation of an interval, which is 0 (or missing) for a single value
+    squares = data_df["std"].fillna(0) ** 2 * (count - AGGREGATE_STD_DDOF)
+    keys = [data_df["assetname"], data_df["pointname"]]
+
+    total = count.groupby(keys, observed=True).sum()
+    mean = (count * data_df["mean"]).groupby(keys, observed=True).sum() / total
+    # add the spread of the interval means around the overall mean
+    interval_mean = mean.reindex(pd.MultiIndex.from_arrays(keys)).to_numpy()
+    squares = squares + count * (data_df["mean"] - interval_mean) ** 2
+    std = (squares.groupby(keys, observed=True).sum() / (total - 1)) ** 0.5
+    std[total <= 1] = float("nan")
+
+    result_df = pd.DataFrame({"mean": mean, "std": std}).reset_index()
+    result_df.columns = ["assetname", "pointname", "mean", "std"]
+    return result_df
+
+
 def upload_to_s3(bucket_name, key, file_path):
     """Uploads object to S3.
 
@@ -68,10 +460,19 @@ if __name__ == "__main__":
     pipeline_type = os.environ["pipeline_type"]
     data_bucket = os.environ["data_bucket"]
     model_artifact_bucket = os.environ["model_artifact_bucket"]
+    # "streaming" builds the model from chunks with running statistics, in memory bounded by the number of sensors
+    training_mode = os.environ.get("training_mode", "in_memory")
     time = datetime.now()
 
-    data = readFromS3(site_id, data_bucket, pipeline_type, event_id)
-    model_df = create_model(data)
+    if training_mode == "streaming":
+        chunks = iter_from_s3(site_id, data_bucket, pipeline_type, event_id)
+        model_df = create_model_streaming(validate_schema(chunk) for chunk in chunks)
+    else:
+        data = validate_schema(readFromS3(site_id, data_bucket, pipeline_type, event_id))
+        if "count" in data.columns:
+            model_df = create_model_from_aggregates(data)
+        else:
+            model_df = create_model(data)
     model_df.to_csv("model.csv")
 
     upload_path = f"models/{site_id}/model.csv"
@@ -0,0 +1,15 @@
+import os
+import sys
+
+# the functions are deployed as flat modules, so they are imported the way the Lambda runtime does
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("lambdas", "inference_lambda", "retrain_image_asset"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+# the modules create their boto3 clients on import
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("neptune_cluster_writer_endpoint", "localhost")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: measures throughput, run with -m benchmark -s to see the numbers")
@@ -0,0 +1,222 @@
+import json
+import time
+import hashlib
+import threading
+from io import BytesIO
+from botocore.exceptions import ClientError
+
+from sitewise_history import getEpochSeconds
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+def getETag(body):
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+class FakeS3:
+    """In-memory stand-in for the boto3 s3 client methods the functions use, keyed by (bucket, key).
+
+    Multipart uploads only become objects once they are completed, and keep the
+    sizes of their parts in completed_parts. Uploads neither completed nor
+    aborted stay in uploads. PutObject honours IfMatch and IfNoneMatch like S3,
+    and every method is atomic.
+    """
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = {}
+        # parts of the multipart uploads in progress, by upload id
+        self.uploads = {}
+        self.completed_parts = {}
+        self.tags = {}
+        self.lock = threading.RLock()
+
+    def put_object(self, Bucket, Key, Body, Tagging=None, IfMatch=None, IfNoneMatch=None):
+        with self.lock:
+            current = self.objects.get((Bucket, Key))
+            if (IfNoneMatch == "*" and current is not None) or (
+                IfMatch is not None and (current is None or getETag(current) != IfMatch)
+            ):
+                raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+            self.objects[(Bucket, Key)] = Body.encode() if isinstance(Body, str) else bytes(Body)
+            self.tags[(Bucket, Key)] = Tagging
+            return {"ETag": getETag(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key):
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise NoSuchKey(Key)
+            body = self.objects[(Bucket, Key)]
+        return {"Body": BytesIO(body), "ETag": getETag(body)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+        self.tags.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete["Objects"]:
+            self.objects.pop((Bucket, item["Key"]), None)
+            self.tags.pop((Bucket, item["Key"]), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload{len(self.uploads) + len(self.completed_parts)}"
+        self.uploads[upload_id] = {"bucket": Bucket, "key": Key, "parts": {}}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        upload = self.uploads[UploadId]
+        assert (upload["bucket"], upload["key"]) == (Bucket, Key)
+        upload["parts"][PartNumber] = bytes(Body)
+        return {"ETag": f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self.uploads.pop(UploadId)
+        parts = MultipartUpload["Parts"]
+        assert [part["PartNumber"] for part in parts] == list(range(1, len(parts) + 1))
+        assert all(part["ETag"] == f'"{UploadId}-{part["PartNumber"]}"' for part in parts)
+        bodies = [upload["parts"][part["PartNumber"]] for part in parts]
+        # like S3, every part but the last has to hold at least 5 MiB
+        if any(len(body) < 5 * 1024 * 1024 for body in bodies[:-1]):
+            raise ValueError("EntityTooSmall")
+        self.objects[(Bucket, Key)] = b"".join(bodies)
+        self.completed_parts[UploadId] = [len(body) for body in bodies]
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        return {}
+
+    def keys(self, Bucket, Prefix=""):
+        return sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+
+
+class FakeSiteWise:
+    """Stand-in for the BatchGetAssetPropertyValueHistory API.
+
+    Like SiteWise, the start of an entry's range is exclusive and its end
+    inclusive, both in whole seconds, every entry gets up to maxResults values
+    per page, and entries that are complete are reported in skippedEntries of
+    the later pages of the same request. A nextToken is only valid for the
+    request it was returned for, and with reject_tokens only in the generation
+    it was returned in.
+    """
+
+    def __init__(self, data, delay=0, reject_tokens=False):
+        self.data = data
+        self.delay = delay
+        self.reject_tokens = reject_tokens
+        self.generation = 0
+        self.calls = 0
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def batch_get_asset_property_value_history(self, entries, maxResults, nextToken=None):
+        with self.lock:
+            self.calls += 1
+            self.requests.append((entries, nextToken))
+        time.sleep(self.delay)
+        signature = [
+            [entry["entryId"], getEpochSeconds(entry["startDate"]), getEpochSeconds(entry["endDate"])]
+            for entry in entries
+        ]
+        offsets = {}
+        if nextToken is not None:
+            token = json.loads(nextToken)
+            if token["signature"] != signature or (
+                self.reject_tokens and token["generation"] != self.generation
+            ):
+                raise ClientError({"Error": {"Code": "InvalidRequestException"}}, "BatchGetAssetPropertyValueHistory")
+            offsets = token["offsets"]
+
+        response = {"successEntries": [], "errorEntries": [], "skippedEntries": []}
+        next_offsets = {}
+        for entry in entries:
+            offset = offsets.get(entry["entryId"], 0)
+            if offset is None:
+                response["skippedEntries"].append({"entryId": entry["entryId"], "completionStatus": "SUCCESS"})
+                continue
+            start = getEpochSeconds(entry["startDate"])
+            end = getEpochSeconds(entry["endDate"])
+            values = [t for t in self.data[entry["propertyId"]] if start < t // 1_000_000_000 <= end]
+            page = values[offset : offset + maxResults]
+            response["successEntries"].append(
+                {
+                    "entryId": entry["entryId"],
+                    "assetPropertyValueHistory": [
+                        {
+                            "value": {"doubleValue": t / 1e9},
+                            "timestamp": {
+                                "timeInSeconds": t // 1_000_000_000,
+                                "offsetInNanos": t % 1_000_000_000,
+                            },
+                        }
+                        for t in page
+                    ],
+                }
+            )
+            next_offsets[entry["entryId"]] = offset + maxResults if offset + maxResults < len(values) else None
+        if any(offset is not None for offset in next_offsets.values()):
+            response["nextToken"] = json.dumps(
+                {"signature": signature, "offsets": next_offsets, "generation": self.generation}
+            )
+        return response
+
+
+class FakeTimestream:
+    """Stand-in for the WriteRecords API of a single Timestream table.
+
+    A record is stored under its dimensions, measure name and time. A record
+    that exists with other measure values is rejected with its ExistingVersion
+    unless the new record has a higher version, and records older than
+    retention_ns before the newest time written are rejected like ones outside
+    the memory store. The first throttle_calls requests are throttled. Every
+    record that was written is listed in written.
+    """
+
+    def __init__(self, throttle_calls=0, retention_ns=None):
+        self.throttle_calls = throttle_calls
+        self.retention_ns = retention_ns
+        self.table = {}
+        self.requests = []
+        self.written = []
+        self.lock = threading.Lock()
+
+    def write_records(self, DatabaseName, TableName, CommonAttributes, Records):
+        with self.lock:
+            self.requests.append({"CommonAttributes": CommonAttributes, "Records": Records})
+            if len(Records) > 100:
+                raise ClientError({"Error": {"Code": "ValidationException"}}, "WriteRecords")
+            if len(self.requests) <= self.throttle_calls:
+                raise ClientError({"Error": {"Code": "ThrottlingException"}}, "WriteRecords")
+            dimensions = tuple((item["Name"], item["Value"]) for item in CommonAttributes["Dimensions"])
+            newest = max((int(key[2]) for key in self.table), default=None)
+            rejected = []
+            for index, record in enumerate(Records):
+                key = (dimensions, CommonAttributes["MeasureName"], record["Time"])
+                version = record.get("Version", 1)
+                existing = self.table.get(key)
+                if (
+                    self.retention_ns is not None
+                    and newest is not None
+                    and int(record["Time"]) < newest - self.retention_ns
+                ):
+                    reason = "The record timestamp is outside the time range of the data ingestion window."
+                    rejected.append({"RecordIndex": index, "Reason": reason})
+                elif existing is not None and existing[1] != record["MeasureValues"] and version <= existing[0]:
+                    reason = "A record with a higher version exists."
+                    rejected.append({"RecordIndex": index, "Reason": reason, "ExistingVersion": existing[0]})
+                else:
+                    self.table[key] = (version, record["MeasureValues"])
+                    self.written.append(key)
+            if rejected:
+                err = ClientError({"Error": {"Code": "RejectedRecordsException"}}, "WriteRecords")
+                err.response["RejectedRecords"] = rejected
+                raise err
+            return {"RecordsIngested": {"Total": len(Records)}}
@@ -0,0 +1,62 @@
+import json
+import numpy as np
+import pandas as pd
+
+from fakes import FakeS3
+from history_store import HistoryStore, getPointCoverage, subtractIntervals
+
+HOUR_NS = 3600 * 1_000_000_000
+START = 1_600_000_000 * 1_000_000_000
+
+
+def getExtract(points, lower, upper, step=600 * 1_000_000_000):
+    timestamps = np.arange(lower, upper, step, dtype=np.int64)
+    return pd.DataFrame(
+        {
+            "assetname": [assetname for assetname, _ in points for _ in timestamps],
+            "pointname": [pointname for _, pointname in points for _ in timestamps],
+            "value": np.tile(timestamps / 1e9, len(points)),
+            "timestamp": np.tile(timestamps, len(points)),
+        }
+    )
+
+
+def test_coverage_is_kept_per_point():
+    s3 = FakeS3()
+    store = HistoryStore(s3, "bucket", "site")
+    points = [{"assetname": "rtu0", "pointname": "pt0"}, {"assetname": "rtu0", "pointname": "pt1"}]
+    for hour in range(3):
+        lower, upper = START + hour * HOUR_NS, START + (hour + 1) * HOUR_NS
+        store.compact(getExtract([("rtu0", "pt0"), ("rtu0", "pt1")], lower, upper), lower, upper, points)
+
+    # a point added later, and an hour whose extract could not be read completely for pt1
+    lower, upper = START + 3 * HOUR_NS, START + 4 * HOUR_NS
+    extract = getExtract([("rtu0", "pt0"), ("rtu0", "pt1"), ("rtu1", "pt2")], lower, upper)
+    coverage = store.compact(extract, lower, upper, points[:1] + [{"assetname": "rtu1", "pointname": "pt2"}])
+
+    assert getPointCoverage(coverage, "rtu0", "pt0") == [[START, START + 4 * HOUR_NS]]
+    assert getPointCoverage(coverage, "rtu0", "pt1") == [[START, START + 3 * HOUR_NS]]
+    assert getPointCoverage(coverage, "rtu1", "pt2") == [[START + 3 * HOUR_NS, START + 4 * HOUR_NS]]
+    assert getPointCoverage(coverage, "rtu1", "pt3") == []
+    assert store.readCoverage() == json.loads(json.dumps(coverage))
+
+    # readers fetch every point outside its own coverage, the new point over the whole window
+    window = [START, START + 4 * HOUR_NS]
+    assert subtractIntervals(getPointCoverage(coverage, "rtu0", "pt1"), *window) == [
+        [START + 3 * HOUR_NS, START + 4 * HOUR_NS]
+    ]
+    assert subtractIntervals(getPointCoverage(coverage, "rtu1", "pt3"), *window) == [window]
+
+    data = store.read("rtu0", "pt0", getPointCoverage(coverage, "rtu0", "pt0"))
+    assert data["timestamp"].tolist() == list(range(START, START + 4 * HOUR_NS, 600 * 1_000_000_000))
+
+
+def test_extract_without_covered_points_keeps_the_coverage():
+    s3 = FakeS3()
+    store = HistoryStore(s3, "bucket", "site")
+    extract = getExtract([("rtu0", "pt0")], START, START + HOUR_NS)
+    coverage = store.compact(extract, START, START + HOUR_NS, [])
+    assert coverage["points"] == {}
+    assert not any(key.endswith("_coverage.json") for key in s3.keys("bucket"))
+    # the values are stored anyway, and a later complete extract of the same hour covers them
+    assert len(store.read("rtu0", "pt0", [[START, START + HOUR_NS]])) == len(extract)
@@ -0,0 +1,79 @@
+import time
+import numpy as np
+import pandas as pd
+import pytest
+
+from infer_lambda import score_values
+
+
+def score_with_loop(data_df, lower_thresh, upper_thresh):
+    # the per-row scoring score_values replaced
+    is_anomaly = []
+    for i in range(data_df.shape[0]):
+        if lower_thresh < data_df["value"][i] < upper_thresh:
+            is_anomaly.append(0)
+        else:
+            is_anomaly.append(1)
+    return np.array(is_anomaly, dtype=np.int64)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_vectorized_scoring_matches_the_loop(dtype):
+    mean, std = 21.7, 1.3
+    lower_thresh = mean - 2 * std
+    upper_thresh = mean + 2 * std
+    edges = [
+        lower_thresh,
+        upper_thresh,
+        np.nextafter(lower_thresh, -np.inf),
+        np.nextafter(lower_thresh, np.inf),
+        np.nextafter(upper_thresh, -np.inf),
+        np.nextafter(upper_thresh, np.inf),
+        mean,
+        np.nan,
+        np.inf,
+        -np.inf,
+        0.0,
+        -0.0,
+    ]
+    rng = np.random.default_rng(7)
+    values = np.concatenate([np.array(edges), rng.normal(mean, 2 * std, 100_000)]).astype(dtype)
+    data_df = pd.DataFrame({"value": values})
+
+    is_anomaly = score_values(data_df["value"].to_numpy(), lower_thresh, upper_thresh)
+    assert is_anomaly.dtype == np.int64
+    # float32 values are compared exactly, as the loop did with NumPy 1 scalar promotion. NumPy 2 compares a
+    # float32 scalar with a Python float in float32, so the loop is given the exactly widened values
+    expected = score_with_loop(data_df.astype(np.float64), lower_thresh, upper_thresh)
+    np.testing.assert_array_equal(is_anomaly, expected)
+    # both sides of both thresholds occur, so the comparison is not trivially all 0 or all 1
+    assert 0 < is_anomaly.sum() < len(is_anomaly)
+
+
+def test_equal_thresholds_flag_everything():
+    values = np.array([1.0, 2.0, np.nan])
+    np.testing.assert_array_equal(score_values(values, 2.0, 2.0), [1, 1, 1])
+
+
+def measure_rows_per_second(score, rows, repeats=3):
+    # best of a few runs, so a busy machine does not understate the throughput
+    best = float("inf")
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        score()
+        best = min(best, time.perf_counter() - begin)
+    return rows / best
+
+
+@pytest.mark.benchmark
+def test_vectorized_scoring_throughput():
+    rows = 20_000
+    mean, std = 21.7, 1.3
+    lower_thresh, upper_thresh = mean - 2 * std, mean + 2 * std
+    data_df = pd.DataFrame({"value": np.random.default_rng(7).normal(mean, 2 * std, rows)})
+    values = data_df["value"].to_numpy()
+
+    loop = measure_rows_per_second(lambda: score_with_loop(data_df, lower_thresh, upper_thresh), rows)
+    vectorized = measure_rows_per_second(lambda: score_values(values, lower_thresh, upper_thresh), rows)
+    print(f"per-row loop: {loop:,.0f} rows/s, score_values: {vectorized:,.0f} rows/s ({vectorized / loop:,.0f}x)")
+    assert vectorized > 100 * loop
@@ -0,0 +1,179 @@
+import io
+import json
+import time
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+import init_lambda
+from fakes import FakeS3
+
+
+def test_partitions_are_read_as_they_are_taken(monkeypatch):
+    started = []
+    lock = threading.Lock()
+
+    def readPartition(s3_bucket_name, prefix, partition, columns=None):
+        with lock:
+            started.append(partition["pointname"])
+        return pd.DataFrame({"value": [1.0], "timestamp": [partition["index"]]})
+
+    monkeypatch.setattr(init_lambda, "readPartition", readPartition)
+    monkeypatch.setattr(init_lambda, "partition_read_workers", 3)
+    partitions = [{"assetname": "rtu", "pointname": f"pt{index}", "index": index} for index in range(20)]
+
+    reader = init_lambda.readPartitions("bucket", "prefix/", partitions)
+    for taken in range(1, 8):
+        key, data = next(reader)
+        assert key == ("rtu", f"pt{taken - 1}")
+        assert data["timestamp"].tolist() == [taken - 1]
+        # besides the partition taken, only the ones read ahead were started
+        assert len(started) <= taken + init_lambda.partition_read_workers - 1
+    assert [key for key, _ in reader] == [("rtu", f"pt{index}") for index in range(7, 20)]
+    assert sorted(started) == sorted(partition["pointname"] for partition in partitions)
+
+
+def getGroup(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "assetname": "rtu1",
+            "pointname": "Supply_Air_Temperature_Sensor",
+            "value": rng.normal(20, 5, rows),
+            "timestamp": 1_600_000_000_000_000_000 + np.arange(rows, dtype=np.int64) * 60_000_000_000,
+        },
+        index=np.arange(rows) + 10_000_000,
+    )
+
+
+def test_inline_size_estimate_is_an_upper_bound():
+    group = getGroup(5000)
+    key = ("rtu1", "Supply_Air_Temperature_Sensor")
+    payload = json.dumps(group.reset_index().to_dict(orient="records"))
+    assert len(payload) <= init_lambda.getInlineBytes(key, group) <= 1.5 * len(payload)
+
+
+def test_inline_shards_stay_below_the_byte_limit():
+    groups = [((f"rtu{index}", "Supply_Air_Temperature_Sensor"), getGroup(3000, index)) for index in range(40)]
+    max_bytes = 5_000_000
+    shards = list(init_lambda.getShards(groups, 100, 100_000, max_bytes))
+    assert [pair for shard in shards for pair in shard] == groups
+    assert len(shards) > 1
+    for shard in shards:
+        batch = [
+            {"rtu": key[0], "point": key[1], "data": group.reset_index().to_dict(orient="records")}
+            for key, group in shard
+        ]
+        assert len(json.dumps({"points": batch})) < max_bytes
+
+    # claim check references are not limited by size, only by their rows
+    refs = [(key, {"bucket": "bucket", "prefix": "prefix", "rows": len(group)}) for key, group in groups]
+    assert [len(shard) for shard in init_lambda.getShards(refs, 100, 100_000, max_bytes)] == [33, 7]
+
+
+class FakeLambda:
+    """Stand-in for the Lambda client, answering each invocation with the next of its responses."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def invoke(self, FunctionName, Payload):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def getResponse(body, error=None):
+    response = {"StatusCode": 200, "Payload": io.BytesIO(json.dumps(body).encode())}
+    if error is not None:
+        response["FunctionError"] = error
+    return response
+
+
+def useFakeLambda(monkeypatch, responses):
+    client = FakeLambda(responses)
+    timeouts = []
+
+    def getLambdaClient(read_timeout):
+        timeouts.append(read_timeout)
+        return client
+
+    monkeypatch.setattr(init_lambda, "getLambdaClient", getLambdaClient)
+    monkeypatch.setattr(init_lambda.time, "sleep", lambda seconds: None)
+    return client, timeouts
+
+
+def test_function_errors_are_not_retried(monkeypatch):
+    client, _ = useFakeLambda(monkeypatch, [getResponse({"errorMessage": "bad input"}, "Unhandled")])
+    with pytest.raises(Exception, match="bad input"):
+        init_lambda.invokeInference({"site_id": "site"})
+    assert client.calls == 1
+
+
+def test_failed_invocations_are_retried(monkeypatch):
+    responses = [
+        ReadTimeoutError(endpoint_url="https://lambda"),
+        ClientError({"Error": {"Code": "TooManyRequestsException"}}, "Invoke"),
+        getResponse({"points": []}),
+    ]
+    client, _ = useFakeLambda(monkeypatch, responses)
+    assert init_lambda.invokeInference({"site_id": "site"}) == {"points": []}
+    assert client.calls == 3
+
+    client, _ = useFakeLambda(monkeypatch, [ClientError({"Error": {"Code": "AccessDeniedException"}}, "Invoke")])
+    with pytest.raises(ClientError):
+        init_lambda.invokeInference({"site_id": "site"})
+    assert client.calls == 1
+
+
+def test_invocations_end_before_the_deadline(monkeypatch):
+    client, timeouts = useFakeLambda(monkeypatch, [getResponse({"points": []})])
+    init_lambda.invokeInference({"site_id": "site"}, time.time() + 125)
+    assert timeouts == [120]
+
+    # an invocation is not started without the time to wait for it
+    client, _ = useFakeLambda(monkeypatch, [getResponse({"points": []})])
+    with pytest.raises(TimeoutError):
+        init_lambda.invokeInference({"site_id": "site"}, time.time() + 20)
+    assert client.calls == 0
+
+
+def test_results_parts_are_deleted_when_the_merge_fails(monkeypatch):
+    s3 = FakeS3()
+    partitions = [
+        {"assetname": "rtu1", "pointname": f"pt{index}", "path": f"asset=rtu1/point=pt{index}/", "rows": 10}
+        for index in range(3)
+    ]
+
+    def invokeInference(payload, deadline=None):
+        # every invocation writes its part, like the inference function
+        s3.put_object(Bucket="results", Key=payload["resultsPartKey"], Body=b"part")
+        return {
+            "points": [
+                {"rtu": point["rtu"], "point": point["point"], "rows": 10, "anomalies": 1}
+                for point in payload["points"]
+            ]
+        }
+
+    def writeResults(site_id, event_id, key, parts, summaries):
+        assert len(s3.keys("results", "event/site.parts/")) == 3
+        raise RuntimeError("merge failed")
+
+    monkeypatch.setattr(init_lambda, "aws_s3", s3)
+    monkeypatch.setattr(init_lambda, "results_bucket", "results")
+    monkeypatch.setattr(init_lambda, "results_output", "site")
+    monkeypatch.setattr(init_lambda, "claim_check", True)
+    monkeypatch.setattr(init_lambda, "inference_batch_points", 1)
+    monkeypatch.setattr(init_lambda, "readPartitionManifest", lambda bucket, prefix: {"partitions": partitions})
+    monkeypatch.setattr(init_lambda, "invokeInference", invokeInference)
+    monkeypatch.setattr(init_lambda, "writeResults", writeResults)
+
+    event = {"Payload": {"site_id": "site", "pipeline_type": "inference", "event_id": "event"}}
+    with pytest.raises(RuntimeError, match="merge failed"):
+        init_lambda.handler(event, None)
+    assert s3.keys("results") == []
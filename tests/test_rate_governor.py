@@ -0,0 +1,104 @@
+import time
+import threading
+
+from rate_governor import LocalStateStore, RateGovernor
+
+
+class FakeClock:
+    """Simulated time that only moves when a caller sleeps."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def makeGovernors(store, clock, count, **kwargs):
+    return [RateGovernor(store, "api", clock=clock, sleep=clock.sleep, **kwargs) for _ in range(count)]
+
+
+def test_callers_share_one_rate():
+    store = LocalStateStore()
+    clock = FakeClock()
+    callers = 4
+    rate, burst, lease_size = 10.0, 10.0, 5
+    governors = makeGovernors(store, clock, callers, max_rate=rate, burst=burst, lease_size=lease_size)
+
+    times = []
+    for request in range(400):
+        governors[request % callers].acquire()
+        times.append(clock())
+
+    elapsed = times[-1] - times[0]
+    assert elapsed >= (len(times) - burst) / rate - 1e-6
+    # a window never holds more than the bucket plus its refill, and the tokens callers leased before it
+    for first, start in enumerate(times):
+        window = sum(1 for t in times[first:] if t <= start + 1.0)
+        assert window <= burst + rate + callers * lease_size
+
+
+def test_throttle_cuts_rate_once_per_cooldown_and_recovers():
+    store = LocalStateStore()
+    clock = FakeClock()
+    first, second = makeGovernors(store, clock, 2, max_rate=10.0, cooldown=2.0)
+    first.acquire()
+    assert store.get("api")["rate"] == 10.0
+
+    # every caller that saw the same congestion reports it, but it only counts once
+    first.onThrottle()
+    second.onThrottle()
+    assert store.get("api")["rate"] == 5.0
+    assert first.reserve == 0
+
+    clock.sleep(2.0)
+    second.onThrottle()
+    assert store.get("api")["rate"] == 2.5
+
+    # the lease right after a throttle does not grow the rate, the ones after it do
+    second.acquire()
+    assert store.get("api")["rate"] == 2.5
+    rates = [2.5]
+    start = clock()
+    while rates[-1] < 10.0:
+        (first if len(rates) % 2 else second).acquire()
+        rates.append(store.get("api")["rate"])
+        assert clock() - start < 30
+    assert rates == sorted(rates)
+    # additive increase: about one request per second per second
+    assert 4 <= clock() - start <= 12
+
+
+def test_rate_never_drops_below_min_rate():
+    store = LocalStateStore()
+    clock = FakeClock()
+    (governor,) = makeGovernors(store, clock, 1, max_rate=8.0, min_rate=2.0, cooldown=0.0)
+    for _ in range(5):
+        governor.onThrottle()
+        clock.sleep(0.1)
+    assert store.get("api")["rate"] == 2.0
+
+
+def test_concurrent_callers_keep_the_rate_limit():
+    store = LocalStateStore()
+    rate, burst, requests = 100.0, 5.0, 30
+    governors = [RateGovernor(store, "api", max_rate=rate, burst=burst) for _ in range(4)]
+
+    def call(governor):
+        for _ in range(requests):
+            governor.acquire()
+
+    begin = time.perf_counter()
+    threads = [threading.Thread(target=call, args=(governor,)) for governor in governors]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+
+    assert elapsed >= (len(governors) * requests - burst) / rate * 0.95
+    # every lease was a conditional update of the shared state that no other caller overwrote
+    assert store.get("api")["version"] >= len(governors) * requests / governors[0].lease_size
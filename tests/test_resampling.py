@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+import site_id_and_rtu_lambda as extraction
+from fakes import FakeSiteWise
+from resampling import resampleFrame
+
+# an end time on an hour boundary, which is also a boundary of every resampling interval
+END = 1_600_002_000
+SECOND = 1_000_000_000
+
+
+def getAssetProperties(data):
+    return [
+        {"assetName": "rtu0", "assetSiteWiseId": "asset0", "pointName": f"brick:{property_id}", "pointSiteWiseId": property_id}
+        for property_id in data
+    ]
+
+
+def test_consecutive_windows_do_not_split_intervals(monkeypatch):
+    monkeypatch.setattr(extraction, "resample_interval_seconds", 300)
+    monkeypatch.setattr(extraction, "history_slice_seconds", 3600)
+    monkeypatch.setattr(extraction, "sitewise_fetch_workers", 1)
+    rules = {"default": "mean"}
+    # values on whole seconds, including every window and interval boundary, and just before and after them
+    seconds = np.arange(END - 2 * 3600 - 5, END + 3600 + 5, 20)
+    seconds = np.union1d(seconds, [END - 3600, END - 300, END, END + 300, END + 3600])
+    series = sorted(
+        int(second * SECOND + offset) for second in seconds for offset in (0, SECOND // 2)
+    )
+    data = {"Supply_Air_Temperature_Sensor": series, "Zone_Air_Temperature_Sensor": series[::3]}
+
+    frames = []
+    windows = []
+    for end_time in (END + 17, END + 3600 + 17):
+        monkeypatch.setattr(extraction, "sitewise_client", FakeSiteWise(data))
+        end, start = extraction.getTimeInterval("inference", end_time)
+        windows.append(extraction.getQueryWindow(start, end))
+        frame = extraction.getHistoricalDatawithinTimeInterval(getAssetProperties(data), start, end)
+        frame = frame.assign(pointname=frame["pointname"].astype("category"))
+        frames.append(resampleFrame(frame, 300, rules))
+
+    # each run reads exactly the intervals from its aligned start to its aligned end
+    assert windows == [[(END - 3600) * SECOND, END * SECOND], [END * SECOND, (END + 3600) * SECOND]]
+    frame = pd.concat(frames, ignore_index=True).astype({"pointname": str})
+    assert not frame.duplicated(["pointname", "timestamp"]).any()
+
+    # the two runs together give what resampling all values of both windows at once gives
+    expected = []
+    for pointname, values in data.items():
+        values = np.array(values, dtype=np.int64)
+        values = values[(values >= (END - 3600) * SECOND) & (values < (END + 3600) * SECOND)]
+        means = pd.Series(values / 1e9).groupby(values // (300 * SECOND) * (300 * SECOND)).mean()
+        expected.append(pd.DataFrame({"pointname": pointname, "value": means.to_numpy(), "timestamp": means.index}))
+    expected = pd.concat(expected, ignore_index=True)
+    frame = frame.sort_values(["pointname", "timestamp"], ignore_index=True)
+    assert frame["timestamp"].tolist() == expected["timestamp"].tolist()
+    assert frame["pointname"].tolist() == expected["pointname"].tolist()
+    assert np.allclose(frame["value"], expected["value"])
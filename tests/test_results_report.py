@@ -0,0 +1,122 @@
+import json
+import time
+import threading
+import numpy as np
+import pandas as pd
+
+import infer_lambda
+from fakes import FakeS3
+from results_report import (
+    ResultsReport,
+    getSiteResultsPartKey,
+    mergeSiteResults,
+    readSiteResults,
+    writeSiteResults,
+)
+
+HOUR_NS = 3600 * 1_000_000_000
+
+
+def getPoint(rtu, pointname, count, seed):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(0, 1, count)
+    return (rtu, pointname), pd.DataFrame(
+        {
+            "value": values,
+            "timestamp": np.arange(count, dtype=np.int64) * 60_000_000_000,
+            "is_anomaly": (np.abs(values) > 1.5).astype(np.int64),
+        }
+    )
+
+
+def test_merged_parts_match_a_site_results_file(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(infer_lambda, "aws_s3", s3)
+    monkeypatch.setenv("bucket", "results")
+
+    # 150 points in shards of up to 40, so parts differ in their category codes
+    points = [getPoint(f"rtu{index % 7}", f"pt{index}", 50 + index, index) for index in range(150)]
+    points.append(getPoint("rtu9", "quiet", 20, 0))
+    points[-1][1]["is_anomaly"] = 0
+    shards = [points[start : start + 40] for start in range(0, 120, 40)] + [points[120:150], points[150:]]
+
+    parts = []
+    for part, shard in enumerate(shards):
+        key = getSiteResultsPartKey("event", "site", part)
+        infer_lambda.write_results_part(key, [key for key, _ in shard], [frame for _, frame in shard])
+        parts.append((key, int(sum(frame["is_anomaly"].sum() for _, frame in shard))))
+    # the tag the results bucket expires parts by, should the init function not delete them
+    assert {s3.tags[("results", key)] for key, _ in parts} == {infer_lambda.RESULTS_PART_TAGGING}
+    summary = mergeSiteResults(s3, "results", "event/site.parquet", parts, {"site_id": "site"})
+    assert summary["anomalyRowGroups"] == len(shards) - 1
+
+    expected = pd.concat(
+        [frame.assign(assetname=rtu, pointname=pointname) for (rtu, pointname), frame in points], ignore_index=True
+    )[["assetname", "pointname", "value", "timestamp", "is_anomaly"]]
+    writeSiteResults(s3, "results", "expected.parquet", expected, {"site_id": "site"})
+
+    def normalize(frame):
+        frame = frame.astype({"assetname": str, "pointname": str, "is_anomaly": np.int8})
+        return frame.sort_values(["assetname", "pointname", "timestamp"]).reset_index(drop=True)
+
+    for anomalies_only in (False, True):
+        merged_summary, merged = readSiteResults(s3, "results", "event/site.parquet", anomalies_only)
+        _, reference = readSiteResults(s3, "results", "expected.parquet", anomalies_only)
+        assert merged_summary == summary
+        pd.testing.assert_frame_equal(normalize(merged), normalize(reference))
+    # the anomalies come first
+    _, merged = readSiteResults(s3, "results", "event/site.parquet")
+    flags = merged["is_anomaly"].to_numpy()
+    assert flags[: flags.sum()].all()
+
+
+def getSummaries(rtu, hours, rows, anomalies):
+    start = 1_600_000_000 // 3600 * 3600 * 1_000_000_000
+    return [
+        {
+            "key": f"{rtu}.parquet",
+            "rtu": rtu,
+            "point": "pt",
+            "rows": rows * hours,
+            "anomalies": anomalies * hours,
+            "startTime": start,
+            "endTime": start + hours * HOUR_NS,
+            "hourly": [(start + hour * HOUR_NS, rows, anomalies) for hour in range(hours)],
+        }
+    ]
+
+
+def test_overlapping_runs_keep_each_others_counts():
+    class SlowS3(FakeS3):
+        # every run reads a rollup file before any of them wrote it back
+        def get_object(self, Bucket, Key):
+            response = super().get_object(Bucket, Key)
+            time.sleep(0.02)
+            return response
+
+    s3 = SlowS3()
+    runs = [(f"event{index}", f"rtu{index % 3}") for index in range(8)]
+    threads = [
+        threading.Thread(
+            target=lambda event_id, rtu: ResultsReport(s3, "results", "site").record(
+                event_id, getSummaries(rtu, 3, 60, 2)
+            ),
+            args=run,
+        )
+        for run in runs
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # a retried run is not counted again
+    ResultsReport(s3, "results", "site").record("event0", getSummaries("rtu0", 3, 60, 2))
+
+    for rollup, periods in (("hourly", 3), ("daily", 1)):
+        (key,) = s3.keys("results", f"reports/site/{rollup}/")
+        counts = json.loads(s3.objects[("results", key)])
+        assert sorted(counts["events"]) == sorted(event_id for event_id, _ in runs)
+        assert len(counts["total"]) == periods
+        assert sum(totals["rows"] for totals in counts["total"].values()) == len(runs) * 3 * 60
+        assert sum(totals["anomalies"] for totals in counts["total"].values()) == len(runs) * 3 * 2
+        assert sum(totals["rows"] for totals in counts["rtus"]["rtu1"].values()) == 3 * 3 * 60
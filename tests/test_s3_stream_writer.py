@@ -0,0 +1,106 @@
+import io
+import numpy as np
+import pandas as pd
+import pytest
+
+from fakes import FakeS3
+from s3_stream_writer import MIN_PART_SIZE, CsvFrameWriter, ParquetFrameWriter, S3StreamWriter
+from site_schema import applySchema
+
+
+def getData(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return applySchema(
+        pd.DataFrame(
+            {
+                "assetname": np.where(np.arange(rows) < rows // 2, "rtu1", "rtu2"),
+                "pointname": np.tile(["Supply_Air_Temperature_Sensor", "Zone_Air_Temperature_Sensor"], rows)[:rows],
+                "value": rng.normal(20, 5, rows),
+                "timestamp": 1_600_000_000_000_000_000 + np.arange(rows, dtype=np.int64) * 1_000_000_000,
+            }
+        )
+    )
+
+
+def getChunks(data, chunk_rows):
+    return [data.iloc[start : start + chunk_rows] for start in range(0, len(data), chunk_rows)]
+
+
+def test_parts_are_flushed_at_the_minimum_part_size():
+    s3 = FakeS3()
+    body = np.random.default_rng(0).bytes(2 * MIN_PART_SIZE + 12345)
+    # a part size below the S3 minimum is raised to it
+    with S3StreamWriter(s3, "bucket", "key", part_size=1024) as stream:
+        for start in range(0, len(body), 1_000_000):
+            stream.write(body[start : start + 1_000_000])
+            # only the bytes of the part that is not full yet are held in memory
+            assert len(stream.buffer) < MIN_PART_SIZE
+    assert s3.objects[("bucket", "key")] == body
+    assert list(s3.completed_parts.values()) == [[MIN_PART_SIZE, MIN_PART_SIZE, 12345]]
+
+
+def test_small_objects_are_written_with_one_put():
+    s3 = FakeS3()
+    with S3StreamWriter(s3, "bucket", "key") as stream:
+        stream.write(b"small")
+        stream.write(b" object")
+    assert s3.objects[("bucket", "key")] == b"small object"
+    assert not s3.completed_parts and not s3.uploads
+
+
+def test_upload_is_aborted_on_error():
+    s3 = FakeS3()
+    with pytest.raises(RuntimeError):
+        with S3StreamWriter(s3, "bucket", "key", part_size=MIN_PART_SIZE) as stream:
+            stream.write(bytes(MIN_PART_SIZE + 1))
+            assert s3.uploads
+            raise RuntimeError("fetch failed")
+    assert not s3.objects and not s3.uploads
+
+
+def test_suspended_csv_is_the_same_as_one_to_csv():
+    s3 = FakeS3()
+    data = getData(150_000)
+    chunks = getChunks(data, 20_000)
+    state, buffer, rows, header_written = None, b"", 0, False
+    # every invocation writes a few chunks and suspends, the last one completes the upload
+    for invocation in range(0, len(chunks), 3):
+        with S3StreamWriter(
+            s3, "bucket", "site.csv", part_size=MIN_PART_SIZE, state=state, buffer=buffer
+        ) as stream:
+            writer = CsvFrameWriter(stream, rows=rows, header_written=header_written)
+            for chunk in chunks[invocation : invocation + 3]:
+                writer.writeFrame(chunk)
+            if invocation + 3 < len(chunks):
+                state, buffer = stream.suspend()
+                rows, header_written = writer.rows, writer.header_written
+    expected = data.to_csv().encode("utf-8")
+    assert len(expected) > 2 * MIN_PART_SIZE
+    assert s3.objects[("bucket", "site.csv")] == expected
+    assert len(list(s3.completed_parts.values())[0]) > 2
+    assert not s3.uploads
+
+
+def test_streamed_parquet_is_the_same_as_one_to_parquet():
+    s3 = FakeS3()
+    data = getData(600_000)
+    with S3StreamWriter(s3, "bucket", "site.parquet", part_size=MIN_PART_SIZE) as stream:
+        writer = ParquetFrameWriter(stream)
+        writer.writeFrame(data)
+        writer.close()
+    expected = io.BytesIO()
+    data.to_parquet(expected, index=False, compression="zstd", row_group_size=len(data))
+    assert len(expected.getvalue()) > MIN_PART_SIZE
+    assert s3.objects[("bucket", "site.parquet")] == expected.getvalue()
+    assert len(list(s3.completed_parts.values())[0]) > 1
+
+    # a frame per row group keeps every row and the column types
+    s3 = FakeS3()
+    with S3StreamWriter(s3, "bucket", "site.parquet") as stream:
+        writer = ParquetFrameWriter(stream)
+        for chunk in getChunks(data, 70_000):
+            writer.writeFrame(chunk)
+        writer.close()
+    read = pd.read_parquet(io.BytesIO(s3.objects[("bucket", "site.parquet")]))
+    assert read.dtypes.equals(data.dtypes)
+    assert read.equals(data)
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import init_lambda
+import site_schema
+import training
+
+# the retrain image is built from retrain_image_asset alone, so training.py keeps its own copy of the schema of
+# site_schema.py and of the readers of init_lambda.py. these tests keep the copies in step with the originals
+
+
+def getFrames():
+    rows = 6
+    names = {"assetname": ["rtu1", "rtu2"] * 3, "pointname": ["pt1"] * 3 + ["pt2"] * 3}
+    timestamps = 1_600_000_000_000_000_000 + np.arange(rows, dtype=np.int64) * 60_000_000_000
+    values = np.linspace(0, 1, rows)
+    return {
+        # as parsed from a CSV file without dtypes
+        "strings": pd.DataFrame({**names, "value": np.arange(rows), "timestamp": timestamps}),
+        "float timestamps": pd.DataFrame({**names, "value": values, "timestamp": timestamps.astype(float)}),
+        "float32 values": pd.DataFrame({**names, "value": values.astype(np.float32), "timestamp": timestamps}),
+        "typed": site_schema.applySchema(pd.DataFrame({**names, "value": values, "timestamp": timestamps})),
+        "aggregates": pd.DataFrame(
+            {
+                **names,
+                "count": np.arange(rows),
+                "mean": values,
+                "std": [np.nan] + [0.5] * (rows - 1),
+                "timestamp": timestamps,
+            }
+        ),
+        "no timestamp": pd.DataFrame({**names, "value": np.arange(rows)}),
+        "empty": pd.DataFrame({"assetname": [], "pointname": [], "value": [], "timestamp": []}),
+    }
+
+
+def test_constants_match():
+    assert training.CATEGORY_COLUMNS == site_schema.CATEGORY_COLUMNS
+    assert training.TIMESTAMP_COLUMN == site_schema.TIMESTAMP_COLUMN
+    assert training.VALUE_DTYPES == site_schema.VALUE_DTYPES
+    assert training.CSV_DTYPES == site_schema.CSV_DTYPES
+    assert training.PARTITION_COLUMNS == init_lambda.PARTITION_COLUMNS
+
+
+@pytest.mark.parametrize("name", list(getFrames()))
+def test_schema_gives_the_same_types(name):
+    data = getFrames()[name]
+    pd.testing.assert_frame_equal(training.apply_schema(data), site_schema.applySchema(data))
+
+
+@pytest.mark.parametrize("name", list(getFrames()))
+def test_validation_gives_the_same_result(name):
+    data = getFrames()[name]
+    for frame in (data, site_schema.applySchema(data)):
+        results = []
+        for validate in (training.validate_schema, site_schema.validateSchema):
+            try:
+                validate(frame)
+                results.append(None)
+            except ValueError as err:
+                results.append(str(err))
+        assert results[0] == results[1]
+
+
+def test_partition_readers_give_the_same_frame(tmp_path, monkeypatch):
+    partition = {
+        "assetname": "rtu 1",
+        "pointname": "Supply_Air_Temperature_Sensor",
+        "path": "asset=rtu%201/point=Supply_Air_Temperature_Sensor/",
+    }
+    (tmp_path / "prefix" / partition["path"]).mkdir(parents=True)
+    timestamps = 1_600_000_000_000_000_000 + np.arange(100, dtype=np.int64) * 60_000_000_000
+    pd.DataFrame({"value": np.linspace(0, 1, 100, dtype=np.float32), "timestamp": timestamps}).to_parquet(
+        tmp_path / "prefix" / partition["path"] / "part-00000.parquet", index=False
+    )
+    read_parquet = pd.read_parquet
+    # the functions read from S3, the test from the local copy of the bucket
+    monkeypatch.setattr(
+        pd,
+        "read_parquet",
+        lambda path, **kwargs: read_parquet(str(path).replace("s3://bucket/", f"{tmp_path}/"), **kwargs),
+    )
+    columns = ["assetname", "pointname", "value", "timestamp"]
+    for columns in (columns, columns[::-1], ["timestamp", "pointname"]):
+        pd.testing.assert_frame_equal(
+            training.read_partition(f"s3://bucket/prefix/{partition['path']}", partition, columns),
+            init_lambda.readPartition("bucket", "prefix/", partition, columns),
+        )
@@ -0,0 +1,226 @@
+import json
+import time
+import numpy as np
+import pandas as pd
+import pytest
+
+import sitewise_history as sh
+from fakes import FakeSiteWise
+
+START = 1_600_000_000
+# values every 250 ms, so most seconds hold several of them
+STEP_NS = 250_000_000
+
+
+def makeSeries(first_second, count):
+    return [first_second * 1_000_000_000 + index * STEP_NS for index in range(count)]
+
+
+def getAssetProperties(data):
+    return [
+        {
+            "assetName": f"rtu{index % 3}",
+            "assetSiteWiseId": f"asset{index % 3}",
+            "pointName": f"brick:pt{index}",
+            "pointSiteWiseId": property_id,
+        }
+        for index, property_id in enumerate(data)
+    ]
+
+
+def getExpected(data, start_time, end_time):
+    rows = [
+        (f"rtu{index % 3}", f"pt{index}", t / 1e9, t)
+        for index, series in enumerate(data.values())
+        for t in series
+        if start_time < t // 1_000_000_000 <= end_time
+    ]
+    return pd.DataFrame(rows, columns=["assetname", "pointname", "value", "timestamp"])
+
+
+def normalize(frame):
+    return frame.astype({"assetname": str, "pointname": str}).reset_index(drop=True)
+
+
+@pytest.fixture
+def data():
+    # more series than a request holds, of different lengths, so entries finish at different times
+    return {f"prop{index}": makeSeries(START + index % 7, 100 + 37 * (index % 5)) for index in range(20)}
+
+
+def test_resumed_request_starts_before_the_cursor_second():
+    state = {
+        "entryId": "0",
+        "assetId": "asset",
+        "propertyId": "prop",
+        "startDate": START,
+        "endDate": START + 100,
+        "cursor": (START + 10) * 1_000_000_000 + 500_000_000,
+    }
+    entry = sh.buildHistoryRequestEntry(state, sh.HISTORY_QUERY)
+    assert entry["startDate"] == START + 9
+
+    # values after the cursor can still be in the last second of the range
+    state["cursor"] = (START + 100) * 1_000_000_000 + 250_000_000
+    assert sh.buildHistoryRequestEntry(state, sh.HISTORY_QUERY)["startDate"] == START + 99
+    state["cursor"] = (START + 101) * 1_000_000_000
+    assert sh.buildHistoryRequestEntry(state, sh.HISTORY_QUERY) is None
+
+
+@pytest.mark.parametrize("workers", [1, 2, 4])
+@pytest.mark.parametrize("slice_seconds", [0, 10, 17])
+def test_fetch_reads_every_value_once(data, workers, slice_seconds):
+    client = FakeSiteWise(data)
+    query = dict(sh.HISTORY_QUERY, maxResults=30)
+    end_time = START + 80
+    frame = sh.fetchHistory(
+        client, getAssetProperties(data), START, end_time, workers=workers, slice_seconds=slice_seconds, query=query
+    )
+    pd.testing.assert_frame_equal(normalize(frame), getExpected(data, START, end_time))
+    assert any(token is not None for _, token in client.requests)
+
+
+def test_free_slots_are_refilled(data):
+    client = FakeSiteWise(data)
+    query = dict(sh.HISTORY_QUERY, maxResults=30)
+    frame = sh.fetchHistory(client, getAssetProperties(data), START, START + 80, query=query)
+    pd.testing.assert_frame_equal(normalize(frame), getExpected(data, START, START + 80))
+
+    # the entries still in flight resumed from their cursors in the refilled requests
+    assert all(len(entries) <= sh.MAX_BATCH_ENTRIES for entries, _ in client.requests)
+    first_starts = {}
+    resumed = 0
+    for entries, token in client.requests:
+        for entry in entries:
+            first_starts.setdefault(entry["entryId"], entry["startDate"])
+            resumed += token is None and entry["startDate"] != first_starts[entry["entryId"]]
+    assert resumed > 0
+
+
+def test_slices_keep_values_on_their_boundaries_once():
+    # a value exactly on every slice boundary, and values just before and after it
+    series = sorted(
+        t
+        for boundary in range(START + 10, START + 60, 10)
+        for t in (boundary * 1_000_000_000 - 1, boundary * 1_000_000_000, boundary * 1_000_000_000 + 1)
+    )
+    data = {"prop0": series}
+    frame = sh.fetchHistory(FakeSiteWise(data), getAssetProperties(data), START, START + 60, slice_seconds=10)
+    assert frame["timestamp"].tolist() == series
+
+
+def test_ranges_are_read_per_property(data):
+    # sub-second range ends, a property read over two ranges and one that is not read at all
+    second = 1_000_000_000
+    ranges = [
+        [[(START + 5) * second + 500_000_000, (START + 12) * second + 250_000_000]],
+        [[(START + 2) * second, (START + 4) * second], [(START + 30) * second, (START + 61) * second]],
+        [],
+    ]
+    ranges = (ranges * len(data))[: len(data)]
+    frame = sh.fetchHistory(
+        FakeSiteWise(data),
+        getAssetProperties(data),
+        START,
+        START + 80,
+        slice_seconds=10,
+        query=dict(sh.HISTORY_QUERY, maxResults=30),
+        ranges=ranges,
+    )
+    expected = getExpected(data, START, START + 80)
+    keep = np.zeros(len(expected), dtype=bool)
+    for index, property_ranges in enumerate(ranges):
+        in_point = (expected["pointname"] == f"pt{index}").to_numpy()
+        for lower, upper in property_ranges:
+            keep |= in_point & expected["timestamp"].between(lower, upper - 1).to_numpy()
+    pd.testing.assert_frame_equal(normalize(frame), expected[keep].reset_index(drop=True))
+
+
+def test_watermarks_resume_after_the_newest_value(data):
+    end_time = START + 80
+    watermarks = {}
+    query = dict(sh.HISTORY_QUERY, maxResults=30)
+    # the first run happens while the values of its last second are still arriving
+    cut = (START + 40) * 1_000_000_000 + 400_000_000
+    arrived = {property_id: [t for t in series if t < cut] for property_id, series in data.items()}
+    first = sh.fetchHistory(
+        FakeSiteWise(arrived), getAssetProperties(data), START, START + 40, watermarks=watermarks, query=query
+    )
+    second = sh.fetchHistory(
+        FakeSiteWise(data), getAssetProperties(data), START, end_time, watermarks=watermarks, query=query
+    )
+    frame = pd.concat([normalize(first), normalize(second)]).sort_values(["pointname", "timestamp"], kind="stable")
+    expected = getExpected(data, START, end_time).sort_values(["pointname", "timestamp"], kind="stable")
+    pd.testing.assert_frame_equal(frame.reset_index(drop=True), expected.reset_index(drop=True))
+
+
+@pytest.mark.parametrize("reject_tokens", [False, True])
+def test_suspended_fetch_resumes_from_its_checkpoint(data, reject_tokens):
+    client = FakeSiteWise(data, reject_tokens=reject_tokens)
+    query = dict(sh.HISTORY_QUERY, maxResults=18)
+    end_time = START + 80
+    frames = []
+    checkpoint = None
+    invocations = 0
+    while True:
+        invocations += 1
+        client.generation += 1
+        stop_at = client.calls + 2
+        checkpoint = sh.fetchHistory(
+            client,
+            getAssetProperties(data),
+            START,
+            end_time,
+            workers=2,
+            slice_seconds=20,
+            sink=frames.append,
+            chunk_rows=100,
+            query=query,
+            checkpoint=checkpoint,
+            should_stop=lambda: client.calls >= stop_at,
+        )
+        if checkpoint is None:
+            break
+        # the checkpoint is stored as JSON between invocations, the buffers separately
+        buffers = checkpoint.pop("buffers")
+        checkpoint = dict(json.loads(json.dumps(checkpoint)), buffers=buffers)
+    assert invocations > 2
+    frame = pd.concat(frames, ignore_index=True)
+    pd.testing.assert_frame_equal(normalize(frame), getExpected(data, START, end_time))
+
+
+def test_failed_entries_are_retried_from_their_cursors(data):
+    client = FakeSiteWise(data)
+    throttled = set()
+    read = client.batch_get_asset_property_value_history
+
+    def throttleOnce(entries, maxResults, nextToken=None):
+        response = read(entries, maxResults, nextToken)
+        for entry in response["successEntries"][:1]:
+            if entry["entryId"] not in throttled and nextToken is not None:
+                throttled.add(entry["entryId"])
+                response["successEntries"].remove(entry)
+                response["errorEntries"].append({"entryId": entry["entryId"], "errorCode": "ThrottlingException"})
+        return response
+
+    client.batch_get_asset_property_value_history = throttleOnce
+    query = dict(sh.HISTORY_QUERY, maxResults=30)
+    failures = []
+    frame = sh.fetchHistory(client, getAssetProperties(data), START, START + 80, query=query, failures=failures)
+    assert throttled and not failures
+    pd.testing.assert_frame_equal(normalize(frame), getExpected(data, START, START + 80))
+
+
+def test_wall_time_scales_with_workers():
+    # more properties than one request holds, each with several pages
+    data = {f"prop{index}": makeSeries(START + 1, 200) for index in range(64)}
+    elapsed = {}
+    for workers in (1, 4):
+        client = FakeSiteWise(data, delay=0.02)
+        begin = time.perf_counter()
+        frame = sh.fetchHistory(
+            client, getAssetProperties(data), START, START + 60, workers=workers, query=dict(sh.HISTORY_QUERY, maxResults=50)
+        )
+        elapsed[workers] = time.perf_counter() - begin
+        assert len(frame) == 64 * 200
+    assert elapsed[4] < elapsed[1] / 2
@@ -0,0 +1,104 @@
+from collections import Counter
+import numpy as np
+import pandas as pd
+import pytest
+
+import timestream_writer
+from fakes import FakeTimestream
+from timestream_writer import MAX_RECORDS_PER_REQUEST, TimestreamWriter, build_records
+
+START = 1_600_000_000_000_000_000
+MINUTE = 60_000_000_000
+DIMENSIONS = {"site_id": "site", "rtu": "rtu1", "point": "Supply_Air_Temperature_Sensor"}
+
+
+def getRecords(rows, offset=0.0):
+    values = np.arange(rows, dtype=np.float64) + offset
+    values[3] = np.nan
+    return build_records(
+        pd.DataFrame(
+            {
+                "timestamp": START + np.arange(rows, dtype=np.int64) * MINUTE,
+                "value": values,
+                "is_anomaly": values > rows / 2,
+            }
+        )
+    )
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(timestream_writer.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_records_are_sent_in_requests_with_common_attributes(sleeps):
+    client = FakeTimestream()
+    records = getRecords(250)
+    assert TimestreamWriter(client, "db", "table").write(DIMENSIONS, records) == []
+
+    sizes = sorted(len(request["Records"]) for request in client.requests)
+    assert sizes == [50, MAX_RECORDS_PER_REQUEST, MAX_RECORDS_PER_REQUEST]
+    for request in client.requests:
+        assert request["CommonAttributes"] == {
+            "Dimensions": [{"Name": name, "Value": value} for name, value in DIMENSIONS.items()],
+            "MeasureName": "inference",
+            "MeasureValueType": "MULTI",
+            "TimeUnit": "NANOSECONDS",
+        }
+        # the records only hold what differs between them
+        assert all(set(record) == {"Time", "MeasureValues"} for record in request["Records"])
+    # a missing value is left out of its record
+    assert [measure["Name"] for measure in records[3]["MeasureValues"]] == ["is_anomaly"]
+    assert not sleeps
+
+
+def test_rescored_values_replace_the_written_ones(sleeps):
+    client = FakeTimestream()
+    writer = TimestreamWriter(client, "db", "table")
+    assert writer.write(DIMENSIONS, getRecords(150)) == []
+    # values scored again, some of them differently
+    assert writer.write(DIMENSIONS, getRecords(150, offset=0.5)) == []
+    first = {record["Time"]: record["MeasureValues"] for record in getRecords(150)}
+    stored = {key[2]: stored for key, stored in client.table.items()}
+    for record in getRecords(150, offset=0.5):
+        # a value that did not change keeps its version
+        version = 1 if record["MeasureValues"] == first[record["Time"]] else 2
+        assert stored[record["Time"]] == (version, record["MeasureValues"])
+    assert sum(version == 2 for version, _ in stored.values()) == 149
+    assert not sleeps
+
+
+def test_throttled_requests_are_repeated_with_backoff(sleeps):
+    client = FakeTimestream(throttle_calls=3)
+    writer = TimestreamWriter(client, "db", "table", workers=1, backoff_seconds=0.1)
+    assert writer.write(DIMENSIONS, getRecords(150)) == []
+    assert sleeps == pytest.approx([0.1, 0.2, 0.4])
+    assert len(client.table) == 150
+
+    # a request that stays throttled is given up after max_attempts, and its records are reported
+    client = FakeTimestream(throttle_calls=100)
+    writer = TimestreamWriter(client, "db", "table", workers=1, max_attempts=3)
+    rejected = writer.write(DIMENSIONS, getRecords(150))
+    assert len(rejected) == 150 and {record["Reason"] for record in rejected} == {"Retries exhausted"}
+    assert len(client.requests) == 6
+
+
+def test_every_record_is_written_once(sleeps):
+    client = FakeTimestream(throttle_calls=2, retention_ns=500 * MINUTE)
+    writer = TimestreamWriter(client, "db", "table", workers=4)
+    # the newest values first, so the oldest fall outside the retention
+    writer.write(DIMENSIONS, getRecords(1000)[600:])
+    records = getRecords(1000, offset=0.25)
+    rejected = writer.write(DIMENSIONS, records)
+
+    written = Counter(key[2] for key in client.written)
+    kept = {record["Time"] for record in records} - {record["Time"] for record in rejected}
+    # the second write replaced every value of the first one, and added the ones not written before
+    assert all(written[time] == (2 if int(time) >= START + 600 * MINUTE else 1) for time in kept)
+    assert sorted(int(record["Time"]) for record in rejected) == [START + index * MINUTE for index in range(499)]
+    assert all("ingestion window" in record["Reason"] for record in rejected)
+    assert {key[2]: measures for key, (_, measures) in client.table.items()} == {
+        record["Time"]: record["MeasureValues"] for record in records if record["Time"] in kept
+    }
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import training
+
+
+def getRawData(seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for index, rows in enumerate([1, 2, 50, 333, 1000]):
+        frames.append(
+            pd.DataFrame(
+                {
+                    "assetname": f"rtu{index % 2}",
+                    "pointname": f"pt{index}",
+                    # a large offset, so the statistics have to be combined without cancellation
+                    "value": rng.normal(1e6 * index, 1 + index, rows),
+                    "timestamp": 1_600_000_000_000_000_000 + np.arange(rows, dtype=np.int64) * 60_000_000_000,
+                }
+            )
+        )
+    return training.apply_schema(pd.concat(frames, ignore_index=True))
+
+
+def getThresholds(model_df):
+    return model_df.astype({"assetname": str, "pointname": str}).sort_values(
+        ["assetname", "pointname"], ignore_index=True
+    )
+
+
+def assertSameThresholds(model_df, expected_df):
+    model_df, expected_df = getThresholds(model_df), getThresholds(expected_df)
+    assert model_df[["assetname", "pointname"]].equals(expected_df[["assetname", "pointname"]])
+    for column in ("mean", "std"):
+        assert np.allclose(model_df[column], expected_df[column], rtol=1e-9, atol=0, equal_nan=True)
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+@pytest.mark.parametrize("chunk_rows", [7, 100, 500, 10_000])
+def test_streaming_matches_in_memory(chunk_rows, shuffle):
+    data = getRawData()
+    # chunks cut through the rows of a point, which arrive in order or spread over all chunks
+    if shuffle:
+        data = data.sample(frac=1, random_state=1).reset_index(drop=True)
+    chunks = (
+        training.apply_schema(data.iloc[start : start + chunk_rows].astype({"assetname": str, "pointname": str}))
+        for start in range(0, len(data), chunk_rows)
+    )
+    assertSameThresholds(training.create_model_streaming(chunks), training.create_model(data))
+
+
+def getAggregates(data, interval_ns=3600 * 1_000_000_000):
+    # count, average and population standard deviation per interval, as SiteWise reports them. an interval
+    # with a single value has a missing standard deviation
+    values = data["value"].groupby(
+        [data["assetname"], data["pointname"], data["timestamp"] // interval_ns * interval_ns], observed=True
+    )
+    aggregates = pd.DataFrame(
+        {"count": values.count().astype(np.float64), "mean": values.mean(), "std": values.std(ddof=0)}
+    )
+    aggregates.loc[aggregates["count"] == 1, "std"] = np.nan
+    aggregates.index.names = ["assetname", "pointname", "timestamp"]
+    return training.apply_schema(aggregates.reset_index())
+
+
+def test_aggregates_match_raw_values():
+    data = getRawData()
+    aggregates = getAggregates(data)
+    assert (aggregates["count"] > 1).any() and (aggregates["count"] == 1).any()
+    expected = training.create_model(data)
+    assertSameThresholds(training.create_model_from_aggregates(aggregates), expected)
+    assertSameThresholds(training.create_model_streaming([aggregates]), expected)
+
+
+def test_aggregate_std_is_population_std(monkeypatch):
+    data = getRawData()
+    aggregates = getAggregates(data)
+    # reading the population standard deviations as sample standard deviations understates the spread
+    monkeypatch.setattr(training, "AGGREGATE_STD_DDOF", 1)
+    model_df = getThresholds(training.create_model_from_aggregates(aggregates))
+    expected_df = getThresholds(training.create_model(data))
+    several = expected_df["pointname"].isin(["pt2", "pt3", "pt4"])
+    assert (model_df["std"][several] < expected_df["std"][several]).all()